@@ -0,0 +1,59 @@
+"""
+How many fetches canonicalising links saves when crawling the fixture pages.
+
+    python benchmarks/bench_canonical.py [fixture.html ...]
+"""
+import os
+import sys
+import glob
+import argparse
+from urllib.parse import urljoin
+
+import lxml.html
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ttc_scraper.parser import pagination_links
+from ttc_scraper.urls import canonical_url
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASE_URL = 'http://sae.wsu.edu/ttc/'
+
+
+def followed_links(tree):
+    """
+    Every link ``ForumSpider`` would consider queueing from a page.
+    """
+    for xpath in ('//a[@class="forumtitle"]', '//a[@class="topictitle"]'):
+        for elem in tree.xpath(xpath):
+            yield urljoin(BASE_URL, elem.get('href'))
+
+    for href, _ in pagination_links(tree):
+        yield urljoin(BASE_URL, href)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('fixtures', nargs='*',
+            default=sorted(glob.glob(os.path.join(HERE, 'fixtures', '*.html'))))
+    args = parser.parse_args()
+
+    raw, canonical = set(), set()
+
+    for filename in args.fixtures:
+        with open(filename, encoding='utf-8') as f:
+            tree = lxml.html.fromstring(f.read())
+
+        for link in followed_links(tree):
+            raw.add(link)
+            canonical.add(canonical_url(link))
+
+    saved = len(raw) - len(canonical)
+    print('distinct raw links:       {}'.format(len(raw)))
+    print('distinct canonical links: {}'.format(len(canonical)))
+    print('fetches saved:            {} ({:.0%})'.format(
+        saved, saved / len(raw) if raw else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Crawl the synthetic board from ``phpbb_site.py`` end to end at several
+sizes, reporting pages/sec, posts/sec, time spent writing to the database
+and peak memory. Each crawl runs in its own process. Pages are counted by the
+server, so attachments are included when they're downloaded (``-a``).
+
+    python benchmarks/bench_crawl.py [-n POSTS ...] [-e ENGINE] [-c CONCURRENCY] [-j PROCESSES]
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import resource
+import subprocess
+
+from sqlalchemy import create_engine, select, func
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ttc_scraper.models import Post
+from phpbb_site import Site, serve, USERNAME, PASSWORD
+
+
+def run_crawl(args):
+    if args.engine == 'asyncio':
+        from ttc_scraper.aio import AsyncForumSpider as spider_class
+    else:
+        from ttc_scraper.spider import ForumSpider as spider_class
+
+    directory = tempfile.mkdtemp()
+
+    spidey = spider_class(thread_number=args.concurrency)
+    spidey.initial_urls = [args.url]
+    spidey.database_location = os.path.join(directory, 'records.sqlite')
+    spidey.log_file = os.path.join(directory, 'crawler.log')
+    spidey.username = USERNAME
+    spidey.password = PASSWORD
+    spidey.parse_processes = args.parse_processes
+    if args.attachments:
+        spidey.download_dir = os.path.join(directory, 'attachments')
+
+    start = time.perf_counter()
+    spidey.run()
+    elapsed = time.perf_counter() - start
+
+    engine = create_engine('sqlite:///{}'.format(spidey.database_location))
+    with engine.connect() as conn:
+        posts = conn.execute(select([func.count(Post.id)])).scalar()
+
+    print(json.dumps({
+        'posts': posts,
+        'elapsed': elapsed,
+        'flush_time': spidey.writer.flush_time,
+        'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--posts', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('-e', '--engine', choices=['grab', 'asyncio'], default='grab')
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('-j', '--parse-processes', type=int, default=0)
+    parser.add_argument('-a', '--attachments', action='store_true',
+            help='Download the attachments as part of the crawl')
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='How long the server takes to respond')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run_crawl(args)
+
+    print('{:>7} {:>7} {:>8} {:>10} {:>10} {:>12} {:>10}'.format('posts', 'pages',
+        'seconds', 'pages/sec', 'posts/sec', 'DB writes', 'peak RSS'))
+
+    for posts in args.posts:
+        site = Site(posts)
+        server, url = serve(site, latency=args.latency)
+
+        command = [sys.executable, __file__, '--run', '--url', url,
+                   '-e', args.engine, '-c', str(args.concurrency),
+                   '-j', str(args.parse_processes)]
+        if args.attachments:
+            command.append('--attachments')
+
+        output = subprocess.check_output(command)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        pages = server.RequestHandlerClass.requests
+        server.shutdown()
+
+        elapsed = result['elapsed']
+        print('{:>7} {:>7} {:>8.1f} {:>10.1f} {:>10.1f} {:>6.2f}s ({:>2.0%}) {:>8.1f}MB'.format(
+            result['posts'], pages, elapsed, pages / elapsed, result['posts'] / elapsed,
+            result['flush_time'], result['flush_time'] / elapsed, result['peak_kb'] / 1024))
+
+        if result['posts'] != site.post_count:
+            print('        (the site has {} posts)'.format(site.post_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Compare grab's Spider with ``AsyncSpider`` crawling a local server which
+serves the fixture pages, reporting requests/sec and peak memory. Each
+engine runs in its own process so their memory use doesn't overlap.
+
+    python benchmarks/bench_engine.py [-n PAGES] [-c CONCURRENCY] [--latency SECONDS]
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import resource
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    pages = {}
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        kind = 'viewforum.html' if 'viewforum' in self.path else 'viewtopic.html'
+        body = self.pages[kind]
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(latency):
+    for name in ('viewforum.html', 'viewtopic.html'):
+        with open(os.path.join(FIXTURES, name), 'rb') as f:
+            FixtureHandler.pages[name] = f.read()
+    FixtureHandler.latency = latency
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_spider(base, root, pages):
+    class BenchSpider(base):
+        initial_urls = [root + 'viewforum.php?f=1']
+
+        def prepare(self):
+            self.fetched = 0
+
+        def task_initial(self, grab, task):
+            self.fetched += 1
+            for i in range(pages - 1):
+                yield Task('page', url='{}viewtopic.php?t={}'.format(root, i))
+
+        def task_page(self, grab, task):
+            self.fetched += 1
+            grab.doc.tree
+
+    return BenchSpider
+
+
+def run_engine(engine, root, pages, concurrency):
+    global Task
+    if engine == 'grab':
+        from grab.spider import Spider as base, Task
+    else:
+        from grab.spider import Task
+        from ttc_scraper.aio import AsyncSpider as base
+
+    spider = make_spider(base, root, pages)(thread_number=concurrency)
+    start = time.perf_counter()
+    spider.run()
+    elapsed = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'fetched': spider.fetched, 'elapsed': elapsed, 'peak_kb': peak}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--pages', type=int, default=1000)
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.01,
+            help='How long the server takes to respond')
+    parser.add_argument('--engine', help=argparse.SUPPRESS)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.engine:
+        return run_engine(args.engine, args.root, args.pages, args.concurrency)
+
+    server = serve(args.latency)
+    root = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    print('{:>8} {:>8} {:>10} {:>10}'.format('engine', 'pages', 'req/sec', 'peak RSS'))
+    for engine in ('grab', 'asyncio'):
+        output = subprocess.check_output([sys.executable, __file__,
+            '--engine', engine, '--root', root,
+            '-n', str(args.pages), '-c', str(args.concurrency)])
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        print('{:>8} {:>8} {:>10.1f} {:>8.1f}MB'.format(engine, result['fetched'],
+            result['fetched'] / result['elapsed'], result['peak_kb'] / 1024))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
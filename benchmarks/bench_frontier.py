@@ -0,0 +1,70 @@
+"""
+Memory use and lookup throughput of ``SeenUrls`` for a large crawl.
+
+    python benchmarks/bench_frontier.py [-n URLS]
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ttc_scraper.models import Base, Url
+from ttc_scraper.writer import BatchWriter
+from ttc_scraper.frontier import SeenUrls
+
+
+def fake_urls(n):
+    for i in range(n):
+        yield 'http://sae.wsu.edu/ttc/viewtopic.php?f={}&t={}&start={}'.format(
+                i % 97, i // 10, (i % 10) * 10)
+
+
+def populate(engine, n):
+    with engine.begin() as conn:
+        conn.execute(Url.__table__.insert(), [{'link': u} for u in fake_urls(n)])
+
+
+def bench(engine, n, **kwargs):
+    tracemalloc.start()
+    seen = SeenUrls(engine, BatchWriter(engine), **kwargs)
+
+    start = time.perf_counter()
+    seen.load()
+    load_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Half hits, half misses
+    probes = list(fake_urls(n // 2)) + ['http://example.com/{}'.format(i)
+                                        for i in range(n // 2)]
+    start = time.perf_counter()
+    hits = sum(1 for url in probes if url in seen)
+    lookup_time = time.perf_counter() - start
+
+    return load_time, peak, len(probes) / lookup_time, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--urls', type=int, default=1000000)
+    args = parser.parse_args()
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    populate(engine, args.urls)
+
+    print('{:>8} {:>10} {:>12} {:>14} {:>10}'.format(
+        'index', 'load (s)', 'peak (MiB)', 'lookups/sec', 'hits'))
+
+    for name, kwargs in [('hashed', {}), ('bloom', {'bloom_capacity': args.urls})]:
+        load_time, peak, rate, hits = bench(engine, args.urls, **kwargs)
+        print('{:>8} {:>10.2f} {:>12.1f} {:>14,.0f} {:>10}'.format(
+            name, load_time, peak / 2**20, rate, hits))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Crawl the synthetic board from ``phpbb_site.py``, start some new topics in a
+few of its forums, then crawl it again incrementally, reporting how many
+listing and topic pages the second crawl fetched. It's done once with the
+forum markers and cutoff recorded by the first crawl, and once without them
+(as if it had never finished), which reads every listing like older
+versions did. Each crawl runs in its own process.
+
+    python benchmarks/bench_incremental.py [-n POSTS] [--new-posts N] [--changed-forums N]
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from sqlalchemy import create_engine, select, func
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ttc_scraper.models import Post, Crawl
+from phpbb_site import Site, serve, USERNAME, PASSWORD
+
+
+def run_crawl(args):
+    from ttc_scraper.spider import ForumSpider
+
+    spidey = ForumSpider(thread_number=args.concurrency)
+    spidey.initial_urls = [args.url]
+    spidey.database_location = args.database
+    spidey.log_file = args.database + '.log'
+    spidey.username = USERNAME
+    spidey.password = PASSWORD
+    spidey.incremental = args.incremental
+
+    start = time.perf_counter()
+    spidey.run()
+    elapsed = time.perf_counter() - start
+
+    engine = create_engine('sqlite:///{}'.format(args.database))
+    with engine.connect() as conn:
+        posts = conn.execute(select([func.count(Post.id)])).scalar()
+
+    print(json.dumps({
+        'posts': posts,
+        'elapsed': elapsed,
+        'skipped': spidey.forums_skipped,
+        'stopped': spidey.listings_stopped,
+        }))
+
+
+def crawl(server, url, database, args, incremental):
+    handler = server.RequestHandlerClass
+    handler.requests = 0
+    handler.scripts.clear()
+
+    command = [sys.executable, __file__, '--run', '--url', url, '--database', database,
+               '-c', str(args.concurrency)]
+    if incremental:
+        command.append('--incremental')
+
+    output = subprocess.check_output(command)
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result['listings'] = handler.scripts['viewforum.php']
+    result['topics'] = handler.scripts['viewtopic.php']
+    return result
+
+
+def forget_crawls(database):
+    engine = create_engine('sqlite:///{}'.format(database))
+    with engine.begin() as conn:
+        conn.execute(Crawl.__table__.update().values(finished=None))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--posts', type=int, default=20000)
+    parser.add_argument('--new-posts', type=int, default=200,
+            help='How many posts to add before the second crawl')
+    parser.add_argument('--changed-forums', type=int, default=1,
+            help='How many sub-forums the new posts go in')
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--database', help=argparse.SUPPRESS)
+    parser.add_argument('--incremental', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run_crawl(args)
+
+    site = Site(args.posts)
+    server, url = serve(site)
+    directory = tempfile.mkdtemp()
+    database = os.path.join(directory, 'records.sqlite')
+
+    first = crawl(server, url, database, args, incremental=False)
+    print('First crawl: {} posts, {} listing and {} topic pages in {:.1f}s'.format(
+        first['posts'], first['listings'], first['topics'], first['elapsed']))
+
+    subforums = [f.id for f in site.forums.values() if f.parent is not None]
+    site.add_topics(args.new_posts, subforums[:args.changed_forums])
+    print('Added {} posts to {} of {} forums'.format(args.new_posts,
+        min(args.changed_forums, len(subforums)), len(site.forums)))
+
+    print('{:>12} {:>9} {:>7} {:>8} {:>8} {:>8} {:>7}'.format('markers', 'listings',
+        'topics', 'skipped', 'stopped', 'seconds', 'posts'))
+
+    for markers in (True, False):
+        copy = os.path.join(directory, 'records-{}.sqlite'.format(markers))
+        shutil.copy(database, copy)
+        if not markers:
+            forget_crawls(copy)
+
+        result = crawl(server, url, copy, args, incremental=True)
+        print('{:>12} {:>9} {:>7} {:>8} {:>8} {:>8.1f} {:>7}'.format(
+            'used' if markers else 'ignored', result['listings'], result['topics'],
+            result['skipped'], result['stopped'], result['elapsed'], result['posts']))
+
+        if result['posts'] != site.post_count:
+            print('        (the site has {} posts)'.format(site.post_count))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Compare parsing a TTC-style tire test data file line by line, with
+``numpy.loadtxt`` and with the chunked ingest, then time opening the ingested
+run. Each parser runs in its own process so its peak memory can be measured.
+
+    python benchmarks/bench_ingest.py [--size MB] [--chunk-size MB]
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import resource
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+#: The channels of a TTC cornering run
+CHANNELS = ('ET', 'V', 'N', 'SA', 'IA', 'RL', 'RE', 'P', 'FX', 'FY', 'FZ', 'MX', 'MZ',
+            'NFX', 'NFY', 'RST', 'TSTI', 'TSTC', 'TSTO', 'AMBTMP', 'SR', 'SL')
+UNITS = ('s', 'kph', 'rpm', 'deg', 'deg', 'cm', 'cm', 'kPa', 'N', 'N', 'N', 'N-m', 'N-m',
+         'none', 'none', 'degC', 'degC', 'degC', 'degC', 'degC', 'none', 'none')
+
+
+def generate(location, size):
+    """
+    Write about ``size`` bytes of a fake run, returning its number of rows.
+    """
+    random = np.random.RandomState(42)
+    rows = 0
+
+    with open(location, 'w') as f:
+        f.write('Synthetic run 1: {} channels\n'.format(len(CHANNELS)))
+        f.write('\t'.join(CHANNELS) + '\n')
+        f.write('\t'.join(UNITS) + '\n')
+
+        while f.tell() < size:
+            block = random.normal(0, 500, (10000, len(CHANNELS)))
+            block[:, 0] = (rows + np.arange(len(block))) * 0.01
+            np.savetxt(f, block, fmt='%.3f', delimiter='\t')
+            rows += len(block)
+
+    return rows
+
+
+def parse_lines(location):
+    with open(location) as f:
+        for _ in range(3):
+            f.readline()
+        rows = [[float(value) for value in line.split('\t')] for line in f]
+    return np.array(rows)
+
+
+def run_parser(args):
+    start = time.perf_counter()
+
+    if args.parser == 'lines':
+        rows = len(parse_lines(args.location))
+    elif args.parser == 'loadtxt':
+        rows = len(np.loadtxt(args.location, skiprows=3, delimiter='\t'))
+    else:
+        from ttc_scraper.ingest import ingest_file
+        _, _, rows = ingest_file(args.location, args.location + '.run',
+                chunk_size=args.chunk_size * 1024 * 1024)
+
+    print(json.dumps({
+        'elapsed': time.perf_counter() - start,
+        'rows': rows,
+        'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }))
+
+
+def time_open(location):
+    from ttc_scraper.ingest import Run
+
+    directory = location + '.run'
+    channels = [(name, unit, name + '.npy') for name, unit in zip(CHANNELS, UNITS)]
+
+    start = time.perf_counter()
+    run = Run(directory, '', channels, None)
+    run['FZ'][0]
+    opened = time.perf_counter() - start
+
+    start = time.perf_counter()
+    run['FZ'].mean()
+    scanned = time.perf_counter() - start
+    return opened, scanned
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=100,
+            help='Roughly how many megabytes of data to parse')
+    parser.add_argument('--chunk-size', type=int, default=4,
+            help='How many megabytes the ingest parses at a time')
+    parser.add_argument('--parsers', nargs='+', default=['lines', 'loadtxt', 'ingest'],
+            choices=['lines', 'loadtxt', 'ingest'])
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--parser', help=argparse.SUPPRESS)
+    parser.add_argument('--location', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run_parser(args)
+
+    location = os.path.join(tempfile.mkdtemp(), 'run.dat')
+    rows = generate(location, args.size * 1024 * 1024)
+    size = os.path.getsize(location) / 1024 / 1024
+    print('{:.0f} MB, {} rows of {} channels'.format(size, rows, len(CHANNELS)))
+    print('{:>10} {:>8} {:>8} {:>10}'.format('parser', 'seconds', 'MB/sec', 'peak RSS'))
+
+    for name in args.parsers:
+        output = subprocess.check_output([sys.executable, __file__, '--run',
+            '--parser', name, '--location', location,
+            '--chunk-size', str(args.chunk_size)])
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        assert result['rows'] == rows, result
+
+        print('{:>10} {:>8.1f} {:>8.1f} {:>8.1f}MB'.format(name, result['elapsed'],
+            size / result['elapsed'], result['peak_kb'] / 1024))
+
+    if 'ingest' in args.parsers:
+        opened, scanned = time_open(location)
+        print('Opened the ingested run in {:.2f}ms, and read all of FZ in {:.1f}ms'.format(
+            opened * 1000, scanned * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Compare how many thread pages/sec we can get through with the old
+lxml + BeautifulSoup double parse against the single lxml pass in
+``ttc_scraper.parser``.
+
+    python benchmarks/bench_parser.py [-n PAGES] [fixture.html ...]
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+from datetime import datetime
+from urllib.parse import urljoin
+
+import lxml.html
+from bs4 import BeautifulSoup
+from html2text import html2text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ttc_scraper.parser import parse_thread
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+URL = 'http://sae.wsu.edu/ttc/viewtopic.php?f=12&t=345'
+
+
+def legacy(body):
+    """
+    What ``ForumSpider.task_thread`` used to do for every page.
+    """
+    tree = lxml.html.fromstring(body)
+    soup = BeautifulSoup(body, 'html.parser')
+    posts = []
+
+    for elem in soup.find_all(class_='postbody'):
+        author_tag = elem.find(class_='author')
+        author = author_tag.strong.text
+        created = author_tag.text.split('»')[-1].strip()
+        content = elem.find(class_='content')
+        created_on = datetime.strptime(created, '%a %b %d, %Y %I:%M %p')
+
+        for anchor in content.find_all('a'):
+            anchor['href'] = urljoin(URL, anchor['href'])
+
+        html = ''.join(str(c) for c in content.contents)
+        posts.append((author, created_on, html, html2text(html)))
+
+        for img in content.find_all('img'):
+            urljoin(URL, img['src'])
+
+        attach_box = elem.find(class_='attachbox')
+        if attach_box is not None:
+            for thing in attach_box.find_all(class_='postlink'):
+                urljoin(URL, thing['href'])
+
+    pages = [(a.get('href'), a.text_content())
+             for div in tree.xpath('//div[@class="pagination"]')
+             for a in div.xpath('span/a')]
+    return posts, pages
+
+
+def single_pass(body):
+    return parse_thread(lxml.html.fromstring(body), URL)
+
+
+def bench(func, bodies, n):
+    start = time.perf_counter()
+    for i in range(n):
+        func(bodies[i % len(bodies)])
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('fixtures', nargs='*',
+            default=glob.glob(os.path.join(HERE, 'fixtures', 'viewtopic*.html')))
+    parser.add_argument('-n', '--pages', type=int, default=500)
+    args = parser.parse_args()
+
+    bodies = []
+    for filename in args.fixtures:
+        with open(filename, encoding='utf-8') as f:
+            bodies.append(f.read())
+
+    before = bench(legacy, bodies, args.pages)
+    after = bench(single_pass, bodies, args.pages)
+
+    print('lxml + BeautifulSoup: {:8.1f} pages/sec'.format(before))
+    print('single lxml pass:     {:8.1f} pages/sec'.format(after))
+    print('speedup:              {:8.2f}x'.format(after / before))
+
+
+if __name__ == '__main__':
+    main()
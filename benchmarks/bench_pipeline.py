@@ -0,0 +1,77 @@
+"""
+Compare parsing thread pages inline (as grab's handler thread used to) with
+handing them to ``ParsePipeline``, reporting how long the handler thread is
+kept busy (including any time spent blocked on a full pipeline) and the
+overall pages per second. The pipeline only pulls ahead on throughput with
+more than one core to run on.
+
+    python benchmarks/bench_pipeline.py [-n PAGES] [-j PROCESSES]
+"""
+import os
+import sys
+import time
+import argparse
+
+import lxml.html
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ttc_scraper.parser import parse_thread, pagination_links
+from ttc_scraper.pipeline import ParsePipeline
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'viewtopic.html')
+URL = 'http://sae.wsu.edu/ttc/viewtopic.php?t=1'
+
+
+def inline(body, pages):
+    start = time.perf_counter()
+    posts = 0
+    for _ in range(pages):
+        tree = lxml.html.fromstring(body)
+        posts += len(parse_thread(tree, URL).posts)
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed, posts
+
+
+def pipelined(body, pages, processes, max_pending=None):
+    posts = []
+    pipeline = ParsePipeline(lambda context, page: posts.append(len(page.posts)),
+            processes=processes, max_pending=max_pending)
+    # Don't count starting the pool
+    pipeline.submit(URL, body, None)
+    pipeline.drain(wait=True)
+    posts.clear()
+
+    start = time.perf_counter()
+    busy = 0.0
+    for _ in range(pages):
+        handler_start = time.perf_counter()
+        # The handler still needs the pagination links from the tree
+        tree = lxml.html.fromstring(body)
+        list(pagination_links(tree))
+        pipeline.submit(URL, body, None)
+        busy += time.perf_counter() - handler_start
+    pipeline.close()
+    return busy, time.perf_counter() - start, sum(posts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--pages', type=int, default=500)
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--max-pending', type=int,
+            help='Pages allowed in the pool before the handler blocks')
+    args = parser.parse_args()
+
+    with open(FIXTURE, 'rb') as f:
+        body = f.read()
+
+    print('{:>12} {:>14} {:>10} {:>8}'.format('mode', 'handler busy', 'pages/s', 'posts'))
+    for name, (busy, total, posts) in [
+            ('inline', inline(body, args.pages)),
+            ('pipeline', pipelined(body, args.pages, args.processes, args.max_pending))]:
+        print('{:>12} {:>13.2f}s {:>10.1f} {:>8}'.format(name, busy,
+            args.pages / total, posts))
+
+
+if __name__ == '__main__':
+    main()
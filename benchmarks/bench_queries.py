@@ -0,0 +1,193 @@
+"""
+Compare reading a scraped database through the models' lazy relationships
+and ``OFFSET`` pagination with the eager loading and keyset pagination in
+``ttc_scraper.queries``, counting queries and timing each. The keyset
+queries are timed again after dropping the indexes they rely on.
+
+    python benchmarks/bench_queries.py [-n POSTS] [--page-size N]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+#: The indexes added for the queries module
+INDEXES = ('ix_posts_thread_created', 'ix_posts_created', 'ix_threads_forum')
+
+POSTS_PER_THREAD = 15
+
+
+def populate(location, posts):
+    """
+    A forum tree like the TTC's (four rounds with two runs each) with
+    ``posts`` posts spread over its threads, a third of them with an
+    attachment.
+    """
+    from ttc_scraper.models import Forum, Thread
+    from ttc_scraper.parser import PostRecord
+    from ttc_scraper.storage import sqlite_engine
+    from ttc_scraper.migrations import upgrade
+    from ttc_scraper.writer import BatchWriter, queue_post
+
+    engine = sqlite_engine(location)
+    upgrade(engine)
+    writer = BatchWriter(engine, batch_size=5000)
+
+    forums = []
+    root = writer.add(Forum, name='Main Forum', link='http://localhost/')
+    for i in range(4):
+        parent = writer.add(Forum, name='Round {}'.format(i + 1),
+                link='http://localhost/viewforum.php?f={}'.format(i * 3 + 1), parent_id=root)
+        forums.append(parent)
+        for j in range(2):
+            forums.append(writer.add(Forum, name='Round {} Run {}'.format(i + 1, j + 1),
+                link='http://localhost/viewforum.php?f={}'.format(i * 3 + j + 2),
+                parent_id=parent))
+
+    html = '<div class="content">{}</div>'.format('Slip angle sweep at 12 psi. ' * 10)
+    start = datetime(2010, 1, 1)
+    threads = -(-posts // POSTS_PER_THREAD)
+
+    for t in range(threads):
+        thread_id = writer.add(Thread, name='Thread {}'.format(t),
+                link='http://localhost/viewtopic.php?t={}'.format(t),
+                forum_id=forums[t % len(forums)])
+
+        # Threads overlap in time, like they do on the forum
+        for i in range(min(POSTS_PER_THREAD, posts - t * POSTS_PER_THREAD)):
+            phpbb_id = t * POSTS_PER_THREAD + i
+            created = start + timedelta(minutes=t * 5 + i * 37)
+            attachments = [('run{}.dat'.format(phpbb_id),
+                            'http://localhost/download/file.php?id={}'.format(phpbb_id))]
+            queue_post(writer, PostRecord(phpbb_id, 'user{}'.format(phpbb_id % 50),
+                created, html, html[23:-6], [], attachments if i % 3 == 0 else []),
+                thread_id)
+
+    writer.close()
+    return engine, forums[0]
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def measure(counter, function):
+    counter.count = 0
+    start = time.perf_counter()
+    result = function()
+    return result, counter.count, time.perf_counter() - start
+
+
+def walk_lazily(Session, forum_id):
+    from ttc_scraper.models import Forum
+    from ttc_scraper.queries import subforum_ids
+
+    session = Session()
+    attachments = 0
+    for forum in session.query(Forum).filter(Forum.id.in_(subforum_ids(session, forum_id))):
+        for thread in forum.child_threads:
+            for post in thread.posts:
+                attachments += len(post.attachments)
+    session.close()
+    return attachments
+
+
+def walk_eagerly(Session, forum_id, page_size):
+    from ttc_scraper.queries import iter_forum_posts
+
+    session = Session()
+    attachments = sum(len(post.attachments)
+                      for post in iter_forum_posts(session, forum_id, page_size))
+    session.close()
+    return attachments
+
+
+def offset_page(Session, offset, page_size):
+    from ttc_scraper.models import Post
+
+    session = Session()
+    page = (session.query(Post).order_by(Post.created, Post.id)
+            .offset(offset).limit(page_size).all())
+    for post in page:
+        post.attachments, post.threads
+    session.close()
+    return page
+
+
+def keyset_page(Session, after, page_size):
+    from ttc_scraper.queries import posts_since
+
+    session = Session()
+    page = posts_since(session, datetime(1970, 1, 1), page_size, after)
+    for post in page:
+        post.attachments, post.threads
+    session.close()
+    return page
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--posts', type=int, default=200000)
+    parser.add_argument('--page-size', type=int, default=100)
+    args = parser.parse_args()
+
+    from ttc_scraper.models import Post
+
+    location = os.path.join(tempfile.mkdtemp(), 'records.sqlite')
+    engine, forum_id = populate(location, args.posts)
+    Session = sessionmaker(bind=engine)
+    counter = QueryCounter(engine)
+
+    with engine.connect() as conn:
+        posts = conn.execute('SELECT count(*) FROM posts').scalar()
+    print('{} posts in {} threads'.format(posts, -(-posts // POSTS_PER_THREAD)))
+
+    # The post each keyset page starts after
+    session = Session()
+    depths = [0, posts // 2, posts - args.page_size]
+    cursors = [None] + [session.query(Post).order_by(Post.created, Post.id)
+                        .offset(depth - 1).first() for depth in depths[1:]]
+    session.close()
+
+    print('{:>34} {:>9} {:>9}'.format('', 'queries', 'seconds'))
+
+    def report(name, counted):
+        _, queries, elapsed = counted
+        print('{:>34} {:>9} {:>9.3f}'.format(name, queries, elapsed))
+
+    lazy = measure(counter, lambda: walk_lazily(Session, forum_id))
+    report('forum subtree, lazy', lazy)
+
+    for indexed in (True, False):
+        if not indexed:
+            with engine.begin() as conn:
+                for index in INDEXES:
+                    conn.execute('DROP INDEX {}'.format(index))
+            print('Without {}:'.format(', '.join(INDEXES)))
+
+        eager = measure(counter, lambda: walk_eagerly(Session, forum_id, 500))
+        assert eager[0] == lazy[0], (eager[0], lazy[0])
+        report('forum subtree, eager + keyset', eager)
+
+        for depth, cursor in zip(depths, cursors):
+            if indexed:
+                report('page at {}, offset'.format(depth), measure(counter,
+                    lambda: offset_page(Session, depth, args.page_size)))
+            report('page at {}, keyset'.format(depth), measure(counter,
+                lambda: keyset_page(Session, cursor, args.page_size)))
+
+
+if __name__ == '__main__':
+    main()
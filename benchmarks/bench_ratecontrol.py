@@ -0,0 +1,114 @@
+"""
+Exercise ``AdaptiveRateLimiter`` against a local stand-in server which gets
+slower, then starts returning 503s, as it's pushed past its capacity.
+
+    python benchmarks/bench_ratecontrol.py [-t SECONDS] [-c CONCURRENCY]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from urllib.request import urlopen
+from urllib.error import HTTPError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ttc_scraper.ratecontrol import AdaptiveRateLimiter
+
+
+class OverloadedHandler(BaseHTTPRequestHandler):
+    base_latency = 0.02
+    capacity = 8
+    error_rate = 0.01
+
+    in_flight = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = self.__class__
+        with cls.lock:
+            cls.in_flight += 1
+            load = cls.in_flight
+
+        try:
+            overload = max(0, load - self.capacity)
+            time.sleep(self.base_latency * (1 + overload))
+
+            if overload > self.capacity or random.random() < self.error_rate:
+                self.send_response(503)
+                self.end_headers()
+            else:
+                body = b'x' * 4096
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+def crawl(url, limiter, workers, duration, paced=False):
+    deadline = time.monotonic() + duration
+    done = []
+    windows = []
+
+    def worker():
+        while time.monotonic() < deadline:
+            limiter.wait(paced)
+            start = time.monotonic()
+            try:
+                with urlopen(url) as response:
+                    response.read()
+                limiter.record(time.monotonic() - start)
+                done.append(True)
+            except HTTPError:
+                limiter.record(ok=False)
+                done.append(False)
+            windows.append(limiter.window)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    ok = sum(done)
+    return ok / duration, (len(done) - ok) / max(1, len(done)), sum(windows) / max(1, len(windows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-t', '--duration', type=float, default=10)
+    parser.add_argument('-c', '--concurrency', type=int, default=32)
+    parser.add_argument('--max-rps', type=float)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OverloadedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    print('{:>10} {:>10} {:>10} {:>12}'.format('mode', 'ok/sec', 'errors', 'mean window'))
+
+    fixed = AdaptiveRateLimiter(args.concurrency, min_concurrency=args.concurrency,
+            max_rps=args.max_rps)
+    def adaptive():
+        return AdaptiveRateLimiter(args.concurrency, max_rps=args.max_rps,
+                latency_target=OverloadedHandler.base_latency * 3)
+
+    for name, limiter, paced in [('fixed', fixed, False),
+                                 ('adaptive', adaptive(), False),
+                                 ('paced', adaptive(), True)]:
+        rate, errors, window = crawl(url, limiter, args.concurrency, args.duration, paced)
+        print('{:>10} {:>10.1f} {:>10.1%} {:>12.1f}'.format(name, rate, errors, window))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Compare the crawl order of the priority scheduler with grab's old random
+priorities on the synthetic board: how many tasks pile up in the frontier,
+how soon posts start landing and peak memory. Each crawl runs in its own
+process.
+
+    python benchmarks/bench_scheduler.py [-n POSTS] [-e ENGINE] [-c CONCURRENCY] [--frontier-size N]
+"""
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import tempfile
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from phpbb_site import Site, serve, USERNAME, PASSWORD
+
+MILESTONES = (0.1, 0.5, 0.9)
+
+
+def run_crawl(args):
+    if args.engine == 'asyncio':
+        from ttc_scraper.aio import AsyncForumSpider as spider_class
+    else:
+        from ttc_scraper.spider import ForumSpider as spider_class
+
+    class BenchSpider(spider_class):
+        def task_priority(self, task):
+            if args.order == 'random':
+                # What grab does by default
+                return 0 if task.name == 'initial' else random.randint(1, 100)
+            return super().task_priority(task)
+
+        def save_post(self, post, thread_id):
+            super().save_post(post, thread_id)
+            self.saved += 1
+            for fraction in MILESTONES:
+                if self.saved == int(fraction * args.posts):
+                    self.milestones[fraction] = time.perf_counter() - start
+
+    directory = tempfile.mkdtemp()
+    spidey = BenchSpider(thread_number=args.concurrency)
+    spidey.initial_urls = [args.url]
+    spidey.database_location = os.path.join(directory, 'records.sqlite')
+    spidey.log_file = os.path.join(directory, 'crawler.log')
+    spidey.username = USERNAME
+    spidey.password = PASSWORD
+    spidey.frontier_size = args.frontier_size
+    spidey.saved = 0
+    spidey.milestones = {}
+
+    start = time.perf_counter()
+    spidey.run()
+
+    print(json.dumps({
+        'elapsed': time.perf_counter() - start,
+        'milestones': [spidey.milestones.get(f) for f in MILESTONES],
+        'peak_queue': spidey.frontier.peak_size,
+        'spilled': spidey.frontier.spill_count,
+        'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--posts', type=int, default=20000)
+    parser.add_argument('-e', '--engine', choices=['grab', 'asyncio'], default='grab')
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--frontier-size', type=int, default=100,
+            help='How many tasks the bounded frontier keeps in memory')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--order', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run_crawl(args)
+
+    site = Site(args.posts)
+    args.posts = site.post_count
+    server, url = serve(site)
+
+    print('{:>22} {:>8} {:>8} {:>20} {:>8} {:>10}'.format('scheduler', 'queued', 'spilled',
+        'posts at 10/50/90%', 'seconds', 'peak RSS'))
+
+    variants = [('random', 'random', 10 ** 9),
+                ('priority', 'priority', 10 ** 9),
+                ('priority, bounded', 'priority', args.frontier_size)]
+
+    for label, order, frontier_size in variants:
+        output = subprocess.check_output([sys.executable, __file__, '--run',
+            '--url', url, '--order', order, '-n', str(args.posts), '-e', args.engine,
+            '-c', str(args.concurrency), '--frontier-size', str(frontier_size)])
+        result = json.loads(output.decode().strip().splitlines()[-1])
+
+        print('{:>22} {:>8} {:>8} {:>20} {:>8.1f} {:>8.1f}MB'.format(label,
+            result['peak_queue'], result['spilled'],
+            '/'.join('{:.1f}s'.format(t) if t is not None else '-'
+                     for t in result['milestones']),
+            result['elapsed'], result['peak_kb'] / 1024))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Compare ``LIKE '%...%'`` scans of ``posts.text`` with the ``post_search``
+FTS5 index on a database of synthetic posts.
+
+    python benchmarks/bench_search.py [-n POSTS] [--database PATH]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import itertools
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select, func
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ttc_scraper.models import Thread, Post
+from ttc_scraper.migrations import upgrade
+from ttc_scraper.writer import BatchWriter
+from ttc_scraper.search import search
+
+COMMON = ('the a of and to in is for on with that this it as be at by from '
+          'tire data test run round file').split()
+TOPICAL = ('slip angle camber pressure load cornering stiffness rim width '
+           'lateral force coefficient pacejka fit model hoosier goodyear avon '
+           'compound temperature matlab csv sweep inclination spring rate').split()
+
+QUERIES = ['tire', 'pacejka', 'hoosier AND camber', '"lateral force"', 'xyzzy']
+
+
+def vocabulary(size=20000):
+    """
+    Words and their cumulative (Zipfian) weights, roughly like real text: a handful of
+    very common words, then the topical ones, then a long tail.
+    """
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    tail = {''.join(random.choice(letters) for _ in range(random.randint(4, 10)))
+            for _ in range(size)}
+    words = COMMON + [word for pair in zip(TOPICAL, sorted(tail)) for word in pair] + \
+            sorted(tail)[len(TOPICAL):]
+    weights = itertools.accumulate(1 / (rank + 1) for rank in range(len(words)))
+    return words, list(weights)
+
+
+def populate(engine, posts, threads=1000):
+    writer = BatchWriter(engine, batch_size=5000)
+    random.seed(0)
+    start = datetime(2010, 1, 1)
+    words, cum_weights = vocabulary()
+
+    thread_ids = [writer.add(Thread,
+                name=' '.join(random.choices(words, cum_weights=cum_weights, k=4)),
+                link='http://example.com/viewtopic.php?t={}'.format(i))
+            for i in range(threads)]
+
+    for i in range(posts):
+        writer.add(Post,
+                phpbb_id=i,
+                author='user{}'.format(random.randrange(500)),
+                created=start + timedelta(minutes=i),
+                text=' '.join(random.choices(words, cum_weights=cum_weights,
+                    k=random.randint(20, 150))),
+                thread_id=random.choice(thread_ids))
+    writer.close()
+
+
+def like(engine, word):
+    # The newest matches, which is about the best you can do for "relevant"
+    with engine.connect() as conn:
+        return conn.execute(select([Post.id])
+                .where(Post.text.like('%{}%'.format(word)))
+                .order_by(Post.created.desc())
+                .limit(20)).fetchall()
+
+
+def timed(function, *args, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--posts', type=int, default=200000)
+    parser.add_argument('--database', help='Reuse (or keep) this database')
+    args = parser.parse_args()
+
+    location = args.database or os.path.join(tempfile.mkdtemp(), 'search.sqlite')
+    engine = create_engine('sqlite:///{}'.format(location))
+    upgrade(engine)
+
+    with engine.connect() as conn:
+        existing = conn.execute(select([func.count(Post.id)])).scalar()
+    if not existing:
+        start = time.perf_counter()
+        populate(engine, args.posts)
+        print('Wrote {} posts (indexing as they go) in {:.1f}s'.format(
+            args.posts, time.perf_counter() - start))
+
+    print('{:>22} {:>12} {:>12}'.format('query', 'LIKE (ms)', 'FTS5 (ms)'))
+    for query in QUERIES:
+        # LIKE can only do a plain substring, so compare on the first word
+        word = query.strip('"').split()[0]
+        print('{:>22} {:>12.1f} {:>12.1f}'.format(query,
+            timed(like, engine, word, repeat=1),
+            timed(search, engine, query)))
+
+    if not args.database:
+        os.remove(location)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Crawl the synthetic board with the crawl split between 1, 2 and 4 worker
+processes, checking every worker shared the one login and nothing was
+fetched or stored twice. Each crawl runs in its own process.
+
+    python benchmarks/bench_shards.py [-n POSTS] [-w WORKERS ...] [-e ENGINE] [-c CONCURRENCY]
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import subprocess
+
+from sqlalchemy import create_engine, select, func
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ttc_scraper.models import Post, Thread, Attachment
+from phpbb_site import Site, serve, USERNAME, PASSWORD
+
+
+def run_crawl(args):
+    if args.engine == 'asyncio':
+        from ttc_scraper.aio import AsyncForumSpider as spider_class
+    else:
+        from ttc_scraper.spider import ForumSpider as spider_class
+    from ttc_scraper.shard import run_sharded
+
+    directory = tempfile.mkdtemp()
+
+    spidey = spider_class(thread_number=args.concurrency)
+    spidey.initial_urls = [args.url]
+    spidey.database_location = os.path.join(directory, 'records.sqlite')
+    spidey.log_file = os.path.join(directory, 'crawler.log')
+    spidey.username = USERNAME
+    spidey.password = PASSWORD
+
+    start = time.perf_counter()
+    run_sharded(spidey, args.workers[0])
+    elapsed = time.perf_counter() - start
+
+    posts, threads, attachments = Post.__table__, Thread.__table__, Attachment.__table__
+    engine = create_engine('sqlite:///{}'.format(spidey.database_location))
+    with engine.connect() as conn:
+        result = {
+            'elapsed': elapsed,
+            'posts': conn.execute(select([func.count()]).select_from(posts)).scalar(),
+            'phpbb_ids': conn.execute(select([func.count(posts.c.phpbb_id.distinct())])).scalar(),
+            'threads': conn.execute(select([func.count()]).select_from(threads)).scalar(),
+            'orphans': conn.execute(select([func.count()]).select_from(attachments)
+                .where(~attachments.c.post_id.in_(select([posts.c.id])))).scalar(),
+            }
+
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--posts', type=int, default=20000)
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('-e', '--engine', choices=['grab', 'asyncio'], default='grab')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+            help='Concurrent requests per worker')
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='How long the server takes to respond')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run_crawl(args)
+
+    site = Site(args.posts)
+    print('The board has {} posts in {} threads'.format(site.post_count, len(site.topics)))
+    print('{:>7} {:>7} {:>7} {:>8} {:>8} {:>10} {:>8} {:>9}'.format('workers', 'logins',
+        'pages', 'posts', 'threads', 'pages/sec', 'seconds', 'problems'))
+
+    for workers in args.workers:
+        site.sessions.clear()
+        server, url = serve(site, latency=args.latency)
+
+        output = subprocess.check_output([sys.executable, __file__, '--run',
+            '--url', url, '-w', str(workers), '-e', args.engine,
+            '-c', str(args.concurrency)])
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        pages = server.RequestHandlerClass.requests
+        server.shutdown()
+
+        problems = []
+        if result['posts'] != site.post_count:
+            problems.append('missing posts')
+        if result['phpbb_ids'] != result['posts']:
+            problems.append('duplicate posts')
+        if result['threads'] != len(site.topics):
+            problems.append('wrong thread count')
+        if result['orphans']:
+            problems.append('{} orphaned attachments'.format(result['orphans']))
+
+        print('{:>7} {:>7} {:>7} {:>8} {:>8} {:>10.1f} {:>8.1f} {:>9}'.format(workers,
+            len(site.sessions), pages, result['posts'], result['threads'],
+            pages / result['elapsed'], result['elapsed'], ', '.join(problems) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Time how long ``python -m ttc_scraper`` takes to start for commands which
+should be quick (``--version``, ``--help``, ``stats``), and fail if any of
+them takes longer than a budget on top of the interpreter's own startup or
+imports one of the heavy libraries only crawling needs.
+
+    python benchmarks/bench_startup.py [--budget MS] [--repeat N]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+#: Libraries which take tens to hundreds of milliseconds to import
+HEAVY = ('grab', 'bs4', 'html2text', 'sqlalchemy', 'lxml', 'pycurl', 'numpy',
+         'aiohttp', 'pyarrow', 'pkg_resources')
+
+
+def python(arguments, **kwargs):
+    # So `-m ttc_scraper` works from anywhere
+    path = os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')]))
+    return subprocess.run([sys.executable] + arguments, check=True,
+            env=dict(os.environ, PYTHONPATH=path), **kwargs)
+
+
+def run(arguments):
+    start = time.perf_counter()
+    python(arguments, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def startup(arguments, repeat):
+    run(arguments)
+    return statistics.median(run(arguments) for _ in range(repeat))
+
+
+def heavy_imports(arguments):
+    """
+    Which of the ``HEAVY`` libraries running ``python -m ttc_scraper
+    arguments`` imports, according to ``-X importtime``.
+    """
+    output = python(['-X', 'importtime', '-m', 'ttc_scraper'] + arguments,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE).stderr.decode()
+
+    imported = set()
+    for line in output.splitlines():
+        if line.startswith('import time:'):
+            module = line.rsplit('|', 1)[-1].strip().split('.')[0]
+            if module in HEAVY:
+                imported.add(module)
+    return sorted(imported)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--budget', type=float, default=100,
+            help='The most milliseconds a command may add to the interpreter\'s startup')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    from bench_queries import populate
+
+    database = os.path.join(tempfile.mkdtemp(), 'records.sqlite')
+    populate(database, 1000)
+
+    commands = [['--version'], ['--help'], ['crawl', '--help'], ['stats', '-d', database]]
+
+    interpreter = startup(['-c', 'pass'], args.repeat)
+    print('Interpreter startup: {:.0f}ms'.format(interpreter * 1000))
+    print('{:>16} {:>9} {:>9}  {}'.format('', 'total ms', 'added ms', 'heavy imports'))
+
+    failed = False
+    for command in commands:
+        name = ' '.join(command[:2]) if command[0] == 'crawl' else command[0]
+        elapsed = startup(['-m', 'ttc_scraper'] + command, args.repeat)
+        added = (elapsed - interpreter) * 1000
+        heavy = heavy_imports(command)
+
+        over = added > args.budget or heavy
+        failed = failed or over
+        print('{:>16} {:>9.0f} {:>9.0f}  {}{}'.format(name, elapsed * 1000, added,
+            ', '.join(heavy) or '-',
+            '  OVER BUDGET' if over else ''))
+
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
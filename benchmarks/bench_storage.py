@@ -0,0 +1,173 @@
+"""
+Write a crawl's worth of rows with each SQLite profile while another process
+polls the database like a dashboard would, reporting rows inserted per second
+of writing, how long the crawl's handler was held up by the writer, and the
+reader's query latency. Between pages the crawl waits ``--fetch-time``
+seconds, as if for the network. Each profile runs in its own process.
+
+    python benchmarks/bench_storage.py [-n POSTS] [--fetch-time SECONDS] [--poll-interval SECONDS]
+"""
+import os
+import sys
+import time
+import json
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+#: The profile, and whether the writer has a thread of its own
+VARIANTS = [('default', False), ('tuned', False), ('tuned', True)]
+
+POSTS_PER_PAGE = 20
+
+DASHBOARD_QUERIES = [
+    'SELECT count(*) FROM posts',
+    """SELECT posts.id, posts.created, threads.name FROM posts
+       JOIN threads ON threads.id = posts.thread_id
+       ORDER BY posts.id DESC LIMIT 20""",
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def poll(location, interval, stop, results):
+    """
+    Run the dashboard's queries every ``interval`` seconds until ``stop`` is
+    set, with SQLite's default settings.
+    """
+    conn = sqlite3.connect(location)
+    latencies = []
+    errors = 0
+
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            for query in DASHBOARD_QUERIES:
+                conn.execute(query).fetchall()
+        except sqlite3.OperationalError:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+        time.sleep(interval)
+
+    results.put((latencies, errors))
+
+
+def run_writer(args):
+    from ttc_scraper.models import Forum, Thread, Url, CrawlTask
+    from ttc_scraper.parser import PostRecord
+    from ttc_scraper.storage import sqlite_engine
+    from ttc_scraper.migrations import upgrade
+    from ttc_scraper.writer import BatchWriter, queue_post
+
+    location = os.path.join(tempfile.mkdtemp(), 'records.sqlite')
+    engine = sqlite_engine(location, args.profile)
+    upgrade(engine)
+
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    reader = multiprocessing.Process(target=poll,
+            args=(location, args.poll_interval, stop, results))
+    reader.start()
+    time.sleep(0.2)
+
+    writer = BatchWriter(engine, batch_size=args.batch_size, threaded=args.threaded)
+    html = '<div class="content">{}</div>'.format('Slip angle sweep at 12 psi. ' * 60)
+    created = datetime(2016, 1, 1)
+    stalls = []
+
+    start = time.perf_counter()
+    forum_id = writer.add(Forum, name='Forum', link='http://localhost/viewforum.php?f=1')
+
+    for page in range(args.posts // POSTS_PER_PAGE):
+        time.sleep(args.fetch_time)
+        handler_start = time.perf_counter()
+
+        link = 'http://localhost/viewtopic.php?t={}'.format(page)
+        writer.add(Url, link=link)
+        task_id = writer.add(CrawlTask, name='thread', url=link, state='queued', params='{}')
+        writer.update(CrawlTask, task_id, state='in_flight')
+        thread_id = writer.add(Thread, name='Thread {}'.format(page), link=link,
+                forum_id=forum_id, replies=POSTS_PER_PAGE - 1, last_post=created)
+
+        for i in range(POSTS_PER_PAGE):
+            phpbb_id = page * POSTS_PER_PAGE + i
+            attachments = [('run{}.dat'.format(phpbb_id),
+                            'http://localhost/download/file.php?id={}'.format(phpbb_id))]
+            post = PostRecord(phpbb_id, 'user{}'.format(phpbb_id % 50),
+                    created + timedelta(minutes=phpbb_id), html, html[23:-6],
+                    [], attachments if i % 3 == 0 else [])
+            queue_post(writer, post, thread_id)
+
+        writer.update(CrawlTask, task_id, state='done')
+        stalls.append(time.perf_counter() - handler_start)
+
+    writer.close()
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    latencies, errors = results.get()
+    reader.join()
+
+    print(json.dumps({
+        'rows': writer.rows_written,
+        'elapsed': elapsed,
+        'writing': writer.flush_time,
+        'stall_p99': percentile(stalls, 0.99),
+        'stall_max': max(stalls),
+        'read_p50': percentile(latencies, 0.5),
+        'read_p99': percentile(latencies, 0.99),
+        'read_max': max(latencies) if latencies else 0.0,
+        'reads': len(latencies),
+        'read_errors': errors,
+        }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--posts', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--fetch-time', type=float, default=0.01,
+            help='How long the crawl waits for each page')
+    parser.add_argument('--poll-interval', type=float, default=0.05,
+            help='How long the dashboard waits between queries')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--profile', help=argparse.SUPPRESS)
+    parser.add_argument('--threaded', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run_writer(args)
+
+    print('{:>16} {:>12} {:>9} {:>15} {:>19} {:>7}'.format('profile', 'inserts/sec',
+        'seconds', 'handler p99/max', 'read p50/p99/max', 'errors'))
+
+    for profile, threaded in VARIANTS:
+        command = [sys.executable, __file__, '--run', '--profile', profile,
+                   '-n', str(args.posts), '--batch-size', str(args.batch_size),
+                   '--fetch-time', str(args.fetch_time),
+                   '--poll-interval', str(args.poll_interval)]
+        if threaded:
+            command.append('--threaded')
+
+        output = subprocess.check_output(command)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+
+        print('{:>16} {:>12.0f} {:>9.1f} {:>15} {:>19} {:>7}'.format(
+            profile + (', thread' if threaded else ''),
+            result['rows'] / result['writing'], result['elapsed'],
+            '{:.0f}/{:.0f}ms'.format(result['stall_p99'] * 1000, result['stall_max'] * 1000),
+            '{:.1f}/{:.0f}/{:.0f}ms'.format(result['read_p50'] * 1000,
+                result['read_p99'] * 1000, result['read_max'] * 1000),
+            result['read_errors']))
+
+
+if __name__ == '__main__':
+    main()
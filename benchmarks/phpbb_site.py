@@ -0,0 +1,465 @@
+"""
+A synthetic phpBB board, served locally, for crawling without touching the
+real forum.
+
+The site is generated from a seed, so the same arguments always give the same
+forums, topics and posts. Only the shape of the board (which topics are in
+which forum and how many posts each has) is kept in memory. Pages are
+rendered on request with the prosilver markup the parser expects: nested
+forums, paginated listings and topics, inline images, attachboxes and
+``sid=`` noise on every link. Like the real board, nothing but the index
+can be seen until you've logged in through its login form.
+
+    python benchmarks/phpbb_site.py [--posts N] [--port PORT] [--latency SECONDS]
+
+then crawl it with::
+
+    python -m ttc_scraper crawl USERNAME PASSWORD --url http://localhost:PORT/
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import itertools
+from html import escape
+from datetime import datetime, timedelta
+from collections import namedtuple, Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ttc_scraper.parser import TIMESTAMP_FORMAT
+
+USERNAME = 'benchmark'
+PASSWORD = 'hunter2'
+COOKIE = 'phpbb3_ttc_sid'
+
+WORDS = ('the a of and to in is for on with that this it tire data test run '
+         'round file slip angle camber pressure load cornering stiffness rim '
+         'width lateral force coefficient pacejka fit model hoosier goodyear '
+         'avon compound temperature matlab csv sweep inclination spring rate').split()
+
+ForumInfo = namedtuple('ForumInfo', 'id name parent children topics')
+TopicInfo = namedtuple('TopicInfo', 'id forum title posts first_post')
+
+PAGE = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" dir="ltr" lang="en-gb" xml:lang="en-gb">
+<head>
+<meta http-equiv="content-type" content="text/html; charset=UTF-8" />
+<title>TTC Forum &bull; {title}</title>
+</head>
+<body id="phpbb" class="section-{section} ltr">
+<div id="wrap">
+	<div id="page-body">
+<h2>{title}</h2>
+{body}
+	</div>
+</div>
+</body>
+</html>
+'''
+
+LOGIN = '''<p><a href="./ucp.php?mode=register&amp;sid={sid}">All Users Must Register</a></p>
+<form action="./ucp.php?mode=login&amp;sid={sid}" method="post" id="login">
+	<fieldset class="fields1">
+		<dl><dt><label for="username">Username:</label></dt>
+			<dd><input type="text" tabindex="1" name="username" id="username" size="25" value="" class="inputbox autowidth" /></dd></dl>
+		<dl><dt><label for="password">Password:</label></dt>
+			<dd><input type="password" tabindex="2" id="password" name="password" size="25" class="inputbox autowidth" /></dd>
+			<dd><label for="autologin"><input type="checkbox" name="autologin" id="autologin" tabindex="4" /> Log me on automatically each visit</label></dd></dl>
+		<input type="hidden" name="redirect" value="./index.php" />
+		<input type="hidden" name="sid" value="{sid}" />
+		<dl><dt>&nbsp;</dt><dd><input type="submit" name="login" tabindex="6" value="Login" class="button1" /></dd></dl>
+	</fieldset>
+</form>
+'''
+
+FORUM_ROW = '''		<li class="row">
+			<dl class="icon">
+				<dt title="No unread posts"><a href="./viewforum.php?f={id}&amp;sid={sid}" class="forumtitle">{name}</a><br />Data and discussion for {name}</dt>
+				<dd class="topics">{topics} <dfn>Topics</dfn></dd>
+				<dd class="posts">{posts} <dfn>Posts</dfn></dd>
+				<dd class="lastpost"><span><dfn>Last post</dfn> by <a href="./memberlist.php?mode=viewprofile&amp;u={user}">user{user}</a>
+					<a href="./viewtopic.php?f={id}&amp;p={last}#p{last}"><img src="./styles/prosilver/imageset/icon_topic_latest.gif" width="11" height="9" alt="View the latest post" title="View the latest post" /></a> <br />on {created}</span>
+				</dd>
+			</dl>
+		</li>
+'''
+
+TOPIC_ROW = '''		<li class="row bg{bg}">
+			<dl class="icon">
+				<dt title="No unread posts"><a href="./viewtopic.php?t={id}&amp;f={forum}&amp;sid={sid}" class="topictitle">{title}</a><br />
+				by <a href="./memberlist.php?mode=viewprofile&amp;u={user}&amp;sid={sid}">user{user}</a> &raquo; {started}
+				</dt>
+				<dd class="posts">{replies} <dfn>Replies</dfn></dd>
+				<dd class="views">{views} <dfn>Views</dfn></dd>
+				<dd class="lastpost"><span><dfn>Last post </dfn>by <a href="./memberlist.php?mode=viewprofile&amp;u={last_user}&amp;sid={sid}">user{last_user}</a>
+					<a href="./viewtopic.php?f={forum}&amp;t={id}&amp;p={last}&amp;sid={sid}#p{last}"><img src="./styles/prosilver/imageset/icon_topic_latest.gif" width="11" height="9" alt="View the latest post" title="View the latest post" /></a> <br />on {updated}</span>
+				</dd>
+			</dl>
+		</li>
+'''
+
+POST = '''	<div id="p{id}" class="post bg{bg}">
+		<div class="inner"><span class="corners-top"><span></span></span>
+
+		<div class="postbody">
+			<h3><a href="#p{id}">Re: {title}</a></h3>
+			<p class="author"><a href="./viewtopic.php?p={id}&amp;sid={sid}#p{id}"><img src="./styles/prosilver/imageset/icon_post_target.gif" width="11" height="9" alt="Post" title="Post" /></a>by <strong><a href="./memberlist.php?mode=viewprofile&amp;u={user}&amp;sid={sid}">user{user}</a></strong> &raquo; {created} </p>
+
+			<div class="content">{content}</div>
+{attachbox}
+			<div id="sig{id}" class="signature">FSAE Team Suspension Lead</div>
+		</div>
+
+		<dl class="postprofile" id="profile{id}">
+			<dt><a href="./memberlist.php?mode=viewprofile&amp;u={user}">user{user}</a></dt>
+		</dl>
+
+		<span class="corners-bottom"><span></span></span></div>
+	</div>
+
+	<hr class="divider" />
+'''
+
+ATTACHMENT = '''					<dl class="file">
+						<dt><img src="./styles/prosilver/imageset/icon_topic_attach.gif" width="7" height="10" alt="" title="" /> <a class="postlink" href="./download/file.php?id={id}">Round{round}_Run{id}.dat</a></dt>
+						<dd>(48.31 MiB) Downloaded 112 times</dd>
+					</dl>
+'''
+
+
+class Site:
+    """
+    The board's structure: ``forums`` top level forums with ``subforums``
+    each, sharing topics of ``posts_per_topic`` posts on average between
+    them until there are ``posts`` posts in total.
+    """
+    topics_per_page = 25
+    posts_per_page = 10
+    start = datetime(2010, 1, 1)
+
+    def __init__(self, posts=1000, forums=4, subforums=2, posts_per_topic=15,
+            images=0.1, attachments=0.1, attachment_size=4096, seed=0):
+        self.images = images
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.seed = seed
+        rng = random.Random(seed)
+
+        self.forums = {}
+        ids = itertools.count(1)
+        for i in range(forums):
+            parent = self._add_forum(next(ids), 'Round {}'.format(i + 1), None)
+            for j in range(subforums):
+                child = self._add_forum(next(ids), 'Round {} Run {}'.format(i + 1, j + 1), parent.id)
+                parent.children.append(child.id)
+
+        self.topics = {}
+        self.post_count = 0
+        self.add_topics(posts, list(self.forums), posts_per_topic, rng)
+        self.sessions = set()
+        #: Topics which always fail with a 500
+        self.broken = set()
+
+    def add_topics(self, posts, forum_ids, posts_per_topic=15, rng=None):
+        """
+        Start new topics in ``forum_ids`` (taking turns) until there are
+        ``posts`` more posts, as if people had carried on posting.
+        """
+        rng = rng or random.Random(self.seed + self.post_count)
+        target = self.post_count + posts
+
+        while self.post_count < target:
+            count = min(rng.randint(1, 2 * posts_per_topic - 1), target - self.post_count)
+            forum = self.forums[forum_ids[len(self.topics) % len(forum_ids)]]
+            topic = TopicInfo(len(self.topics) + 1, forum.id,
+                    '{} data question {}'.format(forum.name, len(self.topics) + 1),
+                    count, self.post_count + 1)
+
+            self.topics[topic.id] = topic
+            forum.topics.append(topic.id)
+            self.post_count += count
+
+    def add_replies(self, count):
+        """
+        Reply to the newest topic ``count`` times. Posts are numbered topic
+        by topic, so it's the only one which can grow.
+        """
+        topic = self.topics[len(self.topics)]
+        self.topics[topic.id] = topic._replace(posts=topic.posts + count)
+        self.post_count += count
+        return topic
+
+    def _add_forum(self, id, name, parent):
+        forum = ForumInfo(id, name, parent, [], [])
+        self.forums[id] = forum
+        return forum
+
+    @property
+    def page_count(self):
+        """
+        How many listing and topic pages there are to crawl (plus the index).
+        """
+        def pages(items, per_page):
+            return max(1, -(-items // per_page))
+
+        return 1 + sum(pages(len(f.topics), self.topics_per_page) for f in self.forums.values()) + \
+                sum(pages(t.posts, self.posts_per_page) for t in self.topics.values())
+
+    def created(self, post_id):
+        return self.start + timedelta(minutes=37 * post_id)
+
+    def timestamp(self, post_id):
+        return self.created(post_id).strftime(TIMESTAMP_FORMAT)
+
+    def login(self, username, password):
+        if (username, password) != (USERNAME, PASSWORD):
+            return None
+        sid = os.urandom(16).hex()
+        self.sessions.add(sid)
+        return sid
+
+    def pagination(self, link, items, per_page, start, sid):
+        """
+        phpBB's paginator: the first, last and neighbouring pages, with
+        ellipses in between.
+        """
+        pages = max(1, -(-items // per_page))
+        current = start // per_page + 1
+        shown = sorted({p for p in (1, 2, 3, current - 1, current, current + 1,
+                                    pages - 2, pages - 1, pages) if 1 <= p <= pages})
+
+        links = []
+        previous = 0
+        for page in shown:
+            if page - previous > 1:
+                links.append(' ... ')
+            elif links:
+                links.append('<span class="page-sep">, </span>')
+
+            if page == current:
+                links.append('<strong>{}</strong>'.format(page))
+            else:
+                start_param = '&amp;start={}'.format((page - 1) * per_page) if page > 1 else ''
+                links.append('<a href="{}&amp;sid={}{}">{}</a>'.format(link, sid, start_param, page))
+            previous = page
+
+        return ('<div class="topic-actions"><div class="pagination">{} items &bull; '
+                '<a href="#" onclick="jumpto(); return false;">Page <strong>{}</strong> '
+                'of <strong>{}</strong></a> &bull; <span>{}</span></div></div>\n').format(
+                items, current, pages, ''.join(links))
+
+    def subtree_topics(self, forum_id):
+        forum = self.forums[forum_id]
+        topics = [self.topics[t] for t in forum.topics]
+        for child in forum.children:
+            topics += self.subtree_topics(child)
+        return topics
+
+    def forum_rows(self, forum_ids, sid):
+        # Like phpBB, each row counts the forum's sub-forums too
+        if not forum_ids:
+            return ''
+
+        rows = []
+        for forum_id in forum_ids:
+            forum = self.forums[forum_id]
+            topics = self.subtree_topics(forum_id)
+            last = max((t.first_post + t.posts - 1 for t in topics), default=1)
+            rows.append(FORUM_ROW.format(id=forum.id, name=escape(forum.name), sid=sid,
+                    topics=len(topics), posts=sum(t.posts for t in topics),
+                    user=last % 300, last=last, created=self.timestamp(last)))
+
+        return ('<div class="forabg"><div class="inner"><ul class="topiclist forums">\n'
+                '{}\t</ul></div></div>\n').format(''.join(rows))
+
+    def index(self, sid, logged_in):
+        top_level = [f.id for f in self.forums.values() if f.parent is None]
+        body = self.forum_rows(top_level, sid)
+        if not logged_in:
+            body += LOGIN.format(sid=sid)
+        return PAGE.format(title='Index page', section='index', body=body)
+
+    def viewforum(self, forum_id, start, sid):
+        forum = self.forums[forum_id]
+        link = './viewforum.php?f={}'.format(forum.id)
+        pagination = self.pagination(link, len(forum.topics), self.topics_per_page, start, sid)
+
+        # The most recently active topics come first
+        newest_first = forum.topics[::-1]
+        rows = []
+        for i, topic_id in enumerate(newest_first[start:start + self.topics_per_page]):
+            topic = self.topics[topic_id]
+            last = topic.first_post + topic.posts - 1
+            rows.append(TOPIC_ROW.format(bg=i % 2 + 1, id=topic.id, forum=forum.id, sid=sid,
+                    title=escape(topic.title), user=topic.first_post % 300,
+                    started=self.timestamp(topic.first_post),
+                    replies=topic.posts - 1, views=topic.posts * 7, last_user=last % 300,
+                    last=last, updated=self.timestamp(last)))
+
+        body = self.forum_rows(forum.children, sid) + pagination + \
+                '<div class="forumbg"><div class="inner"><ul class="topiclist topics">\n' + \
+                ''.join(rows) + '\t</ul></div></div>\n' + pagination
+        return PAGE.format(title='View forum - ' + escape(forum.name), section='viewforum',
+                body=body)
+
+    def content(self, post_id, rng):
+        words = rng.choices(WORDS, k=rng.randint(20, 120))
+        content = 'Has anyone run the <a href="./viewtopic.php?t={}" class="postlink">' \
+                'cornering data</a> through the fitting scripts yet? {}'.format(
+                rng.randrange(1, len(self.topics) + 1), ' '.join(words))
+
+        if rng.random() < self.images:
+            content += '<br /><img src="./download/file.php?id={}&amp;mode=view" ' \
+                    'alt="Fz vs SA plot" /><br />'.format(post_id)
+        return content
+
+    def attachbox(self, post_id, rng):
+        if rng.random() >= self.attachments:
+            return ''
+        files = ''.join(ATTACHMENT.format(id=post_id * 10 + i, round=rng.randint(1, 9))
+                        for i in range(rng.randint(1, 2)))
+        return ('\t\t\t<dl class="attachbox">\n\t\t\t\t<dt>Attachments</dt>\n'
+                '\t\t\t\t<dd>\n{}\t\t\t\t</dd>\n\t\t\t</dl>\n').format(files)
+
+    def viewtopic(self, topic_id, start, sid):
+        topic = self.topics[topic_id]
+        link = './viewtopic.php?f={}&amp;t={}'.format(topic.forum, topic.id)
+        pagination = self.pagination(link, topic.posts, self.posts_per_page, start, sid)
+
+        posts = []
+        first = topic.first_post + start
+        last = min(first + self.posts_per_page, topic.first_post + topic.posts)
+        for i, post_id in enumerate(range(first, last)):
+            rng = random.Random(self.seed * 1000003 + post_id)
+            posts.append(POST.format(id=post_id, bg=i % 2 + 1, sid=sid,
+                    title=escape(topic.title), user=post_id % 300,
+                    created=self.timestamp(post_id),
+                    content=self.content(post_id, rng),
+                    attachbox=self.attachbox(post_id, rng)))
+
+        body = pagination + ''.join(posts) + pagination
+        return PAGE.format(title='View topic - ' + escape(topic.title), section='viewtopic',
+                body=body)
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    site = None
+    latency = 0.0
+    requests = 0
+    #: Requests for each script (``index.php``, ``viewforum.php``, ...)
+    scripts = Counter()
+    _lock = threading.Lock()
+
+    def _session(self):
+        for cookie in self.headers.get_all('Cookie') or ():
+            for part in cookie.split(';'):
+                name, _, value = part.strip().partition('=')
+                if name == COOKIE and value in self.site.sessions:
+                    return value
+
+    def _send(self, code, body=b'', content_type='text/html; charset=UTF-8', headers=()):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlsplit(self.path)
+        script = url.path.rsplit('/', 1)[-1] or 'index.php'
+
+        with self._lock:
+            type(self).requests += 1
+            self.scripts[script] += 1
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        sid = self._session()
+        start = int(params.get('start', 0))
+
+        if script == 'index.php' or sid is None:
+            # Guests only ever get the login form
+            return self._send(200, self.site.index(sid or '0' * 32, sid is not None))
+
+        try:
+            if script == 'viewforum.php':
+                return self._send(200, self.site.viewforum(int(params['f']), start, sid))
+            elif script == 'viewtopic.php':
+                if int(params['t']) in self.site.broken:
+                    return self._send(500, 'Internal server error')
+                return self._send(200, self.site.viewtopic(int(params['t']), start, sid))
+            elif script == 'file.php':
+                return self._send(200, os.urandom(self.site.attachment_size),
+                        content_type='application/octet-stream')
+        except (KeyError, ValueError):
+            pass
+
+        self._send(404, 'Not found')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        fields = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        sid = self.site.login(fields.get('username'), fields.get('password'))
+
+        headers = [('Location', './index.php')]
+        if sid is not None:
+            headers.append(('Set-Cookie', '{}={}; path=/; HttpOnly'.format(COOKIE, sid)))
+        self._send(302, headers=headers)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(site, port=0, latency=0.0):
+    """
+    Serve ``site`` from a background thread, returning the server and the
+    board's URL.
+    """
+    handler = type('Handler', (SiteHandler,),
+            {'site': site, 'latency': latency, 'requests': 0, 'scripts': Counter(),
+             '_lock': threading.Lock()})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # aiohttp won't keep cookies set by a bare IP address
+    return server, 'http://localhost:{}/'.format(server.server_port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--posts', type=int, default=1000)
+    parser.add_argument('--forums', type=int, default=4)
+    parser.add_argument('--subforums', type=int, default=2)
+    parser.add_argument('--posts-per-topic', type=int, default=15)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='How long the server takes to respond')
+    args = parser.parse_args()
+
+    site = Site(args.posts, forums=args.forums, subforums=args.subforums,
+            posts_per_topic=args.posts_per_topic, seed=args.seed)
+    server, url = serve(site, args.port, args.latency)
+
+    print('Serving {} posts in {} topics ({} pages) at {}'.format(site.post_count,
+        len(site.topics), site.page_count, url))
+    print('Log in as {} / {}'.format(USERNAME, PASSWORD))
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+# The synthetic board the benchmarks crawl
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+from phpbb_site import Site, serve, USERNAME, PASSWORD
+
+
+@pytest.fixture
+def site():
+    return Site(300, forums=2, subforums=1, seed=1)
+
+
+@pytest.fixture
+def server(site):
+    server, server.url = serve(site)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def board(server):
+    return server.url
+
+
+@pytest.fixture
+def crawl(board, tmp_path):
+    """
+    Crawl the board into the same database every time it's called, returning
+    the spider. Keyword arguments are set on the spider before it starts.
+    """
+    database = str(tmp_path / 'records.sqlite')
+
+    def crawl(engine='grab', **options):
+        if engine == 'asyncio':
+            from ttc_scraper.aio import AsyncForumSpider as spider_class
+        else:
+            from ttc_scraper.spider import ForumSpider as spider_class
+
+        spidey = spider_class(thread_number=4)
+        spidey.initial_urls = [board]
+        spidey.database_location = database
+        spidey.log_file = str(tmp_path / 'crawler.log')
+        spidey.username = USERNAME
+        spidey.password = PASSWORD
+        # Give up on broken pages quickly
+        spidey.network_try_limit = spidey.task_try_limit = 2
+        for name, value in options.items():
+            setattr(spidey, name, value)
+
+        spidey.run()
+        return spidey
+
+    crawl.database = database
+    return crawl
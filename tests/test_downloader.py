@@ -0,0 +1,116 @@
+import os
+import hashlib
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from ttc_scraper.downloader import AttachmentDownloader
+from ttc_scraper.migrations import upgrade
+from ttc_scraper.models import Attachment
+from ttc_scraper.writer import BatchWriter
+
+DATA = b'slip angle,lateral force\n' * 1000
+
+LOGIN_PAGE = b'''<html><body>
+<form action="./ucp.php?mode=login" method="post" id="login">
+    <input type="text" name="username" />
+    <input type="password" name="password" />
+    <input type="hidden" name="sid" value="0123" />
+    <input type="submit" name="login" value="Login" />
+</form>
+</body></html>'''
+
+
+class Board(BaseHTTPRequestHandler):
+    """
+    Just enough of phpBB to hand out attachments to people who've logged
+    in, and its login page to everybody else.
+    """
+
+    def send(self, body, content_type='text/html; charset=UTF-8', headers=()):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if 'sid=session' in (self.headers.get('Cookie') or ''):
+            self.send(DATA, 'application/octet-stream')
+        else:
+            self.send(LOGIN_PAGE)
+
+    def do_POST(self):
+        fields = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        if fields['password'] == ['hunter2'] and fields['login'] == ['Login']:
+            self.send(b'<html>Welcome back</html>', headers=[('Set-Cookie', 'sid=session; path=/')])
+        else:
+            self.send(LOGIN_PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def board():
+    server = HTTPServer(('127.0.0.1', 0), Board)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/'.format(server.server_port)
+    server.shutdown()
+
+
+@pytest.fixture
+def engine(tmp_path, board):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'records.sqlite'))
+    upgrade(engine)
+
+    session = Session(bind=engine)
+    for i in range(3):
+        session.add(Attachment(name='run{}.dat'.format(i),
+                link='{}download/file.php?id={}'.format(board, i)))
+    session.commit()
+    return engine
+
+
+def download(engine, directory, **kwargs):
+    writer = BatchWriter(engine)
+    downloader = AttachmentDownloader(engine, writer, str(directory), **kwargs)
+    result = downloader.run()
+    writer.close()
+    return result, downloader
+
+
+def test_login_page_leaves_attachments_pending(engine, tmp_path):
+    (downloaded, failed), downloader = download(engine, tmp_path / 'files')
+
+    assert (downloaded, failed) == (0, 3)
+    assert len(downloader.pending()) == 3
+    assert os.listdir(str(tmp_path / 'files')) == ['partial']
+
+
+def test_logs_in_again_when_the_session_has_expired(engine, tmp_path):
+    (downloaded, failed), downloader = download(engine, tmp_path / 'files',
+            username='alice', password='hunter2')
+
+    assert (downloaded, failed) == (3, 0)
+    assert downloader.logins == 1
+    assert downloader.pending() == {}
+
+    sha256 = hashlib.sha256(DATA).hexdigest()
+    with open(downloader.path_for(sha256), 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_failed_login_leaves_attachments_pending(engine, tmp_path):
+    (downloaded, failed), downloader = download(engine, tmp_path / 'files',
+            username='alice', password='wrong')
+
+    assert (downloaded, failed) == (0, 3)
+    assert downloader.login_failed
+    assert len(downloader.pending()) == 3
@@ -0,0 +1,208 @@
+import os
+from queue import Empty
+from datetime import datetime
+
+import pytest
+from grab.spider import Task
+from sqlalchemy import create_engine
+
+from ttc_scraper.frontier import (BloomFilter, SeenUrls, Checkpoint, Frontier,
+        start_crawl, finish_crawl)
+from ttc_scraper.migrations import upgrade
+from ttc_scraper.writer import BatchWriter
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'records.sqlite'))
+    upgrade(engine)
+    return engine
+
+
+@pytest.fixture
+def writer(engine):
+    writer = BatchWriter(engine)
+    yield writer
+    writer.close()
+
+
+def test_checkpoint_resumes_unfinished_tasks(engine, writer):
+    crawl_id = start_crawl(engine)
+    checkpoint = Checkpoint(engine, writer, crawl_id)
+
+    tasks = [Task('forum', url='http://localhost/viewforum.php?f=1', title='Round 5'),
+             Task('thread', url='http://localhost/viewtopic.php?t=1', forum_id=1,
+                  replies=14, last_post=datetime(2015, 3, 1, 14, 5)),
+             Task('thread', url='http://localhost/viewtopic.php?t=2', forum_id=1),
+             Task('thread', url='http://localhost/viewtopic.php?t=3', forum_id=1)]
+    for task in tasks:
+        checkpoint.queued(task)
+
+    checkpoint.started(tasks[0])
+    checkpoint.done(tasks[0])
+    checkpoint.started(tasks[1])
+    checkpoint.started(tasks[3])
+    checkpoint.failed(tasks[3])
+    writer.flush()
+
+    pending = list(checkpoint.pending())
+    assert [(name, url) for name, url, _ in pending] == \
+            [(task.name, task.url) for task in tasks[1:]]
+
+    # Everything needed to recreate the task comes back
+    name, url, params = pending[0]
+    assert params == dict(forum_id=1, replies=14, last_post=datetime(2015, 3, 1, 14, 5),
+            checkpoint_id=tasks[1].checkpoint_id)
+
+
+def test_only_new_tasks_are_checkpointed(engine, writer):
+    checkpoint = Checkpoint(engine, writer, start_crawl(engine))
+
+    task = Task('thread', url='http://localhost/viewtopic.php?t=1')
+    checkpoint.queued(task)
+    checkpoint_id = task.checkpoint_id
+
+    # A retry (or a resumed task) keeps its row
+    checkpoint.queued(task.clone())
+    checkpoint.queued(Task('initial', url='http://localhost/'))
+    writer.flush()
+
+    assert [params['checkpoint_id'] for _, _, params in checkpoint.pending()] == [checkpoint_id]
+
+
+def test_crawl_finishes_once_nothing_is_left(engine, writer):
+    crawl_id = start_crawl(engine)
+    checkpoint = Checkpoint(engine, writer, crawl_id)
+    task = Task('thread', url='http://localhost/viewtopic.php?t=1')
+    checkpoint.queued(task)
+    writer.flush()
+
+    assert not finish_crawl(engine, crawl_id)
+    # So resuming carries on with the same crawl
+    assert start_crawl(engine, resume=True) == crawl_id
+
+    checkpoint.done(task)
+    writer.flush()
+    assert finish_crawl(engine, crawl_id)
+    assert start_crawl(engine, resume=True) != crawl_id
+
+
+def test_crawls_which_queue_nothing_never_finish(engine):
+    crawl_id = start_crawl(engine)
+    assert not finish_crawl(engine, crawl_id)
+
+
+@pytest.mark.parametrize('bloom_capacity', [None, 1000])
+def test_seen_urls(engine, writer, bloom_capacity):
+    seen = SeenUrls(engine, writer, bloom_capacity=bloom_capacity)
+
+    assert seen.add('http://localhost/viewtopic.php?t=1')
+    assert not seen.add('http://localhost/viewtopic.php?t=1')
+    assert 'http://localhost/viewtopic.php?t=1' in seen
+    assert 'http://localhost/viewtopic.php?t=2' not in seen
+
+    # Still there once it's been written, and after starting again
+    writer.flush()
+    assert 'http://localhost/viewtopic.php?t=1' in seen
+
+    seen = SeenUrls(engine, writer, bloom_capacity=bloom_capacity)
+    assert seen.load() == 1
+    assert 'http://localhost/viewtopic.php?t=1' in seen
+    assert 'http://localhost/viewtopic.php?t=2' not in seen
+
+
+def test_seen_urls_never_miss_with_a_full_bloom_filter(engine, writer):
+    # Far more urls than it was sized for, so plenty of false "maybe"s
+    seen = SeenUrls(engine, writer, bloom_capacity=10)
+    links = ['http://localhost/viewtopic.php?t={}'.format(i) for i in range(500)]
+
+    for i, link in enumerate(links[:250]):
+        seen.add(link)
+        if i % 100 == 0:
+            writer.flush()
+
+    assert all(link in seen for link in links[:250])
+    assert not any(link in seen for link in links[250:])
+
+
+def test_bloom_filter_error_rate():
+    bloom = BloomFilter(10000, error_rate=0.01)
+    for i in range(10000):
+        bloom.add('http://localhost/viewtopic.php?t={}'.format(i))
+
+    assert all('http://localhost/viewtopic.php?t={}'.format(i) in bloom for i in range(10000))
+    false_positives = sum('http://localhost/viewforum.php?f={}'.format(i) in bloom
+                          for i in range(10000))
+    assert false_positives < 200
+
+
+def drain(frontier):
+    tasks = []
+    while True:
+        try:
+            tasks.append(frontier.get())
+        except Empty:
+            return tasks
+
+
+def drain_some(frontier, count):
+    return [frontier.get() for _ in range(count)]
+
+
+def test_frontier_hands_out_the_most_urgent_task_first():
+    frontier = Frontier()
+    for i, priority in enumerate([30, 10, 20, 10, None, 20]):
+        frontier.put(i, priority)
+
+    # Equally urgent tasks come out first in, first out
+    assert drain(frontier) == [1, 3, 2, 5, 0, 4]
+
+
+def test_frontier_spills_to_disk_without_changing_the_order(tmp_path):
+    location = str(tmp_path / 'frontier.sqlite')
+    frontier = Frontier(max_size=10, location=location)
+    priorities = [(i * 7) % 5 for i in range(100)]
+
+    for i, priority in enumerate(priorities):
+        frontier.put(i, priority)
+        if i == 50:
+            # Some handed out part way through
+            taken = drain_some(frontier, 5)
+
+    def in_order(tasks):
+        return [i for _, i in sorted((priorities[i], i) for i in tasks)]
+
+    assert frontier.spill_count > 0
+    assert frontier.size() == 95
+    assert taken == in_order(range(51))[:5]
+    assert drain(frontier) == [i for i in in_order(range(100)) if i not in taken]
+
+    # Only temporary files are removed
+    frontier.close()
+    assert os.path.exists(location)
+
+
+def test_frontier_waits_until_ready():
+    ready = False
+    frontier = Frontier(ready=lambda: ready)
+    frontier.put('thread')
+
+    with pytest.raises(Empty):
+        frontier.get()
+
+    ready = True
+    assert frontier.get() == 'thread'
+
+
+def test_frontier_removes_its_temporary_file():
+    frontier = Frontier(max_size=2)
+    for i in range(10):
+        frontier.put(i)
+    location = frontier._location
+
+    frontier.clear()
+    assert frontier.size() == 0
+    assert drain(frontier) == []
+
+    frontier.close()
+    assert not os.path.exists(location)
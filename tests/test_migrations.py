@@ -0,0 +1,115 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from ttc_scraper.migrations import upgrade
+from ttc_scraper.models import Post, Attachment
+from ttc_scraper.search import search
+
+
+#: The schema databases were created with before any migrations existed
+BASELINE_SCHEMA = """
+CREATE TABLE forums (
+    id INTEGER NOT NULL,
+    name VARCHAR(64),
+    link VARCHAR(128),
+    parent_id INTEGER,
+    PRIMARY KEY (id),
+    FOREIGN KEY(parent_id) REFERENCES forums (id)
+);
+CREATE UNIQUE INDEX ix_forums_link ON forums (link);
+CREATE UNIQUE INDEX ix_forums_name ON forums (name);
+CREATE TABLE _urls (
+    id INTEGER NOT NULL,
+    link VARCHAR(128),
+    PRIMARY KEY (id)
+);
+CREATE UNIQUE INDEX ix__urls_link ON _urls (link);
+CREATE TABLE threads (
+    id INTEGER NOT NULL,
+    name VARCHAR(64),
+    link VARCHAR(128),
+    forum_id INTEGER,
+    PRIMARY KEY (id),
+    FOREIGN KEY(forum_id) REFERENCES forums (id)
+);
+CREATE UNIQUE INDEX ix_threads_link ON threads (link);
+CREATE INDEX ix_threads_name ON threads (name);
+CREATE TABLE posts (
+    id INTEGER NOT NULL,
+    author VARCHAR(20),
+    created DATETIME,
+    html TEXT,
+    text TEXT,
+    thread_id INTEGER,
+    PRIMARY KEY (id),
+    FOREIGN KEY(thread_id) REFERENCES threads (id)
+);
+CREATE TABLE attachments (
+    id INTEGER NOT NULL,
+    link VARCHAR(128),
+    name VARCHAR(64),
+    post_id INTEGER,
+    PRIMARY KEY (id),
+    FOREIGN KEY(post_id) REFERENCES posts (id)
+);
+CREATE INDEX ix_attachments_link ON attachments (link);
+CREATE INDEX ix_attachments_name ON attachments (name);
+
+INSERT INTO forums (id, name, link) VALUES
+    (1, 'Round 5', 'http://localhost/viewforum.php?f=1');
+INSERT INTO threads (id, name, link, forum_id) VALUES
+    (1, 'Slip angle sweeps', 'http://localhost/viewtopic.php?t=1', 1);
+INSERT INTO posts (id, author, created, html, text, thread_id) VALUES
+    (1, 'alice', '2015-01-01 00:00:00.000000', '<p>Hoosier data</p>', 'Hoosier data', 1),
+    (2, 'bob', '2015-01-02 00:00:00.000000', '<p>Thanks</p>', 'Thanks', 1);
+INSERT INTO attachments (id, link, name, post_id) VALUES
+    (1, 'http://localhost/download/file.php?id=1', 'run1.dat', 1),
+    (2, 'http://localhost/download/file.php?id=1', 'run1.dat', 1);
+"""
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    location = str(tmp_path / 'records.sqlite')
+    conn = sqlite3.connect(location)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.close()
+    return create_engine('sqlite:///{}'.format(location))
+
+
+def test_upgrade_baseline_database(baseline):
+    changes = upgrade(baseline)
+
+    assert 'added column posts.author_id' in changes
+    assert 'indexed 2 posts for search' in changes
+    assert 'removed 1 duplicate attachments' in changes
+
+    session = Session(bind=baseline)
+    assert session.query(Post).count() == 2
+    assert session.query(Attachment).count() == 1
+
+
+def test_upgraded_database_is_searchable(baseline):
+    upgrade(baseline)
+
+    hits = search(baseline, 'hoosier')
+    assert [(hit.post_id, hit.author, hit.thread) for hit in hits] == \
+            [(1, 'alice', 'Slip angle sweeps')]
+
+
+def test_upgrade_twice_changes_nothing(baseline):
+    upgrade(baseline)
+    assert upgrade(baseline) == []
+
+
+def test_new_posts_are_indexed_after_upgrade(baseline):
+    upgrade(baseline)
+
+    with baseline.begin() as conn:
+        conn.execute(Post.__table__.insert(), id=3, author='carol',
+                text='Cornering stiffness', thread_id=1)
+
+    assert [hit.post_id for hit in search(baseline, 'cornering')] == [3]
@@ -0,0 +1,88 @@
+import os
+from datetime import datetime
+
+import lxml.html
+import pytest
+
+from ttc_scraper.parser import parse_page, parse_forum
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'fixtures')
+URL = 'http://sae.wsu.edu/ttc/'
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture(scope='module')
+def thread():
+    return parse_page(URL + 'viewtopic.php?f=12&t=345', fixture('viewtopic.html'))
+
+
+@pytest.fixture(scope='module')
+def forum():
+    return parse_forum(lxml.html.fromstring(fixture('viewforum.html')),
+            URL + 'viewforum.php?f=12')
+
+
+def test_thread_posts(thread):
+    assert [post.phpbb_id for post in thread.posts] == list(range(1001, 1011))
+
+    first = thread.posts[0]
+    assert first.author == 'user41'
+    assert first.created == datetime(2015, 3, 1, 14, 5)
+
+
+def test_post_links_are_absolute(thread):
+    first = thread.posts[0]
+
+    assert 'href="http://sae.wsu.edu/ttc/viewtopic.php?f=12&amp;t=345"' in first.html
+    assert '[cornering\ndata](http://sae.wsu.edu/ttc/viewtopic.php?f=12&t=345)' in first.text
+    assert '> someone wrote:Check the SA sign convention' in first.text
+
+
+def test_images_and_attachments(thread):
+    images = {post.phpbb_id: post.images for post in thread.posts if post.images}
+    attachments = {post.phpbb_id: post.attachments for post in thread.posts if post.attachments}
+
+    assert images == {
+        1004: [('Fz vs SA plot', URL + 'download/file.php?id=704&mode=view')],
+        1008: [('Fz vs SA plot', URL + 'download/file.php?id=708&mode=view')],
+    }
+    assert attachments == {
+        1003: [('Round3_Run03.dat', URL + 'download/file.php?id=503')],
+        1006: [('Round6_Run06.dat', URL + 'download/file.php?id=506')],
+        1009: [('Round9_Run09.dat', URL + 'download/file.php?id=509')],
+    }
+
+
+def test_thread_pagination(thread):
+    # Both paginators (above and below the posts) are picked up
+    assert [label for _, label in thread.pages] == ['2', '3', '2', '3']
+    assert thread.pages[0][0] == \
+            './viewtopic.php?f=12&t=345&sid=0123456789abcdef0123456789abcdef&start=10'
+
+
+def test_subforums(forum):
+    assert [(f.title, f.topics, f.posts, f.last_post, f.last_post_id) for f in forum.forums] == [
+        ('Round 5', 14, 96, datetime(2015, 3, 2, 13, 15), 1980),
+        ('Round 6', 9, 51, datetime(2015, 3, 3, 8, 40), 1995),
+    ]
+    assert forum.forums[0].link == \
+            URL + 'viewforum.php?f=31&sid=0123456789abcdef0123456789abcdef'
+
+
+def test_topics(forum):
+    assert len(forum.topics) == 20
+
+    first = forum.topics[0]
+    assert first.title == 'Round 1 cornering data question 340'
+    assert first.link == URL + 'viewtopic.php?t=340&f=12&sid=0123456789abcdef0123456789abcdef'
+    assert (first.replies, first.last_post) == (0, datetime(2015, 3, 1, 16, 0))
+
+    assert [topic.replies for topic in forum.topics[:4]] == [0, 3, 6, 9]
+
+
+def test_forum_pagination(forum):
+    assert [label for _, label in forum.pages] == ['2', '3', '2', '3']
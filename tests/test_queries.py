@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from ttc_scraper.migrations import upgrade
+from ttc_scraper.models import Forum, Thread, Post, Attachment
+from ttc_scraper import queries
+
+START = datetime(2015, 1, 1)
+
+
+@pytest.fixture
+def session(tmp_path):
+    """
+    A main forum with two sub-forums (one with a sub-forum of its own), two
+    threads in each and plenty of posts made at the same time, so pages
+    have to break ties by id.
+    """
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'records.sqlite'))
+    upgrade(engine)
+    session = Session(bind=engine)
+
+    main = Forum(id=1, name='Main', link='http://localhost/')
+    round5 = Forum(id=2, name='Round 5', link='http://localhost/viewforum.php?f=2', parent_id=1)
+    round6 = Forum(id=3, name='Round 6', link='http://localhost/viewforum.php?f=3', parent_id=1)
+    run1 = Forum(id=4, name='Round 5 Run 1', link='http://localhost/viewforum.php?f=4', parent_id=2)
+    session.add_all([main, round5, round6, run1])
+
+    post_id = 0
+    for forum in (round5, round6, run1):
+        for i in range(2):
+            thread = Thread(name='{} thread {}'.format(forum.name, i),
+                    link='http://localhost/viewtopic.php?t={}{}'.format(forum.id, i),
+                    forum_id=forum.id)
+            session.add(thread)
+            session.flush()
+
+            for j in range(23):
+                post_id += 1
+                post = Post(id=post_id, author='user{}'.format(j % 4), thread_id=thread.id,
+                        created=START + timedelta(hours=j // 3), text='post {}'.format(post_id))
+                if j % 5 == 0:
+                    post.attachments.append(Attachment(name='run{}.dat'.format(post_id),
+                        link='http://localhost/download/file.php?id={}'.format(post_id)))
+                session.add(post)
+
+    session.commit()
+    return session
+
+
+def ordered(session, *criteria):
+    return [post.id for post in session.query(Post).filter(*criteria)
+            .order_by(Post.created, Post.id)]
+
+
+def test_iter_posts_since_walks_every_page(session):
+    since = START + timedelta(hours=2)
+    posts = [post.id for post in queries.iter_posts_since(session, since, page_size=7)]
+
+    assert posts == ordered(session, Post.created > since)
+
+
+def test_posts_since_pages_carry_on_from_the_cursor(session):
+    since = START
+    first = queries.posts_since(session, since, limit=10)
+    second = queries.posts_since(session, since, limit=10, after=first[-1])
+
+    expected = ordered(session, Post.created > since)
+    assert [post.id for post in first + second] == expected[:20]
+
+
+def test_latest_posts_stay_after_since(session):
+    since = START + timedelta(hours=5)
+    expected = list(reversed(ordered(session, Post.created > since)))
+
+    pages, before = [], None
+    while True:
+        page = queries.latest_posts(session, since, limit=4, before=before)
+        pages.extend(post.id for post in page)
+        if len(page) < 4:
+            break
+        before = page[-1]
+
+    assert pages == expected
+
+
+def test_latest_posts_without_since(session):
+    newest = queries.latest_posts(session, limit=5)
+    older = queries.latest_posts(session, limit=5, before=newest[-1])
+
+    expected = list(reversed(ordered(session)))
+    assert [post.id for post in newest + older] == expected[:10]
+
+
+def test_subforum_ids(session):
+    assert sorted(queries.subforum_ids(session, 1)) == [1, 2, 3, 4]
+    assert sorted(queries.subforum_ids(session, 2)) == [2, 4]
+    assert queries.subforum_ids(session, 3) == [3]
+
+
+def test_forum_tree_loads_threads(session):
+    forums = queries.forum_tree(session, 2)
+
+    assert [forum.id for forum in forums] == [2, 4]
+    assert all(len(forum.child_threads) == 2 for forum in forums)
+
+
+def test_iter_forum_posts_covers_the_subtree(session):
+    threads = [thread_id for (thread_id,) in session.query(Thread.id)
+               .filter(Thread.forum_id.in_([2, 4]))]
+    posts = list(queries.iter_forum_posts(session, 2, page_size=9))
+
+    assert [post.id for post in posts] == [post.id for post in session.query(Post)
+            .filter(Post.thread_id.in_(threads))
+            .order_by(Post.thread_id, Post.created, Post.id)]
+
+
+def test_pages_load_relationships_up_front(session):
+    page = queries.posts_since(session, START - timedelta(days=1), limit=50)
+    session.expunge_all()
+
+    # Nothing left to lazy load, so this works without the session
+    for post in page:
+        assert post.threads.forums.name
+        assert all(attachment.name for attachment in post.attachments)
+
+
+def test_thread_with_attachments(session):
+    thread = queries.thread_with_attachments(session, 1)
+
+    assert thread.forums.id == 2
+    assert [post.id for post in thread.posts] == ordered(session, Post.thread_id == 1)
+    assert sum(len(post.attachments) for post in thread.posts) == 5
+
+    assert queries.thread_with_attachments(session, 1000) is None
@@ -0,0 +1,166 @@
+import time
+import threading
+from urllib.request import urlopen
+from urllib.error import HTTPError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from ttc_scraper.ratecontrol import AdaptiveRateLimiter
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """
+    A server which answers with ``status`` after ``latency`` seconds, and
+    keeps track of how many requests it's had in flight at once.
+    """
+    latency = 0.0
+    status = 200
+
+    def do_GET(self):
+        cls = self.__class__
+        with cls.lock:
+            cls.in_flight += 1
+            cls.peak = max(cls.peak, cls.in_flight)
+            cls.started.append(time.monotonic())
+
+        try:
+            time.sleep(cls.latency)
+            self.send_response(cls.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    handler = type('Handler', (StandIn,), {'lock': threading.Lock(), 'in_flight': 0,
+            'peak': 0, 'started': []})
+    # Enough of a backlog that connections are never kept waiting to be
+    # accepted, which would look like the server slowing down
+    server = type('Server', (ThreadingHTTPServer,), {'request_queue_size': 64})(
+            ('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_port)
+    yield server
+    server.shutdown()
+
+
+def fetch(server, limiter, requests, workers=8):
+    """
+    Make ``requests`` requests from ``workers`` threads, each waiting for
+    the limiter first and telling it how things went.
+    """
+    remaining = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+
+            limiter.wait()
+            start = time.monotonic()
+            try:
+                with urlopen(server.url) as response:
+                    response.read()
+                limiter.record(time.monotonic() - start)
+            except HTTPError as e:
+                limiter.record(time.monotonic() - start, ok=e.code < 500)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_window_grows_while_the_server_keeps_up(server):
+    limiter = AdaptiveRateLimiter(6, latency_target=0.5)
+    fetch(server, limiter, 40)
+
+    assert limiter.window == 6
+    assert limiter.errors == 0
+    # Never more in flight than the window allowed
+    assert server.RequestHandlerClass.peak <= 6
+
+
+def test_window_shrinks_on_errors(server):
+    limiter = AdaptiveRateLimiter(8, latency_target=0.5)
+    fetch(server, limiter, 40)
+    assert limiter.window == 8
+
+    server.RequestHandlerClass.status = 503
+    fetch(server, limiter, 20)
+
+    assert limiter.window == 1
+    assert limiter.errors == 20
+
+
+def test_window_shrinks_when_the_server_slows_down(server):
+    limiter = AdaptiveRateLimiter(8, latency_target=0.05)
+    fetch(server, limiter, 40)
+    assert limiter.window == 8
+
+    server.RequestHandlerClass.latency = 0.1
+    fetch(server, limiter, 24)
+
+    assert limiter.window < 4
+    assert limiter.errors == 0
+
+
+def test_requests_per_second_ceiling(server):
+    limiter = AdaptiveRateLimiter(8, max_rps=50)
+    start = time.monotonic()
+    fetch(server, limiter, 30)
+    elapsed = time.monotonic() - start
+
+    started = server.RequestHandlerClass.started
+    assert elapsed >= 29 / 50
+    # Allowing for the time between being let through and the request
+    # reaching the server
+    assert (len(started) - 1) / (started[-1] - started[0]) <= 50 * 1.1
+
+
+def test_backs_off_once_per_round_trip():
+    limiter = AdaptiveRateLimiter(16, latency_target=10)
+    for _ in range(4):
+        limiter.record(1.0)
+    assert limiter.window == 5
+
+    # A burst of failures from the same window only halves it once
+    for _ in range(4):
+        limiter.record(1.0, ok=False)
+    assert limiter.window == 2.5
+    assert limiter.errors == 4
+
+    # After that the window grows linearly rather than doubling
+    limiter.record(1.0)
+    assert limiter.window == pytest.approx(2.9)
+
+
+def test_window_stays_within_bounds():
+    limiter = AdaptiveRateLimiter(4, min_concurrency=2)
+    for _ in range(10):
+        limiter.record(0.1)
+    assert limiter.window == 4
+
+    for _ in range(10):
+        limiter.record(ok=False)
+    assert limiter.window == 2
+
+
+def test_paced_requests_are_spread_over_the_latency():
+    limiter = AdaptiveRateLimiter(4, latency_target=1.0)
+    for _ in range(3):
+        limiter.record(0.2)
+
+    assert limiter.window == 4
+    assert limiter.interval(paced=True) == pytest.approx(0.2 / 4)
+    assert limiter.interval() == 0
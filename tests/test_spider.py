@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import create_engine, select, func
+
+from ttc_scraper.models import Crawl, CrawlTask, Post
+
+
+def crawls(database):
+    engine = create_engine('sqlite:///{}'.format(database))
+    with engine.connect() as conn:
+        return conn.execute(select([Crawl.__table__.c.finished])
+                .order_by(Crawl.__table__.c.id)).fetchall()
+
+
+@pytest.mark.parametrize('engine', ['grab', 'asyncio'])
+def test_failed_pages_dont_stop_crawls_finishing(engine, crawl, site):
+    site.broken.add(1)
+
+    crawl(engine)
+    second = crawl(engine, incremental=True)
+    third = crawl(engine, incremental=True)
+
+    assert all(finished is not None for (finished,) in crawls(crawl.database))
+    assert second.forums_skipped == third.forums_skipped > 0
+
+    # The broken topic is tried again every time
+    with create_engine('sqlite:///{}'.format(crawl.database)).connect() as conn:
+        states = conn.execute(select([CrawlTask.__table__.c.state, func.count()])
+                .group_by(CrawlTask.__table__.c.state)).fetchall()
+    assert dict(states)['failed'] == 1
+
+
+def count_posts(database):
+    with create_engine('sqlite:///{}'.format(database)).connect() as conn:
+        return conn.execute(select([func.count()]).select_from(Post.__table__)).scalar()
+
+
+def test_incremental_crawl_picks_up_new_replies(crawl, site, server):
+    scripts = server.RequestHandlerClass.scripts
+    crawl()
+
+    site.add_replies(12)
+    scripts.clear()
+    spidey = crawl(incremental=True)
+
+    assert count_posts(crawl.database) == site.post_count
+    # Only the forums on the way to the topic are read again, and only the
+    # topic's pages with new posts on them
+    assert spidey.forums_skipped > 0
+    assert scripts['viewforum.php'] < len(site.forums)
+    assert scripts['viewtopic.php'] <= 2
+
+
+def test_incremental_crawl_of_an_unchanged_board(crawl, site, server):
+    scripts = server.RequestHandlerClass.scripts
+    crawl()
+
+    scripts.clear()
+    spidey = crawl(incremental=True)
+
+    assert count_posts(crawl.database) == site.post_count
+    assert spidey.forums_skipped == len([f for f in site.forums.values() if f.parent is None])
+    assert scripts['viewforum.php'] == scripts['viewtopic.php'] == 0
+
+
+def test_resume_finishes_an_interrupted_crawl(crawl, site):
+    # Threads over the limit are left queued, as if the crawl had died
+    first = crawl(forum_limit=2)
+    assert first.deferred > 0
+    assert count_posts(crawl.database) < site.post_count
+    assert crawls(crawl.database) == [(None,)]
+
+    crawl(resume=True)
+
+    assert count_posts(crawl.database) == site.post_count
+    finished = crawls(crawl.database)
+    assert len(finished) == 1 and finished[0][0] is not None
@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import subprocess
+
+import pytest
+from sqlalchemy import create_engine
+
+from ttc_scraper.migrations import upgrade
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#: The most milliseconds a quick command may add to the interpreter's startup
+BUDGET = 100
+
+#: Libraries only crawling needs, which take long enough to import to matter
+HEAVY = ('grab', 'sqlalchemy', 'bs4')
+
+
+def python(arguments, **kwargs):
+    # So `-m ttc_scraper` works whatever the working directory is
+    path = os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')]))
+    return subprocess.run([sys.executable] + arguments, check=True,
+            stdout=subprocess.DEVNULL, env=dict(os.environ, PYTHONPATH=path),
+            **kwargs)
+
+
+def startup(arguments, repeat=5):
+    def run():
+        start = time.perf_counter()
+        python(arguments)
+        return time.perf_counter() - start
+
+    # The quickest run is the one least disturbed by whatever else the
+    # machine is doing (like the rest of the test suite)
+    return min(run() for _ in range(repeat))
+
+
+@pytest.fixture(scope='module')
+def database(tmp_path_factory):
+    location = str(tmp_path_factory.mktemp('startup') / 'records.sqlite')
+    upgrade(create_engine('sqlite:///{}'.format(location)))
+    return location
+
+
+@pytest.fixture(scope='module')
+def interpreter():
+    return startup(['-c', 'pass'])
+
+
+@pytest.fixture(params=[['--version'], ['--help'], ['stats']],
+                ids=lambda command: command[0])
+def command(request, database):
+    arguments = request.param
+    if arguments == ['stats']:
+        arguments = arguments + ['-d', database]
+    return ['-m', 'ttc_scraper'] + arguments
+
+
+def test_quick_commands_dont_import_heavy_libraries(command):
+    output = python(['-X', 'importtime'] + command,
+            stderr=subprocess.PIPE).stderr.decode()
+
+    imported = {line.rsplit('|', 1)[-1].strip().split('.')[0]
+                for line in output.splitlines() if line.startswith('import time:')}
+    assert not imported.intersection(HEAVY)
+
+
+def test_quick_commands_start_within_budget(command, interpreter):
+    added = (startup(command) - interpreter) * 1000
+    assert added < BUDGET, '{} took {:.0f}ms on top of the interpreter'.format(
+            ' '.join(command[2:]), added)
@@ -0,0 +1,57 @@
+import pytest
+
+from ttc_scraper.urls import canonical_url, page_url
+
+BASE = 'http://sae.wsu.edu/ttc/'
+
+
+@pytest.mark.parametrize('links', [
+    # Session ids, parameter order and ``&amp;``
+    ['viewtopic.php?f=12&t=345',
+     'viewtopic.php?t=345&f=12',
+     'viewtopic.php?f=12&amp;t=345&amp;sid=0123456789abcdef0123456789abcdef',
+     'viewtopic.php?sid=fedcba9876543210fedcba9876543210&t=345'],
+    # The first page, however it's asked for
+    ['viewtopic.php?t=345',
+     'viewtopic.php?t=345&start=0',
+     'viewtopic.php?t=345&p=1001#p1001',
+     'viewtopic.php?t=345&hilit=slip+angle&view=unread'],
+    ['viewforum.php?f=12&start=25',
+     'viewforum.php?start=25&f=12&sid=0123456789abcdef0123456789abcdef',
+     'viewforum.php?f=12&sk=t&sd=d&st=0&start=25'],
+    # Scheme and host aren't case sensitive
+    ['viewforum.php?f=12',
+     'HTTP://SAE.WSU.EDU/ttc/viewforum.php?f=12'],
+    ['download/file.php?id=503',
+     'download/file.php?sid=0123456789abcdef0123456789abcdef&id=503'],
+])
+def test_links_to_the_same_page_collapse(links):
+    canonical = {canonical_url(link if '://' in link else BASE + link) for link in links}
+    assert len(canonical) == 1
+
+
+@pytest.mark.parametrize('first, second', [
+    ('viewtopic.php?t=345', 'viewtopic.php?t=346'),
+    ('viewtopic.php?t=345', 'viewtopic.php?t=345&start=10'),
+    ('viewforum.php?f=12', 'viewforum.php?f=31'),
+    ('viewtopic.php?p=1001', 'viewtopic.php?p=1002'),
+    # Only the image is a thumbnail
+    ('download/file.php?id=704', 'download/file.php?id=704&mode=view'),
+])
+def test_different_pages_stay_apart(first, second):
+    assert canonical_url(BASE + first) != canonical_url(BASE + second)
+
+
+def test_canonical_url():
+    assert canonical_url(BASE + 'viewtopic.php?t=345&f=12&amp;start=10&sid=0123#p1011') == \
+            BASE + 'viewtopic.php?start=10&t=345'
+    assert canonical_url(BASE + 'download/file.php?mode=view&id=704') == \
+            BASE + 'download/file.php?id=704&mode=view'
+
+
+def test_page_url():
+    link = BASE + 'viewtopic.php?f=12&t=345&sid=0123&start=20'
+
+    assert page_url(link, 0) == BASE + 'viewtopic.php?t=345'
+    assert page_url(link, 10) == BASE + 'viewtopic.php?start=10&t=345'
+    assert page_url(link, 10) == canonical_url(BASE + 'viewtopic.php?start=10&t=345&f=12')
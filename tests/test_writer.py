@@ -0,0 +1,123 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, select
+
+from ttc_scraper.migrations import upgrade
+from ttc_scraper.models import Forum, Thread, Post, Url, CrawlTask
+from ttc_scraper.writer import BatchWriter
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'records.sqlite'))
+    upgrade(engine)
+    return engine
+
+
+def rows(engine, *columns):
+    with engine.connect() as conn:
+        return conn.execute(select(columns).order_by(*columns)).fetchall()
+
+
+def test_nothing_is_written_until_a_batch_fills_up(engine):
+    writer = BatchWriter(engine, batch_size=3, flush_interval=60)
+
+    writer.add(Url, link='http://localhost/a')
+    writer.add(Url, link='http://localhost/b')
+    assert rows(engine, Url.link) == []
+
+    writer.add(Url, link='http://localhost/c')
+    assert len(rows(engine, Url.link)) == 3
+
+
+def test_duplicate_posts_and_urls_are_ignored(engine):
+    writer = BatchWriter(engine)
+    forum_id = writer.add(Forum, name='Round 5', link='http://localhost/viewforum.php?f=1')
+    thread_id = writer.add(Thread, name='Slip angles', link='http://localhost/viewtopic.php?t=1',
+            forum_id=forum_id)
+
+    writer.add(Post, phpbb_id=100, author='alice', text='first', thread_id=thread_id)
+    writer.add(Url, link='http://localhost/viewtopic.php?t=1')
+    writer.flush()
+
+    writer.add(Post, phpbb_id=100, author='alice', text='again', thread_id=thread_id)
+    writer.add(Post, phpbb_id=101, author='bob', text='reply', thread_id=thread_id)
+    writer.add(Url, link='http://localhost/viewtopic.php?t=1')
+    writer.close()
+
+    assert rows(engine, Post.phpbb_id, Post.text) == [(100, 'first'), (101, 'reply')]
+    assert len(rows(engine, Url.link)) == 1
+
+
+def test_tasks_queued_by_a_new_crawl_replace_old_ones(engine):
+    writer = BatchWriter(engine)
+    writer.add(CrawlTask, name='forum', url='http://localhost/', state='done', crawl_id=1)
+    writer.flush()
+
+    writer.add(CrawlTask, name='forum', url='http://localhost/', state='queued', crawl_id=2)
+    writer.close()
+
+    assert rows(engine, CrawlTask.url, CrawlTask.state, CrawlTask.crawl_id) == \
+            [('http://localhost/', 'queued', 2)]
+
+
+def test_tasks_queued_again_by_the_same_crawl_keep_their_state(engine):
+    writer = BatchWriter(engine)
+    writer.add(CrawlTask, name='forum', url='http://localhost/', state='done', crawl_id=1)
+    writer.flush()
+
+    writer.add(CrawlTask, name='forum', url='http://localhost/', state='queued', crawl_id=1)
+    writer.close()
+
+    assert rows(engine, CrawlTask.state) == [('done',)]
+
+
+def test_a_rejected_batch_is_written_row_by_row(engine):
+    writer = BatchWriter(engine)
+    writer.add(Forum, name='Round 5', link='http://localhost/viewforum.php?f=1')
+    writer.flush()
+
+    # Forums aren't allowed to conflict, so only the duplicate is lost
+    writer.add(Forum, name='Round 5', link='http://localhost/viewforum.php?f=1')
+    writer.add(Forum, name='Round 6', link='http://localhost/viewforum.php?f=2')
+    writer.close()
+
+    assert rows(engine, Forum.name) == [('Round 5',), ('Round 6',)]
+
+
+def test_ids_carry_on_from_the_database(engine):
+    writer = BatchWriter(engine)
+    assert [writer.add(Forum, name=str(i)) for i in range(3)] == [1, 2, 3]
+    writer.close()
+
+    writer = BatchWriter(engine)
+    assert writer.add(Forum, name='3') == 4
+
+
+def test_id_blocks_never_overlap(engine):
+    first = BatchWriter(engine, id_block=5)
+    second = BatchWriter(engine, id_block=5)
+
+    ids = [(first if i % 3 else second).add(Forum, name=str(i)) for i in range(20)]
+    first.close()
+    second.close()
+
+    assert len(set(ids)) == 20
+    assert sorted(forum_id for (forum_id,) in rows(engine, Forum.id)) == sorted(ids)
+
+    # And a writer started later doesn't reuse any either
+    third = BatchWriter(engine, id_block=5)
+    assert third.add(Forum, name='later') > max(ids)
+
+
+def test_threaded_writer_writes_everything_on_close(engine):
+    writer = BatchWriter(engine, batch_size=7, threaded=True)
+    for i in range(100):
+        writer.add(Url, link='http://localhost/viewtopic.php?t={}'.format(i))
+    writer.update(Url, 1, link='http://localhost/viewtopic.php?t=first')
+    writer.close()
+
+    links = [link for (link,) in rows(engine, Url.link)]
+    assert len(links) == 100
+    assert 'http://localhost/viewtopic.php?t=first' in links
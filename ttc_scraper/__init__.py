@@ -1,6 +1,12 @@
-import pkg_resources
+def __getattr__(name):
+    # Looking the version up takes longer than most commands do, so it's only
+    # done when something asks for it
+    if name != '__version__':
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
 
-try:
-    __version__ = pkg_resources.get_distribution(__name__).version
-except:
-    __version__ = 'unknown'
+    from importlib.metadata import version
+    try:
+        globals()['__version__'] = version(__name__)
+    except Exception:
+        globals()['__version__'] = 'unknown'
+    return globals()['__version__']
@@ -1,33 +1,64 @@
 import os
+import re
+import sys
+import time
+import logging
+import sqlite3
 import argparse
+from datetime import datetime
+from urllib.parse import urljoin, quote
 
-from . import __version__
-from .spider import ForumSpider
+# Everything else (grab, SQLAlchemy, the spider...) is imported by the
+# commands which use it, so `--help` and friends don't wait on it
 
 
+COMMANDS = ('crawl', 'resume', 'reparse', 'search', 'export', 'ingest', 'stats')
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('username', type=str, help='Your username')
-    parser.add_argument('password', type=str, help='Your password')
-    parser.add_argument('-V', '--version', dest='version', action='store_true',
-                        help='Print the version number')
-    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
-                        help='Print verbose output to the terminal')
-    parser.add_argument('-d', '--database', dest='database', type=str,
-                        help='Where to store the data scraped from the TTC forum')
 
-    args = parser.parse_args()
+def open_database(args):
+    from sqlalchemy import create_engine
+    from .migrations import upgrade
 
-    if args.version:
-        print('{} v{}'.format(__package__, __version__))
-        exit()
+    engine = create_engine('sqlite:///{}'.format(
+        os.path.abspath(args.database or './records.sqlite')))
+    upgrade(engine)
+    return engine
 
-    spidey = ForumSpider(thread_number=2)
 
-    spidey.database_location = os.path.abspath(args.database or 
+def crawl(args):
+    if args.engine == 'asyncio':
+        from .aio import AsyncForumSpider as spider_class
+    else:
+        from .spider import ForumSpider as spider_class
+
+    spidey = spider_class(thread_number=args.concurrency)
+    spidey.max_rps = args.max_rps
+    if args.url:
+        spidey.initial_urls = [args.url]
+
+    spidey.database_location = os.path.abspath(args.database or
             './records.sqlite')
 
+    spidey.batch_size = args.batch_size
+    spidey.flush_interval = args.flush_interval
+    spidey.bloom_capacity = args.bloom_capacity
+    spidey.incremental = args.incremental
+    spidey.resume = args.resume
+    spidey.download_dir = args.download_dir
+    spidey.download_concurrency = args.download_concurrency
+    spidey.archive_location = args.archive
+    spidey.cache_location = args.cache
+    spidey.compact = args.compact
+    spidey.cache_size = args.cache_size
+    spidey.parse_processes = args.parse_processes
+    spidey.stats_interval = args.stats_interval
+    spidey.metrics_port = args.metrics_port
+    spidey.profile_dir = args.profile
+    spidey.frontier_size = args.frontier_size
+    spidey.frontier_location = args.frontier_location
+    spidey.forum_limit = args.forum_limit
+    spidey.sqlite_profile = args.sqlite_profile
+
     spidey.username = args.username
     spidey.password = args.password
 
@@ -38,7 +69,278 @@ def main():
         spidey.debug = False
         spidey.log_file = 'crawler.log'
 
-    spidey.run()
+    if args.workers > 1:
+        from .shard import run_sharded
+        run_sharded(spidey, args.workers)
+    else:
+        spidey.run()
+
+
+def resume(args):
+    args.resume = True
+    crawl(args)
+
+
+def reparse_archive(args):
+    from .archive import PageArchive, reparse
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    engine = open_database(args)
+
+    archive = PageArchive(args.archive or './archive.sqlite')
+    reparse(engine, archive, processes=args.processes,
+            compact=True if args.compact else None)
+
+
+def search_posts(args):
+    from sqlalchemy.exc import OperationalError
+    from .search import search, rebuild_index
+
+    engine = open_database(args)
+
+    if args.rebuild:
+        print('Indexed {} posts'.format(rebuild_index(engine)))
+
+    start = time.perf_counter()
+    try:
+        hits = search(engine, args.query, limit=args.limit)
+    except OperationalError as e:
+        print('Invalid search "{}": {}'.format(args.query, e.orig))
+        exit(1)
+    elapsed = time.perf_counter() - start
+
+    for hit in hits:
+        link = hit.link
+        if hit.phpbb_id is not None:
+            link = urljoin(hit.link, 'viewtopic.php?p={0}#p{0}'.format(hit.phpbb_id))
+
+        print('{} - {}, {}'.format(hit.thread, hit.author,
+            hit.created.strftime('%Y-%m-%d') if hit.created else 'unknown date'))
+        print('    {}'.format(re.sub(r'\s+', ' ', hit.snippet).strip()))
+        print('    {}'.format(link))
+
+    print('{} results in {:.1f}ms'.format(len(hits), elapsed * 1000))
+
+
+def export_posts(args):
+    from .export import export
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+            stream=sys.stderr)
+    engine = open_database(args)
+
+    since = datetime.strptime(args.since, '%Y-%m-%d %H:%M:%S' if ':' in args.since
+            else '%Y-%m-%d') if args.since else None
+
+    export(engine, args.output,
+            format=args.format,
+            since=since,
+            html=not args.no_html,
+            chunk_size=args.chunk_size)
+
+
+def ingest_data(args):
+    # NumPy is only needed for this
+    from .ingest import ingest
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    engine = open_database(args)
+
+    ingest(engine, args.attachments,
+            args.output or os.path.join(args.attachments, 'runs'),
+            chunk_size=args.chunk_size * 1024 * 1024,
+            dtype='float32' if args.float32 else 'float64',
+            force=args.force)
+
+
+def show_stats(args):
+    # Straight through sqlite3 rather than SQLAlchemy, which takes longer to
+    # import than this takes to run. The database is opened read-only, so
+    # it's never migrated and can be looked at in the middle of a crawl.
+    location = os.path.abspath(args.database or './records.sqlite')
+    if not os.path.exists(location):
+        print('No database at {}'.format(location))
+        exit(1)
+
+    conn = sqlite3.connect('file:{}?mode=ro'.format(quote(location)), uri=True)
+
+    def query(sql):
+        # Older databases can be missing tables and columns
+        try:
+            return conn.execute(sql).fetchone()
+        except sqlite3.OperationalError:
+            return None
+
+    def count(table, where=None):
+        row = query('SELECT count(*) FROM {}{}'.format(table,
+            ' WHERE ' + where if where else ''))
+        return row[0] if row else 0
+
+    print('Database:      {} ({:.1f} MB)'.format(location, os.path.getsize(location) / 1e6))
+    print('Forums:        {}'.format(count('forums')))
+    print('Threads:       {}'.format(count('threads')))
+
+    newest = query('SELECT max(created) FROM posts')
+    print('Posts:         {}{}'.format(count('posts'),
+        ', newest from {}'.format(newest[0][:19]) if newest and newest[0] else ''))
+    print('Attachments:   {}, {} downloaded'.format(count('attachments'),
+        count('attachments', 'sha256 IS NOT NULL')))
+
+    crawl = query('SELECT started, finished FROM _crawls ORDER BY id DESC LIMIT 1')
+    if crawl:
+        print('Last crawl:    started {}, {}'.format(crawl[0][:19],
+            'finished {}'.format(crawl[1][:19]) if crawl[1] else 'not finished'))
+    print('Pending tasks: {}, {} failed'.format(
+        count('_tasks', "state IN ('queued', 'in_flight')"), count('_tasks', "state = 'failed'")))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    # `python -m ttc_scraper USERNAME PASSWORD` predates subcommands
+    if not argv or argv[0] not in COMMANDS + ('-h', '--help', '-V', '--version'):
+        argv.insert(0, 'crawl')
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='Print verbose output to the terminal')
+    common.add_argument('-d', '--database', dest='database', type=str,
+                        help='Where to store the data scraped from the TTC forum')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-V', '--version', dest='version', action='store_true',
+                        help='Print the version number')
+    subparsers = parser.add_subparsers(dest='command')
+
+    crawl_options = argparse.ArgumentParser(add_help=False)
+    crawl_options.add_argument('username', type=str, help='Your username')
+    crawl_options.add_argument('password', type=str, help='Your password')
+    crawl_options.add_argument('--url', dest='url', type=str,
+                        help='Crawl the phpBB board at this address instead')
+    crawl_options.add_argument('-c', '--concurrency', dest='concurrency', type=int,
+                        default=2,
+                        help='The most requests to have in flight at once')
+    crawl_options.add_argument('-e', '--engine', dest='engine',
+                        choices=['grab', 'asyncio'], default='grab',
+                        help='What to fetch pages with (default: grab)')
+    crawl_options.add_argument('--max-rps', dest='max_rps', type=float,
+                        help='Never make more than this many requests per second')
+    crawl_options.add_argument('-b', '--batch-size', dest='batch_size', type=int,
+                        default=500,
+                        help='How many rows to queue up before writing them to the database')
+    crawl_options.add_argument('--flush-interval', dest='flush_interval', type=float,
+                        default=5.0,
+                        help='Maximum number of seconds to hold rows before writing them')
+    crawl_options.add_argument('-r', '--resume', dest='resume', action='store_true',
+                        help='Carry on from where an interrupted crawl left off')
+    crawl_options.add_argument('-i', '--incremental', dest='incremental', action='store_true',
+                        help='Only fetch new threads and the new pages of threads with new replies')
+    crawl_options.add_argument('-a', '--attachments', dest='download_dir', type=str,
+                        help='Download attachments into this directory once the crawl finishes')
+    crawl_options.add_argument('--download-concurrency', dest='download_concurrency',
+                        type=int, default=4,
+                        help='How many attachments to download at a time')
+    crawl_options.add_argument('--archive', dest='archive', type=str,
+                        help='Keep a compressed copy of every page fetched in this file')
+    crawl_options.add_argument('--cache', dest='cache', type=str,
+                        help='Cache pages in this file and only re-download them if they change')
+    crawl_options.add_argument('--cache-size', dest='cache_size', type=int, default=500,
+                        help='The most megabytes of (compressed) pages to cache')
+    crawl_options.add_argument('--compact', dest='compact', action='store_true',
+                        help='Store posts compressed, with authors and attachment links interned')
+    crawl_options.add_argument('-j', '--parse-processes', dest='parse_processes',
+                        type=int, default=0,
+                        help='Parse posts on this many worker processes instead of inline')
+    crawl_options.add_argument('--bloom-capacity', dest='bloom_capacity', type=int,
+                        help='Track seen urls with a Bloom filter sized for this many urls')
+    crawl_options.add_argument('--stats-interval', dest='stats_interval', type=float,
+                        default=30,
+                        help='Log a line of crawl statistics this often, in seconds (0 to disable)')
+    crawl_options.add_argument('--metrics-port', dest='metrics_port', type=int,
+                        help='Serve Prometheus metrics on this port on localhost')
+    crawl_options.add_argument('--profile', dest='profile', type=str,
+                        help='Profile each type of task, writing the results to this directory')
+    crawl_options.add_argument('--frontier-size', dest='frontier_size', type=int,
+                        default=10000,
+                        help='Keep at most this many queued tasks in memory, spilling the rest to disk')
+    crawl_options.add_argument('--frontier-location', dest='frontier_location', type=str,
+                        help='Where to spill queued tasks (a temporary file by default)')
+    crawl_options.add_argument('--forum-limit', dest='forum_limit', type=int,
+                        help='Crawl at most this many threads per forum, leaving the rest for --resume')
+    crawl_options.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                        help='Split the crawl between this many processes, by forum')
+    crawl_options.add_argument('--sqlite-profile', dest='sqlite_profile',
+                        choices=['tuned', 'default'], default='tuned',
+                        help='Use WAL mode and a writer thread, or SQLite\'s defaults written inline (default: tuned)')
+
+    crawl_parser = subparsers.add_parser('crawl', parents=[common, crawl_options],
+            help='Scrape the forum (the default)')
+    crawl_parser.set_defaults(func=crawl)
+
+    resume_parser = subparsers.add_parser('resume', parents=[common, crawl_options],
+            help='Carry on from where an interrupted crawl left off (crawl --resume)')
+    resume_parser.set_defaults(func=resume)
+
+    reparse_parser = subparsers.add_parser('reparse', parents=[common],
+            help='Rebuild the posts and attachments from archived pages')
+    reparse_parser.set_defaults(func=reparse_archive)
+    reparse_parser.add_argument('--archive', dest='archive', type=str,
+                        help='The page archive to read (default ./archive.sqlite)')
+    reparse_parser.add_argument('-j', '--processes', dest='processes', type=int,
+                        help='How many worker processes to parse with (default: one per core)')
+    reparse_parser.add_argument('--compact', dest='compact', action='store_true',
+                        help='Store posts compressed, with authors and attachment links interned')
+
+    search_parser = subparsers.add_parser('search', parents=[common],
+            help='Search the text of every post')
+    search_parser.set_defaults(func=search_posts)
+    search_parser.add_argument('query', type=str,
+                        help='What to look for, using SQLite FTS5 query syntax')
+    search_parser.add_argument('-n', '--limit', dest='limit', type=int, default=20,
+                        help='The most results to show')
+    search_parser.add_argument('--rebuild', dest='rebuild', action='store_true',
+                        help='Rebuild the search index from scratch first')
+
+    export_parser = subparsers.add_parser('export', parents=[common],
+            help='Export every post as JSON lines or Parquet')
+    export_parser.set_defaults(func=export_posts)
+    export_parser.add_argument('output', type=str,
+                        help='Where to write the posts (\'-\' for stdout)')
+    export_parser.add_argument('-f', '--format', dest='format', choices=['jsonl', 'parquet'],
+                        help='The format to write (default: guessed from the file name)')
+    export_parser.add_argument('--since', dest='since', type=str,
+                        help='Only export posts made after this "YYYY-MM-DD [HH:MM:SS]"')
+    export_parser.add_argument('--no-html', dest='no_html', action='store_true',
+                        help='Leave out the HTML of each post')
+    export_parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=1000,
+                        help='How many rows to read from the database at a time')
+
+    ingest_parser = subparsers.add_parser('ingest', parents=[common],
+            help='Load downloaded tire test data into memory-mappable arrays')
+    ingest_parser.set_defaults(func=ingest_data)
+    ingest_parser.add_argument('attachments', type=str,
+                        help='Where the attachments were downloaded to')
+    ingest_parser.add_argument('-o', '--output', dest='output', type=str,
+                        help='Where to write the arrays (default: a "runs" directory in ATTACHMENTS)')
+    ingest_parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=4,
+                        help='How many megabytes of a file to parse at a time')
+    ingest_parser.add_argument('--float32', dest='float32', action='store_true',
+                        help='Store single precision numbers, taking half the space')
+    ingest_parser.add_argument('--force', dest='force', action='store_true',
+                        help='Ingest files again even if they already have been')
+
+    stats_parser = subparsers.add_parser('stats', parents=[common],
+            help='Summarise what has been scraped so far')
+    stats_parser.set_defaults(func=show_stats)
+
+    args = parser.parse_args(argv)
+
+    if args.version:
+        from . import __version__
+        print('{} v{}'.format(__package__, __version__))
+        exit()
+
+    args.func(args)
 
 if __name__ == "__main__":
     main()
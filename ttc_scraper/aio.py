@@ -0,0 +1,295 @@
+"""
+An asyncio alternative to grab's Spider.
+
+``AsyncSpider`` uses the same task model: ``Task`` objects are dispatched to
+``task_<name>(grab, task)`` handlers, which yield more tasks. Tasks wait in
+``task_queue``, which can be anything that works as a grab queue backend
+(a ``Frontier`` by default). Pages are
+fetched through a single aiohttp session, so every request shares one pool
+of keep-alive connections and one cookie jar rather than each getting its
+own curl handle.
+
+Handlers still run one at a time on the event loop's thread, so anything
+expensive should be handed off (see ``ParsePipeline``).
+"""
+import time
+import asyncio
+import logging
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar, Cookie
+
+import aiohttp
+import lxml.html
+from yarl import URL
+from grab.spider import Task
+
+from .spider import ForumCrawler
+from .frontier import Frontier
+
+
+class Page:
+    """
+    Just enough of a ``Grab`` object for the task handlers: ``code``,
+    ``headers``, ``body`` and ``total_time`` are available as
+    ``page.response.*`` and the parsed document as ``page.doc.tree``.
+    """
+
+    def __init__(self, url, code, headers, body, total_time):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self.body = body
+        self.total_time = total_time
+        self._tree = None
+
+    @property
+    def response(self):
+        return self
+
+    @property
+    def doc(self):
+        return self
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = lxml.html.fromstring(self.body, base_url=self.url)
+        return self._tree
+
+
+def stdlib_cookiejar(jar):
+    """
+    Copy the cookies out of an aiohttp jar into a ``http.cookiejar``
+    one, for anything using urllib (e.g. the attachment downloader).
+    """
+    cookiejar = CookieJar()
+
+    for morsel in jar:
+        domain = morsel['domain']
+        cookiejar.set_cookie(Cookie(0, morsel.key, morsel.value,
+                None, False,
+                domain, bool(domain), domain.startswith('.'),
+                morsel['path'] or '/', True,
+                bool(morsel['secure']), None, True,
+                None, None, {}))
+
+    return cookiejar
+
+
+class AsyncSpider:
+    initial_urls = []
+    user_agent = 'ttc_scraper'
+    task_try_limit = 3
+    network_timeout = 60
+
+    def __init__(self, thread_number=2):
+        self.thread_number = thread_number
+        self.logger = logging.getLogger(__name__)
+        self.jar = None
+        self.task_queue = Frontier()
+
+        self._wakeup = None
+        self._active = 0
+
+    def prepare(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    async def setup(self, session):
+        """
+        Called once the HTTP session is open, before the first task.
+        """
+
+    async def before_request(self, task):
+        pass
+
+    def request_headers(self, task):
+        return {}
+
+    def network_error(self, task, error):
+        self.logger.warning('Unable to fetch {}: {!r}'.format(task.url, error))
+
+    def valid_response_code(self, code, task):
+        return code < 400 or code == 404
+
+    def queue_size(self):
+        return self.task_queue.size()
+
+    def find_task_handler(self, task):
+        return getattr(self, 'task_{}'.format(task.name))
+
+    def add_task(self, task):
+        self.task_queue.put(task, getattr(task, 'priority', None))
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    def run(self):
+        self.prepare()
+        try:
+            asyncio.run(self._run())
+        finally:
+            self.task_queue.close()
+            self.shutdown()
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        self._finished = False
+        self.jar = aiohttp.CookieJar()
+
+        connector = aiohttp.TCPConnector(limit=self.thread_number)
+        timeout = aiohttp.ClientTimeout(total=self.network_timeout)
+
+        async with aiohttp.ClientSession(connector=connector,
+                cookie_jar=self.jar,
+                timeout=timeout,
+                headers={'User-Agent': self.user_agent}) as session:
+            await self.setup(session)
+
+            for url in self.initial_urls:
+                self.add_task(Task('initial', url=url))
+
+            workers = [asyncio.ensure_future(self._worker(session))
+                       for _ in range(self.thread_number)]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+    async def _worker(self, session):
+        while not self._finished:
+            try:
+                task = self.task_queue.get()
+            except Empty:
+                if not self._active and not self.task_queue.size():
+                    # Nothing queued and nothing running which could queue
+                    # more, so wake everyone else up to finish too
+                    self._finished = True
+                    self._wakeup.set()
+                    break
+                self._wakeup.clear()
+                try:
+                    # The queue may just not be ready for us yet
+                    await asyncio.wait_for(self._wakeup.wait(), 0.5)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._active += 1
+            try:
+                await self._process(session, task)
+            except Exception:
+                self.logger.exception('Error handling {}'.format(task.url))
+            finally:
+                self._active -= 1
+                self._wakeup.set()
+
+    async def _process(self, session, task):
+        await self.before_request(task)
+
+        start = time.monotonic()
+        try:
+            async with session.get(task.url, headers=self.request_headers(task)) as response:
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.network_error(task, e)
+            self._retry(task)
+            return
+
+        page = Page(str(response.url), response.status, response.headers, body,
+                time.monotonic() - start)
+
+        if not self.valid_response_code(page.code, task):
+            self.logger.warning('{} returned {}'.format(task.url, page.code))
+            self._retry(task)
+            return
+
+        handler = self.find_task_handler(task)
+        for new_task in handler(page, task) or ():
+            self.add_task(new_task)
+
+    def _retry(self, task):
+        tries = getattr(task, 'task_try_count', 1)
+
+        if tries < self.task_try_limit:
+            task.task_try_count = tries + 1
+            self.add_task(task)
+        else:
+            self.log_rejected_task(task, 'task-try-count')
+
+    def log_rejected_task(self, task, reason):
+        self.logger.error('Giving up on {} after {} tries'.format(task.url,
+            getattr(task, 'task_try_count', 1)))
+
+
+class AsyncForumSpider(ForumCrawler, AsyncSpider):
+    """
+    The forum spider on the asyncio engine. Every request goes through one
+    keep-alive connection pool and cookie jar, and the rate limiter's window
+    caps how many are in flight.
+    """
+
+    @property
+    def cookiejar(self):
+        return stdlib_cookiejar(self.jar) if self.jar is not None else None
+
+    def prepare(self):
+        super().prepare()
+        # Waiting for a slot blocks, so keep it off the event loop
+        self.slot_waiters = ThreadPoolExecutor(max_workers=self.thread_number)
+
+    def use_session(self, cookies):
+        """
+        Use cookies from somebody else's login instead of logging in.
+        """
+        self.shared_cookies = cookies
+
+    async def setup(self, session):
+        cookies = getattr(self, 'shared_cookies', None)
+        if cookies is not None:
+            self.jar.update_cookies({cookie.name: cookie.value for cookie in cookies},
+                    URL(self.base_url))
+            return
+
+        self.logger.info('Logging in')
+
+        async with session.get(self.base_url) as response:
+            tree = lxml.html.fromstring(await response.read(),
+                    base_url=str(response.url))
+
+        form = next(form for form in tree.forms if 'username' in form.inputs.keys())
+        fields = dict(form.form_values())
+        # Like a browser, send the name of the button we "clicked"
+        for button in form.xpath('.//input[@type="submit"][@name]')[:1]:
+            fields[button.name] = button.value or ''
+        fields.update(username=self.username, password=self.password)
+
+        async with session.post(form.action or self.base_url, data=fields) as response:
+            tree = lxml.html.fromstring(await response.read())
+
+        if tree.xpath('//a[contains(text(),"All Users Must Register")]'):
+            self.logger.error('Login failed')
+            raise RuntimeError('Login failed')
+
+        self.logger.info('Login successful')
+
+    def login(self):
+        # Already done by setup(), before any tasks were started
+        pass
+
+    async def before_request(self, task):
+        self.metrics.inc('ttc_requests_started_total', task=task.name)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.slot_waiters, self.limiter.wait)
+
+    def network_error(self, task, error):
+        super().network_error(task, error)
+        self.limiter.record(ok=False)
+
+    def shutdown(self):
+        super().shutdown()
+        self.slot_waiters.shutdown()
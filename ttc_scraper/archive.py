@@ -0,0 +1,158 @@
+"""
+A local archive of every page the spider fetches, so the posts and
+attachments tables can be rebuilt after a parser change without going
+anywhere near the network.
+
+Pages are stored zlib-compressed in their own SQLite database, keyed by
+canonical URL and fetch time.
+"""
+import zlib
+import logging
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import (create_engine, select, func, MetaData, Table, Column,
+        Integer, String, DateTime, LargeBinary)
+
+from .models import Thread, Post, Attachment, Link
+from .parser import parse_page
+from .urls import canonical_url, page_url
+from .writer import BatchWriter, CompactStorage, queue_post
+
+
+metadata = MetaData()
+
+pages = Table('pages', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('url', String(128), index=True),
+        Column('kind', String(16), index=True),
+        Column('fetched', DateTime),
+        Column('body', LargeBinary))
+
+
+class PageArchive:
+    def __init__(self, location, batch_size=100, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.engine = create_engine('sqlite:///{}'.format(location))
+        metadata.create_all(self.engine)
+
+        self.writer = BatchWriter(self.engine,
+                batch_size=batch_size,
+                logger=self.logger,
+                metadata=metadata)
+
+    def add(self, kind, url, body, fetched=None):
+        self.writer.add(pages,
+                url=url,
+                kind=kind,
+                fetched=fetched or datetime.now(),
+                body=zlib.compress(body))
+
+    def latest(self, kind, chunk_size=500):
+        """
+        Yield lists of ``(url, compressed_body)`` tuples for the most recent
+        copy of every page of the given kind.
+        """
+        newest = (select([func.max(pages.c.id)])
+                .where(pages.c.kind == kind)
+                .group_by(pages.c.url))
+        query = select([pages.c.url, pages.c.body]).where(pages.c.id.in_(newest))
+
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(query)
+
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [tuple(row) for row in rows]
+
+    def urls(self, kind):
+        """
+        Every url with a copy of a page of the given kind.
+        """
+        with self.engine.connect() as conn:
+            return [url for (url,) in conn.execute(
+                select([pages.c.url]).where(pages.c.kind == kind).distinct())]
+
+    def close(self):
+        self.writer.close()
+
+
+def _chunks(items, size=500):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def _parse_page(page):
+    url, body = page
+    return url, parse_page(url, zlib.decompress(body)).posts
+
+
+def reparse(engine, archive, processes=None, compact=None, logger=None):
+    """
+    Throw away the posts and attachments of every thread with archived pages
+    and rebuild them from those pages, parsing on a pool of ``processes``
+    worker processes (one per core by default). Threads which were crawled
+    without an archive are left as they are.
+
+    Anything we'd already downloaded for an attachment is carried across.
+    The posts are written in the compact layout if ``compact`` is set, or
+    if it's ``None`` and they were already.
+    """
+    logger = logger or logging.getLogger(__name__)
+    writer = BatchWriter(engine, logger=logger)
+    attachments, links = Attachment.__table__, Link.__table__
+
+    if compact is None:
+        compact = CompactStorage.in_use(engine)
+
+    with engine.begin() as conn:
+        thread_ids = {link: thread_id for link, thread_id in
+                      conn.execute(select([Thread.link, Thread.id]))}
+        downloads = {link: {'sha256': sha256, 'size': size}
+                     for link, sha256, size in conn.execute(
+                         select([func.coalesce(attachments.c.link, links.c.link),
+                                 attachments.c.sha256, attachments.c.size])
+                         .select_from(attachments.outerjoin(links,
+                             links.c.id == attachments.c.link_id))
+                         .where(attachments.c.sha256 != None))}
+
+        covered = {thread_ids.get(canonical_url(page_url(url, 0)))
+                   for url in archive.urls('thread')}
+        covered.discard(None)
+
+        posts = Post.__table__
+        for chunk in _chunks(sorted(covered)):
+            in_threads = select([posts.c.id]).where(posts.c.thread_id.in_(chunk))
+            conn.execute(attachments.delete().where(attachments.c.post_id.in_(in_threads)))
+            conn.execute(posts.delete().where(posts.c.thread_id.in_(chunk)))
+
+    logger.info('Reparsing {} of {} threads, leaving the rest alone'.format(
+        len(covered), len(thread_ids)))
+
+    storage = CompactStorage(engine, writer) if compact else None
+    seen_posts = set()
+    page_count = post_count = 0
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for chunk in archive.latest('thread'):
+            for url, posts in pool.map(_parse_page, chunk, chunksize=16):
+                page_count += 1
+                thread_id = thread_ids.get(canonical_url(page_url(url, 0)))
+                if thread_id is None:
+                    logger.warning('No thread for archived page {}'.format(url))
+                    continue
+
+                for post in posts:
+                    if post.phpbb_id is not None:
+                        if post.phpbb_id in seen_posts:
+                            continue
+                        seen_posts.add(post.phpbb_id)
+
+                    queue_post(writer, post, thread_id, downloads, compact=storage)
+                    post_count += 1
+
+    writer.close()
+    logger.info('Reparsed {} posts from {} pages'.format(post_count, page_count))
+    return page_count, post_count
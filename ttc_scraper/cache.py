@@ -0,0 +1,152 @@
+"""
+An on-disk cache of responses, revalidated with conditional requests.
+
+Any page the server sent an ``ETag`` or ``Last-Modified`` for is kept
+(zlib-compressed) in its own SQLite database. The next time it's requested
+we send ``If-None-Match``/``If-Modified-Since``, and a ``304 Not Modified``
+is answered from the cache so the task handlers never know the difference.
+
+The cache is capped at ``max_size`` bytes of compressed bodies, evicting the
+least recently used pages first.
+"""
+import zlib
+import logging
+from datetime import datetime
+
+from sqlalchemy import (create_engine, event, select, func, MetaData, Table,
+        Column, Integer, String, DateTime, LargeBinary)
+
+
+metadata = MetaData()
+
+responses = Table('responses', metadata,
+        Column('url', String(128), primary_key=True),
+        Column('etag', String(128)),
+        Column('last_modified', String(64)),
+        Column('size', Integer),
+        Column('accessed', DateTime, index=True),
+        Column('body', LargeBinary))
+
+
+def _fast_pragmas(dbapi_connection, connection_record):
+    # Losing the cache in a crash only costs us some bandwidth
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.close()
+
+
+class ResponseCache:
+    def __init__(self, location, max_size=500 * 1024 * 1024, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_size = max_size
+
+        self.engine = create_engine('sqlite:///{}'.format(location))
+        event.listen(self.engine, 'connect', _fast_pragmas)
+        metadata.create_all(self.engine)
+
+        with self.engine.connect() as conn:
+            self.size = conn.execute(select([func.coalesce(func.sum(responses.c.size), 0)])).scalar()
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def validators(self, url):
+        """
+        The conditional request headers to send for ``url``, if we have a
+        copy of it.
+        """
+        with self.engine.begin() as conn:
+            row = conn.execute(select([responses.c.etag, responses.c.last_modified])
+                    .where(responses.c.url == url)).first()
+            if row is None:
+                return {}
+
+            # Revalidating counts as a use, so it won't be evicted before the
+            # response comes back
+            conn.execute(responses.update()
+                    .where(responses.c.url == url)
+                    .values(accessed=datetime.now()))
+
+        headers = {}
+        if row.etag:
+            headers['If-None-Match'] = row.etag
+        if row.last_modified:
+            headers['If-Modified-Since'] = row.last_modified
+        return headers
+
+    def hit(self, url):
+        """
+        The cached body of a page the server told us hasn't changed, or
+        ``None`` if it was evicted while we were revalidating it.
+        """
+        with self.engine.connect() as conn:
+            body = conn.execute(select([responses.c.body])
+                    .where(responses.c.url == url)).scalar()
+
+        if body is None:
+            return None
+
+        body = zlib.decompress(body)
+        self.hits += 1
+        self.bytes_saved += len(body)
+        return body
+
+    def store(self, url, headers, body):
+        """
+        Record a full response, keeping it if the server gave us something
+        to revalidate it with.
+        """
+        self.misses += 1
+
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not (etag or last_modified):
+            return
+
+        compressed = zlib.compress(body)
+
+        with self.engine.begin() as conn:
+            old_size = conn.execute(select([responses.c.size])
+                    .where(responses.c.url == url)).scalar() or 0
+            conn.execute(responses.insert().prefix_with('OR REPLACE'),
+                    url=url,
+                    etag=etag,
+                    last_modified=last_modified,
+                    size=len(compressed),
+                    accessed=datetime.now(),
+                    body=compressed)
+
+            self.size += len(compressed) - old_size
+            if self.size > self.max_size:
+                self._evict(conn)
+
+    def _evict(self, conn, chunk_size=100):
+        while self.size > self.max_size:
+            oldest = conn.execute(select([responses.c.url, responses.c.size])
+                    .order_by(responses.c.accessed)
+                    .limit(chunk_size)).fetchall()
+            if not oldest:
+                break
+
+            evicted = []
+            for url, size in oldest:
+                if self.size <= self.max_size:
+                    break
+                evicted.append(url)
+                self.size -= size
+
+            conn.execute(responses.delete().where(responses.c.url.in_(evicted)))
+            self.logger.debug('Evicted {} pages from the cache'.format(len(evicted)))
+
+    @property
+    def hit_ratio(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def close(self):
+        self.logger.info('Cache: {} of {} pages unchanged ({:.1%}), saved {:.1f} MB'.format(
+            self.hits, self.hits + self.misses, self.hit_ratio,
+            self.bytes_saved / 1024 / 1024))
+        self.engine.dispose()
@@ -0,0 +1,215 @@
+"""
+Downloading the files attached to posts.
+
+Files are streamed to disk in chunks and stored content-addressed by their
+SHA-256, so the same data file attached to a dozen posts is only kept once.
+Interrupted downloads are resumed with an HTTP ``Range`` request the next
+time around. If the board sends its login page instead of a file, our
+session has expired, so we log in again and retry rather than saving it.
+"""
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import build_opener, HTTPCookieProcessor, Request
+
+import lxml.html
+from sqlalchemy import select, func
+
+from .models import Attachment, Link
+
+
+def downloaded_path(directory, sha256):
+    """
+    Where the file with this SHA-256 is kept in a download directory.
+    """
+    return os.path.join(directory, sha256[:2], sha256[2:4], sha256)
+
+
+def login_form(page, url):
+    """
+    The form on a page from the board asking us to log in, if there is one.
+    """
+    tree = lxml.html.fromstring(page, base_url=url)
+    for form in tree.forms:
+        if 'username' in form.inputs.keys():
+            return form
+
+
+class AttachmentDownloader:
+    def __init__(self, engine, writer, directory, cookiejar=None, username=None,
+            password=None, concurrency=4, chunk_size=1024*1024, timeout=60, logger=None):
+        self.engine = engine
+        self.writer = writer
+        self.directory = os.path.abspath(directory)
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.opener = build_opener(HTTPCookieProcessor(cookiejar or CookieJar()))
+        self.opener.addheaders = [('User-Agent', 'ttc_scraper')]
+
+        self.username = username
+        self.password = password
+        #: How many times we've logged in, so threads which all got the login
+        #: page at once only log in once between them
+        self.logins = 0
+        self.login_failed = False
+        self._login_lock = threading.Lock()
+
+        os.makedirs(os.path.join(self.directory, 'partial'), exist_ok=True)
+
+    def path_for(self, sha256):
+        return downloaded_path(self.directory, sha256)
+
+    def pending(self):
+        """
+        Every attachment link which hasn't been downloaded yet, mapped to the
+        ids of the attachment rows which point at it.
+        """
+        table, links = Attachment.__table__, Link.__table__
+        query = (select([table.c.id, func.coalesce(table.c.link, links.c.link)])
+                .select_from(table.outerjoin(links, links.c.id == table.c.link_id))
+                .where(table.c.sha256 == None)
+                .order_by(table.c.id))
+
+        links = OrderedDict()
+        with self.engine.connect() as conn:
+            for attachment_id, link in conn.execute(query):
+                links.setdefault(link, []).append(attachment_id)
+        return links
+
+    def log_in(self, form, logins):
+        """
+        Log in through the board's login form, unless somebody else has
+        since we made a request as the ``logins``'th session.
+        """
+        with self._login_lock:
+            if self.logins != logins:
+                return
+            if self.login_failed or self.username is None:
+                raise RuntimeError('Got the login page instead of a file')
+
+            fields = dict(form.form_values())
+            # Like a browser, send the name of the button we "clicked"
+            for button in form.xpath('.//input[@type="submit"][@name]')[:1]:
+                fields[button.name] = button.value or ''
+            fields.update(username=self.username, password=self.password)
+
+            self.logger.info('Logging in to download attachments')
+            data = urlencode(fields).encode('utf-8')
+            with self.opener.open(form.action, data, timeout=self.timeout) as response:
+                if login_form(response.read(), response.geturl()) is not None:
+                    # Don't keep trying (and maybe get locked out)
+                    self.login_failed = True
+                    raise RuntimeError('Login failed')
+
+            self.logins += 1
+
+    def download(self, link, retry=True):
+        """
+        Stream a single file to disk, resuming a previous partial download
+        if there is one. Returns the file's SHA-256 and size.
+        """
+        logins = self.logins
+        key = hashlib.sha256(link.encode('utf-8')).hexdigest()
+        partial = os.path.join(self.directory, 'partial', key)
+
+        digest = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial):
+            with open(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    digest.update(chunk)
+                    offset += len(chunk)
+
+        request = Request(link)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+
+        try:
+            response = self.opener.open(request, timeout=self.timeout)
+        except HTTPError as e:
+            if not offset or e.code != 416:
+                raise
+
+            # Nothing left after our offset, so the partial download is the
+            # whole file (unless the server says it's a different size)
+            total = e.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) != offset:
+                self.logger.debug('Partial download of {} is {} bytes but the file is {}, '
+                        'starting again'.format(link, offset, total))
+                os.remove(partial)
+                return self.download(link, retry)
+            response = None
+
+        if response is not None:
+            with response:
+                if response.headers.get_content_type() == 'text/html':
+                    form = login_form(response.read(), response.geturl())
+                    if form is None or not retry:
+                        raise RuntimeError('Got a web page instead of a file')
+
+                    # Our session has expired (or we never had one)
+                    self.log_in(form, logins)
+                    return self.download(link, retry=False)
+
+                if offset and response.status != 206:
+                    # The server ignored our Range header, start from scratch
+                    self.logger.debug('Server refused to resume {}'.format(link))
+                    digest, offset = hashlib.sha256(), 0
+
+                with open(partial, 'ab' if offset else 'wb') as f:
+                    for chunk in iter(lambda: response.read(self.chunk_size), b''):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        offset += len(chunk)
+
+        sha256 = digest.hexdigest()
+        destination = self.path_for(sha256)
+
+        if os.path.exists(destination):
+            os.remove(partial)
+        else:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.move(partial, destination)
+
+        return sha256, offset
+
+    def run(self):
+        """
+        Download every pending attachment, at most ``concurrency`` at a time.
+        """
+        links = self.pending()
+        self.logger.info('Downloading {} attachments'.format(len(links)))
+        downloaded = failed = 0
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {pool.submit(self.download, link): link for link in links}
+
+            for future in as_completed(futures):
+                link = futures[future]
+
+                try:
+                    sha256, size = future.result()
+                except Exception as e:
+                    self.logger.error('Unable to download {}: {}'.format(link, e))
+                    failed += 1
+                    continue
+
+                for attachment_id in links[link]:
+                    self.writer.update(Attachment, attachment_id, sha256=sha256, size=size)
+
+                downloaded += 1
+                self.logger.info('Downloaded {} ({} bytes, {})'.format(link, size, sha256))
+
+        self.writer.flush()
+        self.logger.info('Downloaded {} attachments, {} failed'.format(downloaded, failed))
+        return downloaded, failed
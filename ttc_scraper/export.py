@@ -0,0 +1,167 @@
+"""
+Streaming the scraped corpus out of the database as JSON lines or Parquet.
+
+Every post is exported as one flat record along with its thread and forum,
+and a list of its attachments. The forum -> thread -> post -> attachment
+join is done in a single query ordered by post, read in chunks from a
+streaming cursor, so memory use doesn't grow with the size of the database.
+"""
+import sys
+import json
+import logging
+from itertools import groupby
+
+from sqlalchemy import select, func
+
+from .models import Forum, Thread, Post, Attachment, Author, Link
+
+
+#: The fields of an exported post, in order
+FIELDS = ('post_id', 'phpbb_id', 'author', 'created', 'text', 'html',
+          'thread_id', 'thread', 'thread_link', 'forum_id', 'forum', 'forum_link',
+          'attachments')
+
+ATTACHMENT_FIELDS = ('name', 'link', 'sha256', 'size')
+
+
+def _query(since=None, html=True):
+    posts, threads, forums = Post.__table__, Thread.__table__, Forum.__table__
+    attachments, authors, links = Attachment.__table__, Author.__table__, Link.__table__
+
+    # Posts and attachments may have been stored in either layout
+    columns = [posts.c.id, posts.c.phpbb_id,
+               func.coalesce(posts.c.author, authors.c.name), posts.c.created,
+               posts.c.text, posts.c.html if html else None,
+               threads.c.id, threads.c.name, threads.c.link,
+               forums.c.id, forums.c.name, forums.c.link,
+               attachments.c.name, func.coalesce(attachments.c.link, links.c.link),
+               attachments.c.sha256, attachments.c.size]
+    columns = [column for column in columns if column is not None]
+
+    query = (select(columns)
+            .select_from(posts
+                .outerjoin(authors, authors.c.id == posts.c.author_id)
+                .outerjoin(threads, threads.c.id == posts.c.thread_id)
+                .outerjoin(forums, forums.c.id == threads.c.forum_id)
+                .outerjoin(attachments, attachments.c.post_id == posts.c.id)
+                .outerjoin(links, links.c.id == attachments.c.link_id))
+            .order_by(posts.c.id, attachments.c.id))
+
+    if since is not None:
+        query = query.where(posts.c.created > since)
+
+    return query
+
+
+def _stream(engine, query, chunk_size):
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+
+
+def records(engine, since=None, html=True, chunk_size=1000):
+    """
+    Yield a dict (with the keys in ``FIELDS``) for every post created after
+    ``since``, or every post if it's ``None``.
+    """
+    fields = [f for f in FIELDS if html or f != 'html'][:-1]
+    rows = _stream(engine, _query(since, html), chunk_size)
+
+    # There's a row for each of a post's attachments (or one with them all
+    # NULL if it has none)
+    for _, group in groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        record = dict(zip(fields, group[0]))
+
+        attachments = (dict(zip(ATTACHMENT_FIELDS, row[len(fields):])) for row in group)
+        record['attachments'] = [a for a in attachments if a['link'] is not None]
+        yield record
+
+
+def _json_default(value):
+    # Datetimes are the only thing json can't already handle
+    return value.isoformat(sep=' ')
+
+
+def write_jsonl(records, output):
+    count = 0
+    for record in records:
+        output.write(json.dumps(record, default=_json_default))
+        output.write('\n')
+        count += 1
+    return count
+
+
+def parquet_schema(html=True):
+    import pyarrow as pa
+
+    attachment = pa.struct([('name', pa.string()), ('link', pa.string()),
+                            ('sha256', pa.string()), ('size', pa.int64())])
+    types = {
+            'post_id': pa.int64(), 'phpbb_id': pa.int64(), 'thread_id': pa.int64(),
+            'forum_id': pa.int64(), 'created': pa.timestamp('s'),
+            'attachments': pa.list_(attachment),
+            }
+
+    return pa.schema([(field, types.get(field, pa.string()))
+                      for field in FIELDS if html or field != 'html'])
+
+
+def write_parquet(records, location, html=True, row_group_size=10000):
+    """
+    Write records to a Parquet file one row group at a time, so no more than
+    ``row_group_size`` posts are ever held in memory.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema(html)
+    count = 0
+    batch = []
+
+    def write(writer, batch):
+        writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+
+    with pq.ParquetWriter(location, schema, compression='zstd') as writer:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= row_group_size:
+                write(writer, batch)
+                count += len(batch)
+                batch = []
+
+        if batch:
+            write(writer, batch)
+            count += len(batch)
+
+    return count
+
+
+def export(engine, location, format=None, since=None, html=True,
+        chunk_size=1000, logger=None):
+    """
+    Export every post (created after ``since``) to ``location`` as JSON lines
+    or Parquet, guessing the format from the file extension if it isn't
+    given. A ``location`` of ``-`` writes JSON lines to stdout.
+    """
+    logger = logger or logging.getLogger(__name__)
+    if format is None:
+        format = 'parquet' if location.endswith('.parquet') else 'jsonl'
+
+    posts = records(engine, since=since, html=html, chunk_size=chunk_size)
+
+    if format == 'parquet':
+        count = write_parquet(posts, location, html=html)
+    elif location == '-':
+        count = write_jsonl(posts, sys.stdout)
+    else:
+        with open(location, 'w', encoding='utf-8') as f:
+            count = write_jsonl(posts, f)
+
+    logger.info('Exported {} posts to {}'.format(count, location))
+    return count
@@ -0,0 +1,483 @@
+"""
+Keeping track of which URLs the spider has already seen, and which tasks it
+still has to do.
+
+Everything in the ``_urls`` table is bulk-loaded into memory when the spider
+starts so membership checks never need to touch the database. New URLs and
+task states are handed to the ``BatchWriter`` and persisted along with
+everything else.
+
+``Frontier`` decides what to fetch next: tasks come out in priority order,
+and once there are too many to keep in memory the least urgent are spilled
+to disk.
+"""
+import os
+import json
+import math
+import heapq
+import pickle
+import logging
+import hashlib
+import tempfile
+import threading
+import itertools
+from queue import Empty
+from datetime import datetime
+
+from sqlalchemy import (create_engine, event, select, func, MetaData, Table,
+        Column, Integer, LargeBinary)
+
+from .models import Url, CrawlTask, Crawl
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def url_hash(url):
+    """
+    A 64-bit digest of a URL. With a million URLs the chance of any two
+    colliding is about 1 in 30 million, which we're happy to live with.
+    """
+    digest = hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class BloomFilter:
+    """
+    A plain bit-array Bloom filter using double hashing to derive the
+    ``k`` bit positions from a single 128-bit digest.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self.bits.__sizeof__()
+
+
+class SeenUrls:
+    """
+    The set of URLs the spider has already queued.
+
+    By default this is a set of 64-bit URL hashes. Passing ``bloom_capacity``
+    swaps that for a Bloom filter which uses a fraction of the memory; a
+    "maybe" from the filter is then confirmed with an exact lookup against
+    the database (or the URLs still waiting to be flushed).
+    """
+
+    def __init__(self, engine, writer, bloom_capacity=None, error_rate=0.001,
+            logger=None):
+        self.engine = engine
+        self.writer = writer
+        self.logger = logger or logging.getLogger(__name__)
+
+        if bloom_capacity:
+            self._index = BloomFilter(bloom_capacity, error_rate)
+        else:
+            self._index = set()
+
+        # URLs the writer hasn't written yet, and those in each batch it's
+        # still writing (oldest first)
+        self._unflushed = set()
+        self._writing = []
+        self.writer.on_batch.append(self._batch_taken)
+        self.writer.on_flush.append(self._batch_written)
+
+    @property
+    def exact(self):
+        return not isinstance(self._index, BloomFilter)
+
+    def _key(self, url):
+        return url_hash(url) if self.exact else url
+
+    def load(self, chunk_size=10000):
+        """
+        Bulk-load every URL stored in the database.
+        """
+        count = 0
+
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                    select([Url.__table__.c.link]))
+
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+
+                for (link,) in rows:
+                    self._index.add(self._key(link))
+                count += len(rows)
+
+        self.logger.info('Loaded {} previously seen urls'.format(count))
+        return count
+
+    def _batch_taken(self):
+        self._writing.append(self._unflushed)
+        self._unflushed = set()
+
+    def _batch_written(self):
+        self._writing.pop(0)
+
+    def __contains__(self, url):
+        if self._key(url) not in self._index:
+            return False
+        if self.exact or url in self._unflushed:
+            return True
+        if any(url in batch for batch in list(self._writing)):
+            return True
+
+        # The bloom filter only ever gives us a "maybe"
+        with self.engine.connect() as conn:
+            found = conn.execute(select([Url.__table__.c.id]).where(
+                Url.__table__.c.link == url)).first()
+        return found is not None
+
+    def add(self, url):
+        """
+        Record a URL, returning ``True`` if we hadn't seen it before.
+        """
+        if url in self:
+            return False
+
+        self._index.add(self._key(url))
+        self._unflushed.add(url)
+        self.writer.add(Url, link=url)
+        return True
+
+
+class Checkpoint:
+    """
+    A durable record of every task the spider has queued, so a crawl which
+    dies part way through can pick up exactly where it left off.
+
+    Task states go through the ``BatchWriter`` alongside the rows the task
+    produced, so a task is only ever marked ``done`` in the same transaction
+    as (or after) the data it scraped. Tasks the spider gave up on are
+    ``failed``, which doesn't stop the crawl from finishing but does get
+    them tried again by the next ``--resume`` or ``--incremental`` crawl.
+    """
+    QUEUED = 'queued'
+    IN_FLIGHT = 'in_flight'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    #: The kinds of task worth checkpointing
+    names = {'forum', 'thread'}
+
+    #: The task attributes needed to recreate it
+    fields = ('title', 'forum', 'forum_id', 'parent_id', 'thread_id', 'page',
+              'replies', 'last_post', 'skip_posts', 'topics', 'posts', 'last_post_id')
+
+    def __init__(self, engine, writer, crawl_id=None, logger=None):
+        self.engine = engine
+        self.writer = writer
+        self.crawl_id = crawl_id
+        self.logger = logger or logging.getLogger(__name__)
+
+    def queued(self, task):
+        if task.name not in self.names or hasattr(task, 'checkpoint_id'):
+            return
+
+        params = {field: getattr(task, field) for field in self.fields
+                  if getattr(task, field, None) is not None}
+        if 'last_post' in params:
+            params['last_post'] = params['last_post'].strftime(TIMESTAMP_FORMAT)
+
+        task.checkpoint_id = self.writer.add(CrawlTask,
+                name=task.name,
+                url=task.url,
+                state=self.QUEUED,
+                params=json.dumps(params),
+                crawl_id=self.crawl_id)
+
+    def started(self, task):
+        if hasattr(task, 'checkpoint_id'):
+            self.writer.update(CrawlTask, task.checkpoint_id, state=self.IN_FLIGHT)
+
+    def done(self, task):
+        if hasattr(task, 'checkpoint_id'):
+            self.writer.update(CrawlTask, task.checkpoint_id, state=self.DONE)
+
+    def failed(self, task):
+        if hasattr(task, 'checkpoint_id'):
+            self.writer.update(CrawlTask, task.checkpoint_id, state=self.FAILED)
+
+    def pending(self):
+        """
+        Yield a ``(name, url, params)`` tuple for every task which was queued
+        or in flight when the last crawl stopped, or which failed.
+        """
+        table = CrawlTask.__table__
+        query = (select([table.c.id, table.c.name, table.c.url, table.c.params])
+                .where(table.c.state != self.DONE)
+                .order_by(table.c.id))
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+
+        self.logger.info('Resuming {} unfinished tasks'.format(len(rows)))
+
+        for task_id, name, url, params in rows:
+            params = json.loads(params)
+            if 'last_post' in params:
+                params['last_post'] = datetime.strptime(params['last_post'],
+                        TIMESTAMP_FORMAT)
+
+            params['checkpoint_id'] = task_id
+            yield name, url, params
+
+
+def start_crawl(engine, resume=False):
+    """
+    Record the start of a crawl, returning its id. Resuming carries on with
+    the last crawl if it never finished.
+    """
+    table = Crawl.__table__
+
+    with engine.begin() as conn:
+        if resume:
+            last = conn.execute(select([table.c.id, table.c.finished])
+                    .order_by(table.c.id.desc()).limit(1)).first()
+            if last is not None and last.finished is None:
+                return last.id
+
+        return conn.execute(table.insert(), started=datetime.now()).inserted_primary_key[0]
+
+
+def finish_crawl(engine, crawl_id):
+    """
+    Mark a crawl as finished if it queued anything and every task (its own
+    and any left over from earlier crawls) is done or failed, returning
+    whether it was.
+    """
+    tasks, crawls = CrawlTask.__table__, Crawl.__table__
+
+    with engine.begin() as conn:
+        queued = conn.execute(select([func.count()])
+                .where(tasks.c.crawl_id == crawl_id)).scalar()
+        unfinished = conn.execute(select([func.count()])
+                .where(tasks.c.state.in_([Checkpoint.QUEUED, Checkpoint.IN_FLIGHT]))).scalar()
+
+        finished = queued > 0 and unfinished == 0
+        if finished:
+            conn.execute(crawls.update().where(crawls.c.id == crawl_id)
+                    .values(finished=datetime.now()))
+
+    return finished
+
+
+def finished_crawls(engine):
+    """
+    The ids of every crawl which finished, and the newest post any of them
+    saw on the index when it started. Every post older than that has been
+    crawled.
+    """
+    table = Crawl.__table__
+
+    with engine.connect() as conn:
+        rows = conn.execute(select([table.c.id, table.c.newest_post])
+                .where(table.c.finished != None)).fetchall()
+
+    newest = [newest_post for _, newest_post in rows if newest_post is not None]
+    return {crawl_id for crawl_id, _ in rows}, max(newest, default=None)
+
+
+spill_metadata = MetaData()
+
+spilled_tasks = Table('spilled_tasks', spill_metadata,
+        Column('priority', Integer, primary_key=True),
+        Column('seq', Integer, primary_key=True),
+        Column('task', LargeBinary))
+
+
+def _fast_pragmas(dbapi_connection, connection_record):
+    # The spill file is thrown away at the end of the crawl anyway
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=OFF')
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.close()
+
+
+class Frontier:
+    """
+    A priority queue of tasks (lowest priority first, then first in first
+    out) which keeps at most ``max_size`` of them in memory.
+
+    When it overflows, the least urgent half is written out to a SQLite file
+    (``location``, or a temporary file) and read back in chunks once the
+    tasks in memory run out. Anything added which is no more urgent than the
+    best task on disk goes straight to disk too, so tasks still come out in
+    exactly the right order.
+
+    This is also a grab task queue backend (``put``/``get``/``size``/
+    ``clear``/``close``), so it can be used as a Spider's ``task_queue``.
+    Nothing is handed out while ``ready()`` is false, which lets the spider
+    hold back until it's caught up with the pages it already has.
+    """
+
+    def __init__(self, max_size=10000, location=None, default_priority=100,
+            ready=None, logger=None):
+        self.max_size = max(2, max_size)
+        self.default_priority = default_priority
+        self.ready = ready
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._lock = threading.RLock()
+        self._seq = itertools.count()
+        self._heap = []
+        self._overflow = []
+        self._spilled = 0
+        self._floor = None
+
+        self._location = location
+        self._engine = None
+        self._closed = False
+
+        self.peak_size = 0
+        self.spill_count = 0
+
+    def put(self, task, priority=None, schedule_time=None):
+        # schedule_time is part of grab's interface, but we never delay tasks
+        if priority is None:
+            priority = self.default_priority
+        entry = (priority, next(self._seq), task)
+
+        with self._lock:
+            if self._floor is not None and entry[:2] >= self._floor:
+                self._overflow.append(entry)
+                if len(self._overflow) >= self.max_size // 2:
+                    self._spill(self._overflow)
+                    self._overflow = []
+            else:
+                heapq.heappush(self._heap, entry)
+                if len(self._heap) > self.max_size:
+                    self._spill_worst()
+
+            self.peak_size = max(self.peak_size, self.size())
+
+    def get(self):
+        """
+        The most urgent task, raising ``queue.Empty`` if there aren't any
+        (or we're not ready for another).
+        """
+        if self.ready is not None and not self.ready():
+            raise Empty()
+
+        with self._lock:
+            if not self._heap and (self._spilled or self._overflow):
+                self._load()
+            if not self._heap:
+                raise Empty()
+            return heapq.heappop(self._heap)[2]
+
+    def done(self, task):
+        # Tasks are forgotten as soon as they're handed out
+        pass
+
+    def size(self):
+        with self._lock:
+            return len(self._heap) + len(self._overflow) + self._spilled
+
+    __len__ = size
+
+    def _connect(self):
+        if self._engine is None:
+            if self._location is None:
+                fd, self._location = tempfile.mkstemp(suffix='.sqlite', prefix='frontier-')
+                os.close(fd)
+                self._temporary = True
+            else:
+                self._temporary = False
+
+            self._engine = create_engine('sqlite:///{}'.format(self._location))
+            event.listen(self._engine, 'connect', _fast_pragmas)
+            spill_metadata.drop_all(self._engine)
+            spill_metadata.create_all(self._engine)
+
+        return self._engine
+
+    def _spill(self, entries):
+        with self._connect().begin() as conn:
+            conn.execute(spilled_tasks.insert(), [
+                {'priority': priority, 'seq': seq, 'task': pickle.dumps(task)}
+                for priority, seq, task in entries])
+
+        self._spilled += len(entries)
+        self.spill_count += len(entries)
+        lowest = min(entry[:2] for entry in entries)
+        self._floor = lowest if self._floor is None else min(self._floor, lowest)
+
+    def _spill_worst(self):
+        entries = sorted(self._heap)
+        keep = self.max_size // 2
+        self._heap = entries[:keep]
+        self._spill(entries[keep:])
+        self.logger.debug('Spilled {} tasks to disk'.format(len(entries) - keep))
+
+    def _load(self):
+        if self._overflow:
+            self._spill(self._overflow)
+            self._overflow = []
+
+        with self._connect().begin() as conn:
+            rows = conn.execute(select([spilled_tasks])
+                    .order_by(spilled_tasks.c.priority, spilled_tasks.c.seq)
+                    .limit(self.max_size // 2)).fetchall()
+            if rows:
+                # Everything up to and including the last row we loaded
+                last = rows[-1]
+                conn.execute(spilled_tasks.delete().where(
+                    (spilled_tasks.c.priority < last.priority) |
+                    ((spilled_tasks.c.priority == last.priority) &
+                     (spilled_tasks.c.seq <= last.seq))))
+            floor = conn.execute(select([spilled_tasks.c.priority, spilled_tasks.c.seq])
+                    .order_by(spilled_tasks.c.priority, spilled_tasks.c.seq)
+                    .limit(1)).first()
+
+        self._heap = [(row.priority, row.seq, pickle.loads(row.task)) for row in rows]
+        heapq.heapify(self._heap)
+        self._spilled -= len(rows)
+        self._floor = tuple(floor) if floor is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+            self._overflow = []
+            self._spilled = 0
+            self._floor = None
+            if self._engine is not None:
+                with self._engine.begin() as conn:
+                    conn.execute(spilled_tasks.delete())
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+            if self._engine is not None:
+                self._engine.dispose()
+                self._engine = None
+                if self._temporary:
+                    os.remove(self._location)
+
+            self.logger.info('Frontier: at most {} tasks queued, {} spilled to disk'.format(
+                self.peak_size, self.spill_count))
@@ -0,0 +1,351 @@
+"""
+Loading the tire test data attached to posts into NumPy arrays.
+
+The TTC's runs are plain text: a line or two describing the run, a row of
+channel names, usually a row of units, then one row of numbers per sample
+separated by tabs, commas or spaces. A single run can be hundreds of
+megabytes, so files are read ``chunk_size`` bytes at a time and each chunk
+is parsed in one go by NumPy's C parser rather than a line (or a number) at a
+time in Python, keeping memory use flat however big the file is.
+
+Each channel is written to its own ``.npy`` file, in a directory named after
+the SHA-256 of the file it came from (like the downloads themselves), and
+the ``test_runs`` table records which channels each file had. ``open_run()``
+memory-maps them by attachment id, so a 1 GB run opens instantly and only
+the parts which are actually used are ever read from disk.
+"""
+import io
+import os
+import re
+import json
+import shutil
+import struct
+import logging
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+from sqlalchemy import select, func, or_
+
+from .models import Attachment, TestRun
+from .downloader import downloaded_path
+
+
+#: Attachments with these extensions are assumed to be data files
+EXTENSIONS = ('.dat', '.txt', '.csv', '.asc')
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+#: Every ``.npy`` file gets a header this long, so it can be rewritten once
+#: we know how many rows there are
+HEADER_SIZE = 128
+
+Header = namedtuple('Header', 'description names units delimiter')
+
+
+def _delimiter(line):
+    for delimiter in ('\t', ','):
+        if delimiter in line:
+            return delimiter
+    return None
+
+
+def _split(line, delimiter):
+    if delimiter is None:
+        return line.split()
+    return [field.strip() for field in line.split(delimiter)]
+
+
+def _numeric(fields):
+    try:
+        for field in fields:
+            float(field)
+    except ValueError:
+        return False
+    return bool(fields)
+
+
+def read_header(f, max_lines=50):
+    """
+    Read up to the first row of numbers in a file, returning its ``Header``
+    and the first row (still as bytes).
+    """
+    labels = []
+
+    for _ in range(max_lines):
+        line = f.readline()
+        if not line:
+            break
+
+        text = line.decode('latin-1').rstrip('\r\n')
+        if not text.strip():
+            continue
+
+        delimiter = _delimiter(text)
+        fields = _split(text, delimiter)
+        if _numeric(fields):
+            return _header(labels, len(fields), delimiter), line
+
+        labels.append(text)
+
+    raise ValueError('No numbers in the first {} lines'.format(max_lines))
+
+
+def _header(labels, width, delimiter):
+    # The channel names (and their units, if there's a line of them) are
+    # whichever lines just before the numbers have a field for each column
+    split = [_split(label, delimiter) for label in labels]
+    names = units = None
+
+    if split and len(split[-1]) == width:
+        if len(split) > 1 and len(split[-2]) == width:
+            names, units = split[-2], split[-1]
+            labels = labels[:-2]
+        else:
+            names = split[-1]
+            labels = labels[:-1]
+
+    if names is None:
+        names = ['channel{}'.format(i) for i in range(width)]
+    if units is None:
+        units = [''] * width
+
+    return Header('\n'.join(label.strip() for label in labels), names, units, delimiter)
+
+
+def read_rows(f, width, delimiter=None, first=b'', chunk_size=CHUNK_SIZE, dtype=np.float64):
+    """
+    Parse the rest of a file ``chunk_size`` bytes at a time, yielding each
+    chunk's rows as a 2D array with ``width`` columns.
+    """
+    leftover = first
+
+    while True:
+        data = f.read(chunk_size)
+        chunk = leftover + data
+
+        if data:
+            # Only parse whole lines, leaving the last partial one for later
+            end = chunk.rfind(b'\n') + 1
+            if not end:
+                leftover = chunk
+                continue
+            chunk, leftover = chunk[:end], chunk[end:]
+
+        if chunk.strip():
+            yield _parse(chunk, width, delimiter, dtype)
+
+        if not data:
+            break
+
+
+def _parse(chunk, width, delimiter, dtype):
+    try:
+        values = np.loadtxt(io.BytesIO(chunk), dtype=dtype, delimiter=delimiter,
+                comments=None, ndmin=2, encoding='latin-1')
+    except ValueError:
+        values = None
+
+    if values is None or values.shape[1] != width:
+        # Empty fields, a missing value or something that isn't a number
+        return _parse_slowly(chunk, width, delimiter, dtype)
+
+    return values
+
+
+def _parse_slowly(chunk, width, delimiter, dtype):
+    rows = []
+
+    for line in chunk.decode('latin-1').splitlines():
+        if not line.strip():
+            continue
+
+        fields = _split(line, delimiter)
+        if len(fields) != width:
+            raise ValueError('Expected {} values but found {}: {!r}'.format(width,
+                len(fields), line[:80]))
+
+        try:
+            rows.append([float(field) if field else np.nan for field in fields])
+        except ValueError:
+            raise ValueError('Not a row of numbers: {!r}'.format(line[:80]))
+
+    return np.array(rows, dtype=dtype).reshape(-1, width)
+
+
+def _npy_header(dtype, rows):
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+            dtype.str, rows)
+    header = header.ljust(HEADER_SIZE - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin-1')
+
+
+def _file_names(names):
+    files = []
+    seen = set()
+
+    for i, name in enumerate(names):
+        file = re.sub(r'[^\w.-]+', '_', name).strip('._') or 'channel{}'.format(i)
+        if file.lower() in seen:
+            file = '{}_{}'.format(file, i)
+        seen.add(file.lower())
+        files.append(file + '.npy')
+
+    return files
+
+
+def _write_channels(f, header, first, directory, files, chunk_size, dtype):
+    outputs = [open(os.path.join(directory, file), 'wb') for file in files]
+    rows = 0
+
+    try:
+        for output in outputs:
+            output.write(_npy_header(dtype, 0))
+
+        for block in read_rows(f, len(files), header.delimiter, first,
+                chunk_size=chunk_size, dtype=dtype):
+            columns = np.ascontiguousarray(block.T)
+            for output, column in zip(outputs, columns):
+                output.write(column)
+            rows += len(block)
+
+        for output in outputs:
+            output.seek(0)
+            output.write(_npy_header(dtype, rows))
+    finally:
+        for output in outputs:
+            output.close()
+
+    return rows
+
+
+def ingest_file(source, destination, chunk_size=CHUNK_SIZE, dtype=np.float64):
+    """
+    Parse a data file into a directory with a ``.npy`` file per channel,
+    returning its ``Header``, the channels' file names and the number of
+    rows. Nothing is left at ``destination`` unless it all worked.
+    """
+    dtype = np.dtype(dtype)
+    partial = destination + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+
+    try:
+        with open(source, 'rb') as f:
+            header, first = read_header(f)
+            files = _file_names(header.names)
+            rows = _write_channels(f, header, first, partial, files, chunk_size, dtype)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    shutil.rmtree(destination, ignore_errors=True)
+    os.rename(partial, destination)
+    return header, files, rows
+
+
+def run_path(directory, sha256):
+    return os.path.join(directory, sha256[:2], sha256)
+
+
+def pending(engine, extensions=EXTENSIONS, force=False):
+    """
+    The SHA-256 and name of every downloaded data file which hasn't been
+    ingested yet (or all of them, if ``force``).
+    """
+    attachments, runs = Attachment.__table__, TestRun.__table__
+    query = (select([attachments.c.sha256, func.min(attachments.c.name)])
+            .where(attachments.c.sha256 != None)
+            .where(or_(*[func.lower(attachments.c.name).like('%' + extension)
+                         for extension in extensions]))
+            .group_by(attachments.c.sha256)
+            .order_by(attachments.c.sha256))
+    if not force:
+        query = query.where(~attachments.c.sha256.in_(select([runs.c.sha256])))
+
+    with engine.connect() as conn:
+        return conn.execute(query).fetchall()
+
+
+def ingest(engine, attachments, directory, chunk_size=CHUNK_SIZE, dtype=np.float64,
+        force=False, logger=None):
+    """
+    Ingest every data file downloaded into ``attachments`` which hasn't been
+    already, writing each one's channels under ``directory``. Returns the
+    number of files ingested and the number which couldn't be.
+    """
+    logger = logger or logging.getLogger(__name__)
+    table = TestRun.__table__
+    files = pending(engine, force=force)
+    logger.info('Ingesting {} data files'.format(len(files)))
+    ingested = failed = 0
+
+    for sha256, name in files:
+        source = downloaded_path(attachments, sha256)
+        values = dict(sha256=sha256, description=None, channels=None, rows=None, error=None)
+
+        try:
+            header, channels, rows = ingest_file(source, run_path(directory, sha256),
+                    chunk_size=chunk_size, dtype=dtype)
+        except (OSError, ValueError) as e:
+            logger.warning('Unable to ingest {} ({}): {}'.format(name, sha256, e))
+            values.update(error=str(e))
+            failed += 1
+        else:
+            logger.info('Ingested {}: {} channels, {} rows'.format(name, len(channels), rows))
+            values.update(description=header.description, rows=rows,
+                    channels=json.dumps(list(zip(header.names, header.units, channels))))
+            ingested += 1
+
+        with engine.begin() as conn:
+            conn.execute(table.insert().prefix_with('OR REPLACE'), values)
+
+    logger.info('Ingested {} data files, {} failed'.format(ingested, failed))
+    return ingested, failed
+
+
+class Run:
+    """
+    The channels of an ingested data file, memory-mapped from their
+    ``.npy`` files. Indexing by channel name gives a read-only array.
+    """
+
+    def __init__(self, directory, description, channels, rows):
+        self.description = description
+        self.rows = rows
+        self.units = OrderedDict((name, unit) for name, unit, _ in channels)
+        self.channels = OrderedDict(
+                (name, np.load(os.path.join(directory, file), mmap_mode='r'))
+                for name, _, file in channels)
+
+    def __getitem__(self, name):
+        return self.channels[name]
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __len__(self):
+        return self.rows
+
+    def __repr__(self):
+        return '<{}: {} channels, {} rows>'.format(self.__class__.__name__,
+                len(self.channels), self.rows)
+
+
+def open_run(engine, directory, attachment_id):
+    """
+    The ``Run`` read from an attachment, or ``None`` if it hasn't been
+    ingested (or wasn't a data file).
+    """
+    attachments, runs = Attachment.__table__, TestRun.__table__
+    query = (select([runs.c.sha256, runs.c.description, runs.c.channels, runs.c.rows])
+            .select_from(attachments.join(runs, runs.c.sha256 == attachments.c.sha256))
+            .where(attachments.c.id == attachment_id)
+            .where(runs.c.error == None))
+
+    with engine.connect() as conn:
+        row = conn.execute(query).first()
+
+    if row is None:
+        return None
+    return Run(run_path(directory, row.sha256), row.description,
+            json.loads(row.channels), row.rows)
@@ -0,0 +1,264 @@
+"""
+Counting where a crawl's time goes.
+
+``Metrics`` keeps counters, gauges (read from a callable when needed) and
+latency histograms, and can render them as a one-line summary for the log or
+in the Prometheus text format. ``serve()`` makes the latter available over
+HTTP on localhost, so a crawl can be watched (or scraped) while it runs.
+
+``TaskProfiler`` keeps a cProfile profile per task type. The ``.prof`` files
+it writes can be read with ``pstats`` or turned into a flamegraph with e.g.
+flameprof or snakeviz.
+"""
+import os
+import time
+import bisect
+import logging
+import cProfile
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+#: Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'ttc_handler_seconds': 'Time spent in each task handler',
+    'ttc_fetch_seconds': 'Time taken to fetch each page',
+    'ttc_parse_seconds': 'Time taken to parse each page',
+    'ttc_db_flush_seconds': 'Time taken to write each batch to the database',
+    'ttc_requests_started_total': 'Requests sent',
+    'ttc_responses_total': 'Responses handled',
+    'ttc_downloaded_bytes_total': 'Bytes of response bodies received',
+    'ttc_queue_depth': 'Tasks waiting to be started',
+    'ttc_in_flight': "Requests sent whose responses haven't been handled yet",
+    'ttc_parse_pending': 'Pages waiting to be parsed by worker processes',
+    'ttc_rate_window': "The rate limiter's congestion window",
+}
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """
+        An upper bound on the ``q``th quantile: the top of the bucket it's in.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.gauges = OrderedDict()
+        self.started = time.monotonic()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def gauge(self, name, function):
+        """
+        Report whatever ``function()`` returns as the value of ``name``.
+        """
+        self.gauges[name] = function
+
+    def total(self, name):
+        with self._lock:
+            return sum(value for (n, _), value in self.counters.items() if n == name)
+
+    def render(self):
+        """
+        Everything, in the Prometheus text exposition format.
+        """
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP {} {}'.format(name, HELP.get(name, name)))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        def by_name(item):
+            return item[0][0]
+
+        # Every sample of a metric has to come straight after its description
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items(), key=by_name):
+                describe(name, 'counter')
+                lines.append('{}{} {}'.format(name, _labels(labels), value))
+
+            for (name, labels), histogram in sorted(self.histograms.items(), key=by_name):
+                describe(name, 'histogram')
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name,
+                        _labels(labels + (('le', bound),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), histogram.count))
+
+        for name, function in self.gauges.items():
+            describe(name, 'gauge')
+            lines.append('{} {}'.format(name, function()))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        A one line overview, for logging every now and then. Latencies are
+        given as mean/95th percentile.
+        """
+        elapsed = time.monotonic() - self.started
+        responses = self.total('ttc_responses_total')
+        parts = ['{} pages ({:.1f}/s), {:.1f} MB'.format(responses,
+            responses / elapsed if elapsed else 0,
+            self.total('ttc_downloaded_bytes_total') / 1024 / 1024)]
+
+        parts += ['{} {}'.format(name.replace('ttc_', '').replace('_', ' '), function())
+                  for name, function in self.gauges.items()]
+
+        with self._lock:
+            for (name, labels), histogram in self.histograms.items():
+                label = ' '.join(str(v) for _, v in labels)
+                parts.append('{}{} {:.1f}/{:.0f}ms'.format(
+                    name.replace('ttc_', '').replace('_seconds', '').replace('_', ' '),
+                    ' ' + label if label else '',
+                    histogram.mean * 1000, histogram.quantile(0.95) * 1000))
+
+        return ', '.join(parts)
+
+    def report_every(self, interval, logger):
+        """
+        Log the summary every ``interval`` seconds, until the returned event
+        is set.
+        """
+        stop = threading.Event()
+
+        def report():
+            while not stop.wait(interval):
+                logger.info('Stats: {}'.format(self.summary()))
+
+        threading.Thread(target=report, name='metrics-report', daemon=True).start()
+        return stop
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(metrics, port, host='127.0.0.1'):
+    """
+    Serve ``metrics`` at ``http://host:port/metrics`` from a background
+    thread, returning the server so it can be shut down.
+    """
+    handler = type('Handler', (MetricsHandler,), {'metrics': metrics})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+class TaskProfiler:
+    """
+    A cProfile profile for each type of task, written to
+    ``directory/<task>.prof``.
+    """
+
+    def __init__(self, directory, logger=None):
+        self.directory = directory
+        self.logger = logger or logging.getLogger(__name__)
+        self.profiles = {}
+
+    def __getitem__(self, name):
+        if name not in self.profiles:
+            self.profiles[name] = cProfile.Profile()
+        return self.profiles[name]
+
+    def dump(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        for name, profile in self.profiles.items():
+            location = os.path.join(self.directory, '{}.prof'.format(name))
+            profile.dump_stats(location)
+            self.logger.info('Wrote the profile of {} tasks to {}'.format(name, location))
+
+
+def timed(results, metrics, name, profile=None):
+    """
+    Iterate over a task handler's ``results``, recording how long the
+    handler itself spent producing them (but not whatever the caller does
+    with each one) and profiling it if a ``profile`` is given.
+    """
+    iterator = iter(results or ())
+    elapsed = 0.0
+
+    try:
+        while True:
+            start = time.perf_counter()
+            if profile is not None:
+                profile.enable()
+            try:
+                result = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                if profile is not None:
+                    profile.disable()
+                elapsed += time.perf_counter() - start
+
+            yield result
+    finally:
+        metrics.observe('ttc_handler_seconds', elapsed, task=name)
@@ -0,0 +1,224 @@
+"""
+One-off migrations for existing scraper databases.
+
+    python -m ttc_scraper.migrations records.sqlite
+"""
+import os
+import sys
+import argparse
+from collections import OrderedDict
+
+from sqlalchemy import create_engine, select, inspect, func, bindparam
+
+from .models import (Base, Forum, Thread, Post, Url, Attachment, Author, Link,
+        compress_text)
+from .urls import canonical_url
+from .search import rebuild_index
+
+
+def upgrade(engine):
+    """
+    ``create_all()`` won't touch tables which already exist, so bring older
+    databases up to date by adding any columns and indexes they're missing.
+    Returns a list of the changes which were made.
+    """
+    changes = []
+
+    with engine.begin() as conn:
+        search_index = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'post_search'").scalar()
+        if search_index is not None and 'content=' not in search_index:
+            # Older indexes kept their own copy of every post's text
+            conn.execute('DROP TABLE post_search')
+            changes.append('dropped the old search index')
+
+    # The search index's view and triggers (and the other DDL run by
+    # create_all) refer to newer columns, so those have to exist first
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, column.name, column.type.compile(engine.dialect)))
+                changes.append('added column {}.{}'.format(table.name, column.name))
+
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+
+    if search_index is None or 'content=' not in search_index:
+        changes.append('indexed {} posts for search'.format(rebuild_index(engine)))
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {i['name'] for i in inspector.get_indexes(table.name)}
+
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+
+                if index.name == 'ix_attachments_post_link':
+                    removed = remove_duplicate_attachments(conn)
+                    changes.append('removed {} duplicate attachments'.format(removed))
+
+                index.create(conn)
+                changes.append('created index {}'.format(index.name))
+
+    return changes
+
+
+def remove_duplicate_attachments(conn):
+    """
+    Older crawls could record the same attachment on a post several times,
+    which would stop the ``(post_id, link)`` unique index being created.
+    """
+    table = Attachment.__table__
+    keep = select([func.min(table.c.id)]).group_by(table.c.post_id, table.c.link)
+    return conn.execute(table.delete().where(~table.c.id.in_(keep))).rowcount
+
+
+def _chunks(items, size=500):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def _collapse(conn, table, references):
+    """
+    Rewrite every ``link`` in a table to its canonical form, merging rows
+    which turn out to be the same page into the oldest one and pointing any
+    ``references`` (foreign key columns) at the survivor.
+    """
+    groups = OrderedDict()
+    query = select([table.c.id, table.c.link]).order_by(table.c.id)
+    for row_id, link in conn.execute(query):
+        groups.setdefault(canonical_url(link), []).append((row_id, link))
+
+    removed = 0
+
+    for canonical, rows in groups.items():
+        keep_id, keep_link = rows[0]
+        duplicates = [row_id for row_id, _ in rows[1:]]
+
+        for chunk in _chunks(duplicates):
+            for column in references:
+                conn.execute(column.table.update()
+                        .where(column.in_(chunk))
+                        .values({column.name: keep_id}))
+            conn.execute(table.delete().where(table.c.id.in_(chunk)))
+        removed += len(duplicates)
+
+        if keep_link != canonical:
+            conn.execute(table.update()
+                    .where(table.c.id == keep_id)
+                    .values(link=canonical))
+
+    return removed
+
+
+def canonicalise_urls(engine):
+    """
+    Collapse the near-duplicate ``_urls``, ``forums`` and ``threads`` rows
+    left behind by crawls which didn't canonicalise their links. Returns the
+    number of rows removed from each table.
+    """
+    forums, threads = Forum.__table__, Thread.__table__
+
+    with engine.begin() as conn:
+        return OrderedDict([
+            ('_urls', _collapse(conn, Url.__table__, [])),
+            ('forums', _collapse(conn, forums, [threads.c.forum_id, forums.c.parent_id])),
+            ('threads', _collapse(conn, threads, [Post.__table__.c.thread_id])),
+        ])
+
+
+def compact(engine, chunk_size=500):
+    """
+    Move every post and attachment over to the compact layout (see
+    ``writer.CompactStorage``), then reclaim the space. Returns the number of
+    posts whose HTML was compressed.
+    """
+    posts, authors = Post.__table__, Author.__table__
+    attachments, links = Attachment.__table__, Link.__table__
+
+    with engine.begin() as conn:
+        # Authors' names aren't changing, so don't make the search index
+        # rewrite every post. create_all() below puts the trigger back.
+        conn.execute('DROP TRIGGER IF EXISTS post_search_update')
+
+        conn.execute(authors.insert().prefix_with('OR IGNORE').from_select(['name'],
+            select([posts.c.author]).where(posts.c.author != None).distinct()))
+        conn.execute(posts.update()
+                .where(posts.c.author != None)
+                .values(author=None, author_id=select([authors.c.id])
+                    .where(authors.c.name == posts.c.author).as_scalar()))
+
+        conn.execute(links.insert().prefix_with('OR IGNORE').from_select(['link'],
+            select([attachments.c.link]).where(attachments.c.link != None).distinct()))
+        conn.execute(attachments.update()
+                .where(attachments.c.link != None)
+                .values(link=None, link_id=select([links.c.id])
+                    .where(links.c.link == attachments.c.link).as_scalar()))
+
+    Base.metadata.create_all(engine)
+
+    compressed = 0
+    last_id = 0
+    update = (posts.update()
+            .where(posts.c.id == bindparam('_id'))
+            .values(html=bindparam('_html')))
+
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select([posts.c.id, posts.c.html])
+                    .where(posts.c.id > last_id)
+                    .where(func.typeof(posts.c.html) == 'text')
+                    .order_by(posts.c.id)
+                    .limit(chunk_size)).fetchall()
+            if not rows:
+                break
+
+            conn.execute(update, [{'_id': post_id, '_html': compress_text(html)}
+                                  for post_id, html in rows])
+
+        compressed += len(rows)
+        last_id = rows[-1][0]
+
+    with engine.connect() as conn:
+        conn.execute('VACUUM')
+
+    return compressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Migrate a scraper database')
+    parser.add_argument('database', type=str, help='The database to migrate')
+    parser.add_argument('--compact', dest='compact', action='store_true',
+                        help='Convert it to the compact layout and report how much space was saved')
+    args = parser.parse_args(argv)
+
+    engine = create_engine('sqlite:///{}'.format(args.database))
+
+    for change in upgrade(engine):
+        print(change)
+
+    for table, removed in canonicalise_urls(engine).items():
+        print('{}: collapsed {} duplicate rows'.format(table, removed))
+
+    if args.compact:
+        before = os.path.getsize(args.database)
+        print('compressed the HTML of {} posts'.format(compact(engine)))
+        after = os.path.getsize(args.database)
+
+        print('{}: {:.1f} MB -> {:.1f} MB ({:.0%} smaller)'.format(args.database,
+            before / 1024 / 1024, after / 1024 / 1024, 1 - after / before if before else 0))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
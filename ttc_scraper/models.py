@@ -1,13 +1,36 @@
+import zlib
+
 from sqlalchemy import Table, Column, Integer, ForeignKey
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import String, Column, Integer, ForeignKey, Text, DateTime
+from sqlalchemy import String, Column, Integer, ForeignKey, Text, DateTime, Index
+from sqlalchemy import BigInteger, LargeBinary, DDL, event
+from sqlalchemy.types import TypeDecorator
 
 
 
 Base = declarative_base()
 
 
+def compress_text(text):
+    return zlib.compress(text.encode('utf-8')) if text is not None else None
+
+
+class CompressibleText(TypeDecorator):
+    """
+    Text which may be stored zlib-compressed. Plain strings are stored and
+    read back as-is, and anything compressed with ``compress_text()`` comes
+    back as the original string, so old and compact rows can sit side by
+    side.
+    """
+    impl = Text
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            return zlib.decompress(value).decode('utf-8')
+        return value
+
+
 class Forum(Base):
     __tablename__ = 'forums'
 
@@ -16,6 +39,14 @@ class Forum(Base):
     link = Column(String(128), index=True, unique=True)
 
     child_threads = relationship('Thread')
+
+    #: What the parent forum's listing said about this forum (and its
+    #: sub-forums) when the ``crawl_id`` crawl last read it
+    topics = Column(Integer)
+    posts = Column(Integer)
+    last_post = Column(DateTime)
+    last_post_id = Column(Integer)
+    crawl_id = Column(Integer)
     
     parent_id = Column(Integer, ForeignKey('forums.id'))
     parent = relationship('Forum')
@@ -28,10 +59,15 @@ class Forum(Base):
 
 class Thread(Base):
     __tablename__ = 'threads'
+    __table_args__ = (
+            Index('ix_threads_forum', 'forum_id'),
+            )
 
     id = Column(Integer, primary_key=True)
     name = Column(String(64), index=True)
     link = Column(String(128), index=True, unique=True)
+    replies = Column(Integer)
+    last_post = Column(DateTime)
 
     forum_id = Column(Integer, ForeignKey('forums.id'))
     forums = relationship('Forum', backref='threads')
@@ -44,13 +80,24 @@ class Thread(Base):
 
 class Post(Base):
     __tablename__ = 'posts'
+    #: For paging through posts by thread or by time (see ``queries``); the
+    #: id comes along for free as the rowid
+    __table_args__ = (
+            Index('ix_posts_thread_created', 'thread_id', 'created'),
+            Index('ix_posts_created', 'created'),
+            )
 
     id = Column(Integer, primary_key=True)
+    phpbb_id = Column(Integer, index=True, unique=True)
     author = Column(String(20), unique=False)
     created = Column(DateTime)
-    html = Column(Text)
+    html = Column(CompressibleText)
     text = Column(Text)
 
+    #: Compact rows leave ``author`` empty and point at the author instead
+    author_id = Column(Integer, ForeignKey('authors.id'))
+    authors = relationship('Author', backref='posts')
+
     thread_id = Column(Integer, ForeignKey('threads.id'))
     threads = relationship('Thread', backref='posts')
 
@@ -61,6 +108,31 @@ class Post(Base):
                 self.created)
 
 
+class Author(Base):
+    __tablename__ = 'authors'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(20), index=True, unique=True)
+
+    def __repr__(self):
+        return '<{}: {}>'.format(
+                self.__class__.__name__,
+                self.name)
+
+
+class Link(Base):
+    """
+    Attachment links, stored once no matter how many posts they're in.
+    """
+    __tablename__ = 'links'
+    id = Column(Integer, primary_key=True)
+    link = Column(String(128), index=True, unique=True)
+
+    def __repr__(self):
+        return '<{}: {}>'.format(
+                self.__class__.__name__,
+                self.link)
+
+
 class Url(Base):
     __tablename__ = '_urls'
     id = Column(Integer, primary_key=True)
@@ -72,17 +144,226 @@ class Url(Base):
                 self.link)
 
 
+class CrawlTask(Base):
+    __tablename__ = '_tasks'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(16))
+    url = Column(String(128), index=True, unique=True)
+    state = Column(String(16), index=True)
+    params = Column(Text)
+    crawl_id = Column(Integer, index=True)
+
+    def __repr__(self):
+        return '<{}: {} {} ({})>'.format(
+                self.__class__.__name__,
+                self.name,
+                self.url,
+                self.state)
+
+
+class Crawl(Base):
+    """
+    One run of the spider (carried on by any ``--resume``). It only counts
+    as ``finished`` once every task it queued is done, so anything it
+    recorded about the forum can be trusted by later crawls.
+    """
+    __tablename__ = '_crawls'
+    id = Column(Integer, primary_key=True)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+    #: The time of the newest post on the index when the crawl started, by
+    #: the forum's clock
+    newest_post = Column(DateTime)
+
+    def __repr__(self):
+        return '<{}: {} ({} - {})>'.format(
+                self.__class__.__name__,
+                self.id,
+                self.started,
+                self.finished)
+
+
+class IdRange(Base):
+    """
+    The next free primary key of each table, so writers in several processes
+    can reserve blocks of ids without handing out the same one twice.
+    """
+    __tablename__ = '_ids'
+    name = Column(String(32), primary_key=True)
+    next_id = Column(Integer)
+
+    def __repr__(self):
+        return '<{}: {} {}>'.format(
+                self.__class__.__name__,
+                self.name,
+                self.next_id)
+
+
+class SharedTask(Base):
+    """
+    A task in the frontier shared by the workers of a sharded crawl.
+    """
+    __tablename__ = '_frontier'
+    __table_args__ = (
+            Index('ix_frontier_task', 'name', 'url', unique=True),
+            Index('ix_frontier_claim', 'shard', 'state', 'priority', 'id'),
+            )
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(16))
+    url = Column(String(128))
+    shard = Column(Integer)
+    priority = Column(Integer)
+    state = Column(String(16), index=True)
+    worker = Column(Integer)
+    task = Column(LargeBinary)
+
+    def __repr__(self):
+        return '<{}: {} {} (shard {}, {})>'.format(
+                self.__class__.__name__,
+                self.name,
+                self.url,
+                self.shard,
+                self.state)
+
+
+class LoginSession(Base):
+    """
+    The cookies from logging in, for the other workers of a sharded crawl.
+    """
+    __tablename__ = '_session'
+    id = Column(Integer, primary_key=True)
+    cookies = Column(LargeBinary)
+
+
+class TestRun(Base):
+    """
+    The channels read from a downloaded tire test data file, which are kept
+    as ``.npy`` files (see ``ingest``). Files which couldn't be read get a
+    row with the ``error`` instead, so they aren't tried again.
+    """
+    __tablename__ = 'test_runs'
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String(64), index=True, unique=True)
+    description = Column(Text)
+    #: A JSON list of each channel's name, unit and file
+    channels = Column(Text)
+    rows = Column(BigInteger)
+    error = Column(Text)
+
+    def __repr__(self):
+        return '<{}: {} ({} rows)>'.format(
+                self.__class__.__name__,
+                self.sha256,
+                self.rows)
+
+
 class Attachment(Base):
     __tablename__ = 'attachments'
+    __table_args__ = (
+            Index('ix_attachments_post_link', 'post_id', 'link', unique=True),
+            Index('ix_attachments_post_link_id', 'post_id', 'link_id', unique=True),
+            )
 
     id = Column(Integer, primary_key=True)
     link = Column(String(128), index=True)
     name = Column(String(64), index=True)
+    sha256 = Column(String(64), index=True)
+    size = Column(BigInteger)
 
     post_id = Column(Integer, ForeignKey('posts.id'))
     posts = relationship('Post', backref='attachments')
 
+    #: Compact rows leave ``link`` empty and point at the link instead
+    link_id = Column(Integer, ForeignKey('links.id'))
+    links = relationship('Link', backref='attachments')
+
     def __repr__(self):
         return '<{}: {}>'.format(
                 self.__class__.__name__,
                 self.name)
+
+
+#: A full-text index over every post's text and author, and the title of the
+#: thread it's in. SQLAlchemy can't describe FTS5 virtual tables, so it (and
+#: everything below) is created with raw DDL whenever the rest of the schema
+#: is; the view and triggers are recreated each time so older databases pick
+#: up any changes.
+#:
+#: The index reads the text back out of ``posts`` (through the
+#: ``post_search_source`` view) rather than keeping a copy of its own, so it
+#: has to be told exactly what to forget when a post changes. Triggers do
+#: that in the same transaction as each batch of posts is written. Title
+#: matches count double and author matches half when ranking.
+def _author(row):
+    return 'COALESCE({0}.author, (SELECT name FROM authors WHERE id = {0}.author_id))'.format(row)
+
+
+def _title(row):
+    return '(SELECT name FROM threads WHERE id = {}.thread_id)'.format(row)
+
+
+def _index(row):
+    return """INSERT INTO post_search(rowid, text, author, title)
+        VALUES ({0}.id, {0}.text, {1}, {2});""".format(row, _author(row), _title(row))
+
+
+def _forget(row):
+    return """INSERT INTO post_search(post_search, rowid, text, author, title)
+        VALUES ('delete', {0}.id, {0}.text, {1}, {2});""".format(row, _author(row), _title(row))
+
+
+POST_SEARCH_TRIGGERS = ['post_search_insert', 'post_search_delete',
+                        'post_search_update', 'post_search_rename']
+
+POST_SEARCH_DDL = ['DROP TRIGGER IF EXISTS {}'.format(name)
+                   for name in POST_SEARCH_TRIGGERS] + [
+    'DROP VIEW IF EXISTS post_search_source',
+    """CREATE VIEW post_search_source AS
+        SELECT posts.id AS id, posts.text AS text,
+               COALESCE(posts.author, authors.name) AS author,
+               threads.name AS title
+        FROM posts
+        LEFT JOIN authors ON authors.id = posts.author_id
+        LEFT JOIN threads ON threads.id = posts.thread_id""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS post_search
+        USING fts5(text, author, title,
+                   content='post_search_source', content_rowid='id',
+                   tokenize='porter unicode61')""",
+    """INSERT INTO post_search(post_search, rank) VALUES ('rank', 'bm25(1.0, 0.5, 2.0)')""",
+    """CREATE TRIGGER post_search_insert AFTER INSERT ON posts BEGIN
+        {}
+    END""".format(_index('new')),
+    """CREATE TRIGGER post_search_delete AFTER DELETE ON posts BEGIN
+        {}
+    END""".format(_forget('old')),
+    """CREATE TRIGGER post_search_update
+    AFTER UPDATE OF text, author, author_id, thread_id ON posts BEGIN
+        {}
+        {}
+    END""".format(_forget('old'), _index('new')),
+    """CREATE TRIGGER post_search_rename AFTER UPDATE OF name ON threads
+    WHEN old.name IS NOT new.name BEGIN
+        INSERT INTO post_search(post_search, rowid, text, author, title)
+        SELECT 'delete', id, text, author, old.name
+        FROM post_search_source WHERE id IN (SELECT id FROM posts WHERE thread_id = new.id);
+        INSERT INTO post_search(rowid, text, author, title)
+        SELECT id, text, author, title
+        FROM post_search_source WHERE id IN (SELECT id FROM posts WHERE thread_id = new.id);
+    END""",
+]
+
+#: A task which is queued again during the same crawl (as happens when two
+#: workers of a sharded crawl come across the same page) keeps its original
+#: checkpoint, so one which is already done isn't reset to ``queued``.
+CRAWL_TASK_DDL = [
+    'DROP TRIGGER IF EXISTS crawl_task_requeued',
+    """CREATE TRIGGER crawl_task_requeued BEFORE INSERT ON _tasks
+    WHEN EXISTS (SELECT 1 FROM _tasks WHERE url = new.url AND crawl_id = new.crawl_id) BEGIN
+        SELECT RAISE(IGNORE);
+    END""",
+]
+
+for statement in POST_SEARCH_DDL + CRAWL_TASK_DDL:
+    event.listen(Base.metadata, 'after_create',
+            DDL(statement).execute_if(dialect='sqlite'))
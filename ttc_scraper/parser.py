@@ -0,0 +1,192 @@
+"""
+Extract everything we care about from a phpBB page using the lxml tree grab
+has already built, so each page is only ever parsed once.
+
+The functions here return plain records (namedtuples) instead of touching
+the database, which keeps them cheap to test and easy to run elsewhere.
+"""
+import re
+from collections import namedtuple
+from datetime import datetime
+from urllib.parse import urljoin
+
+import lxml.html
+from html2text import html2text
+
+
+TIMESTAMP_FORMAT = '%a %b %d, %Y %I:%M %p'
+TIMESTAMP_PATTERN = re.compile(r'\w{3} \w{3} \d{1,2}, \d{4} \d{1,2}:\d{2} [ap]m', re.I)
+
+PostRecord = namedtuple('PostRecord', 'phpbb_id author created html text images attachments')
+ThreadPage = namedtuple('ThreadPage', 'posts pages')
+TopicRecord = namedtuple('TopicRecord', 'title link replies last_post')
+ForumRecord = namedtuple('ForumRecord', 'title link topics posts last_post last_post_id')
+ForumPage = namedtuple('ForumPage', 'forums topics pages')
+
+
+def has_class(name):
+    return 'contains(concat(" ", normalize-space(@class), " "), " {} ")'.format(name)
+
+
+_postbodies = './/*[{}]'.format(has_class('postbody'))
+_author = './/*[{}]'.format(has_class('author'))
+_content = './/*[{}]'.format(has_class('content'))
+_attachments = './/*[{}]//*[{}]'.format(has_class('attachbox'), has_class('postlink'))
+_pagination = '//div[@class="pagination"]/span/a'
+_post_anchors = './/a[contains(@href, "#p")]/@href | ancestor::div[starts-with(@id, "p")][1]/@id'
+_replies = './/dd[{}]'.format(has_class('posts'))
+_topics = './/dd[{}]'.format(has_class('topics'))
+_lastpost = './/dd[{}]'.format(has_class('lastpost'))
+
+
+def inner_html(elem):
+    """
+    The serialized contents of an element, without the element's own tag.
+    """
+    return (elem.text or '') + ''.join(
+            lxml.html.tostring(child, encoding='unicode') for child in elem)
+
+
+def find_timestamp(text):
+    """
+    Pull the first phpBB-formatted timestamp out of a chunk of text.
+    """
+    match = TIMESTAMP_PATTERN.search(text)
+    if match is not None:
+        return datetime.strptime(match.group(0), TIMESTAMP_FORMAT)
+
+
+def find_post_id(elem):
+    """
+    phpBB's own id for a post, taken from the ``#p1234`` anchors in its
+    postbody (or the ``id`` of the surrounding post div).
+    """
+    for href in elem.xpath(_post_anchors):
+        match = re.search(r'(?:^|#)p(\d+)$', href)
+        if match:
+            return int(match.group(1))
+
+
+def pagination_links(tree):
+    """
+    Yield a (href, page_label) tuple for every link in a page's paginator.
+    """
+    for elem in tree.xpath(_pagination):
+        yield (elem.get('href'), elem.text_content().strip())
+
+
+def parse_post(elem, url):
+    """
+    Turn a single ``postbody`` element into a ``PostRecord``. Relative links
+    are resolved against ``url``.
+    """
+    author_tag = elem.xpath(_author)[0]
+    author = author_tag.find('.//strong').text_content()
+    created = author_tag.text_content().split('»')[-1].strip()
+    created_on = datetime.strptime(created, TIMESTAMP_FORMAT)
+
+    content = elem.xpath(_content)[0]
+
+    # Convert any relative links in the content to absolute, picking out the
+    # embedded images as we go
+    images = []
+    for child in content.iter('a', 'img'):
+        if child.tag == 'a':
+            if child.get('href') is not None:
+                child.set('href', urljoin(url, child.get('href')))
+        else:
+            link = urljoin(url, child.get('src', ''))
+            name = child.get('alt', '').strip() or link.split('/')[-1]
+            images.append((name, link))
+
+    attachments = [
+            (thing.text_content(), urljoin(url, thing.get('href')))
+            for thing in elem.xpath(_attachments)]
+
+    html = inner_html(content)
+    return PostRecord(
+            phpbb_id=find_post_id(elem),
+            author=author,
+            created=created_on,
+            html=html,
+            text=html2text(html),
+            images=images,
+            attachments=attachments)
+
+
+def parse_thread(tree, url):
+    """
+    Parse every post on a thread page, as well as the links to the
+    thread's other pages.
+    """
+    posts = [parse_post(elem, url) for elem in tree.xpath(_postbodies)]
+    return ThreadPage(posts=posts, pages=list(pagination_links(tree)))
+
+
+def parse_page(url, body):
+    """
+    Parse a raw thread page. This is what gets run in worker processes, so
+    it only deals in picklable arguments and return values.
+    """
+    return parse_thread(lxml.html.fromstring(body), url)
+
+
+def find_count(row, xpath):
+    for dd in row.xpath(xpath):
+        match = re.search(r'\d+', dd.text_content())
+        return int(match.group(0)) if match else None
+
+
+def parse_topic(elem, url):
+    """
+    Turn a ``topictitle`` link on a forum listing into a ``TopicRecord``,
+    reading the reply count and last post time from the rest of its row.
+    """
+    replies = last_post = None
+
+    for row in elem.xpath('ancestor::dl[1]'):
+        replies = find_count(row, _replies)
+        for dd in row.xpath(_lastpost):
+            last_post = find_timestamp(dd.text_content())
+
+    return TopicRecord(
+            title=elem.text_content().strip(),
+            link=urljoin(url, elem.get('href')),
+            replies=replies,
+            last_post=last_post)
+
+
+def parse_subforum(elem, url):
+    """
+    Turn a ``forumtitle`` link into a ``ForumRecord``. The rest of its row
+    has the forum's topic and post counts and its latest post (phpBB counts
+    the forum's own sub-forums in these too).
+    """
+    topics = posts = last_post = last_post_id = None
+
+    for row in elem.xpath('ancestor::dl[1]'):
+        topics = find_count(row, _topics)
+        posts = find_count(row, _replies)
+        for dd in row.xpath(_lastpost):
+            last_post = find_timestamp(dd.text_content())
+            last_post_id = find_post_id(dd)
+
+    return ForumRecord(
+            title=elem.text_content().strip(),
+            link=urljoin(url, elem.get('href')),
+            topics=topics,
+            posts=posts,
+            last_post=last_post,
+            last_post_id=last_post_id)
+
+
+def parse_forum(tree, url):
+    """
+    Parse a forum listing page into its sub-forums, topics and the links to
+    the listing's other pages.
+    """
+    forums = [parse_subforum(elem, url)
+              for elem in tree.xpath('//a[@class="forumtitle"]')]
+    topics = [parse_topic(elem, url)
+              for elem in tree.xpath('//a[@class="topictitle"]')]
+    return ForumPage(forums=forums, topics=topics, pages=list(pagination_links(tree)))
@@ -0,0 +1,68 @@
+"""
+Parsing thread pages on a pool of worker processes.
+
+Turning a page into posts (``html2text``, ``strptime``, link rewriting and
+re-serialising the HTML) is CPU-bound, and grab runs every task handler on
+the same thread that drives the network. Handing raw bodies to other
+processes keeps the crawler's connections busy while parsing scales across
+cores.
+"""
+import os
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .parser import parse_page
+
+
+class ParsePipeline:
+    """
+    Parse pages in worker processes and hand each ``ThreadPage`` to
+    ``handler(context, page)`` back on the calling thread, in the order the
+    pages were submitted.
+
+    At most ``max_pending`` pages are in the pool at once. Submitting
+    another blocks until the oldest is finished, which stops the crawler
+    fetching pages faster than we can parse them.
+    """
+
+    def __init__(self, handler, processes=None, max_pending=None, logger=None):
+        self.handler = handler
+        self.logger = logger or logging.getLogger(__name__)
+
+        processes = processes or os.cpu_count()
+        self.pool = ProcessPoolExecutor(max_workers=processes)
+        self.max_pending = max_pending or 4 * processes
+        self._pending = deque()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, url, body, context):
+        while len(self._pending) >= self.max_pending:
+            self._finish(*self._pending.popleft())
+
+        future = self.pool.submit(parse_page, url, body)
+        self._pending.append((future, url, context))
+        self.drain()
+
+    def drain(self, wait=False):
+        """
+        Pass any finished pages to the handler. If ``wait`` is set, block
+        until everything submitted so far is finished.
+        """
+        while self._pending and (wait or self._pending[0][0].done()):
+            self._finish(*self._pending.popleft())
+
+    def _finish(self, future, url, context):
+        try:
+            page = future.result()
+        except Exception as e:
+            self.logger.error('Unable to parse {}: {}'.format(url, e))
+            return
+
+        self.handler(context, page)
+
+    def close(self):
+        self.drain(wait=True)
+        self.pool.shutdown()
@@ -0,0 +1,166 @@
+"""
+Reading the scraped forum back out through the ORM models without a query
+per relationship.
+
+The models' relationships are lazy, so walking forums -> threads -> posts ->
+attachments one attribute at a time costs a query for every thread and post.
+The functions here load everything that's going to be touched up front
+(``joinedload`` for the thread, forum and author of each post,
+``selectinload`` for its attachments) and page through posts by keyset: each
+page starts after the last post of the one before, so every page is an index
+range scan however deep it is, where ``OFFSET`` has to count its way past
+every row before it.
+
+Pages are plain lists of ``Post`` objects. Pass the last post of one page as
+``after`` (or ``before``) to get the next, or use the ``iter_`` functions to
+walk the lot.
+"""
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .models import Forum, Thread, Post, Attachment
+
+
+def _post_options():
+    return (joinedload(Post.threads).joinedload(Thread.forums),
+            joinedload(Post.authors),
+            selectinload(Post.attachments).joinedload(Attachment.links))
+
+
+def _subtree(forum_id):
+    """
+    A query for the ids of a forum and every forum under it.
+    """
+    forums = Forum.__table__
+    tree = select([forums.c.id]).where(forums.c.id == forum_id).cte('tree', recursive=True)
+    # UNION rather than UNION ALL, so a loop in the tree can't go on forever
+    tree = tree.union(select([forums.c.id]).where(forums.c.parent_id == tree.c.id))
+    return select([tree.c.id])
+
+
+def _keyset(query, columns, after, limit, descending=False):
+    """
+    The ``limit`` rows of ``query`` which come after the ``after`` object
+    when ordered by ``columns``.
+    """
+    if after is not None:
+        values = [getattr(after, column.key) for column in columns]
+        position, bound = tuple_(*columns), tuple_(*values)
+
+        # Bounding the first column on its own as well lets SQLite start an
+        # index range scan there
+        if descending:
+            query = query.filter(columns[0] <= values[0], position < bound)
+        else:
+            query = query.filter(columns[0] >= values[0], position > bound)
+
+    order = [column.desc() for column in columns] if descending else columns
+    return query.order_by(*order).limit(limit).all()
+
+
+def _iterate(fetch, page_size):
+    after = None
+    while True:
+        page = fetch(after, page_size)
+        yield from page
+
+        if len(page) < page_size:
+            return
+        after = page[-1]
+
+
+def subforum_ids(session, forum_id):
+    """
+    The ids of a forum and every forum under it.
+    """
+    return [forum_id for (forum_id,) in session.execute(_subtree(forum_id))]
+
+
+def forum_tree(session, forum_id):
+    """
+    A forum and every forum under it, each with its ``child_threads`` already
+    loaded.
+    """
+    return (session.query(Forum)
+            .filter(Forum.id.in_(_subtree(forum_id)))
+            .options(selectinload(Forum.child_threads))
+            .order_by(Forum.id)
+            .all())
+
+
+def forum_posts(session, forum_id, limit=100, after=None):
+    """
+    A page of the posts in a forum and its sub-forums, thread by thread and
+    oldest first within each thread.
+    """
+    threads = select([Thread.__table__.c.id]).where(
+            Thread.__table__.c.forum_id.in_(_subtree(forum_id)))
+    query = (session.query(Post)
+            .filter(Post.thread_id.in_(threads))
+            .options(*_post_options()))
+
+    return _keyset(query, [Post.thread_id, Post.created, Post.id], after, limit)
+
+
+def iter_forum_posts(session, forum_id, page_size=500):
+    """
+    Every post in a forum and its sub-forums, in the order of
+    ``forum_posts()``.
+    """
+    return _iterate(lambda after, limit: forum_posts(session, forum_id, limit, after),
+            page_size)
+
+
+def latest_posts(session, since=None, limit=100, before=None):
+    """
+    A page of the newest posts (made after ``since``, if given), newest
+    first.
+    """
+    query = session.query(Post).options(*_post_options())
+    # Pages head back towards ``since``, so unlike the cursor it's always a
+    # bound
+    if since is not None:
+        query = query.filter(Post.created > since)
+
+    return _keyset(query, [Post.created, Post.id], before, limit, descending=True)
+
+
+def posts_since(session, since, limit=100, after=None):
+    """
+    A page of the posts made after ``since``, oldest first.
+    """
+    query = session.query(Post).options(*_post_options())
+    # The cursor is already past ``since``, and a second lower bound on
+    # ``created`` can be picked over it as the start of the index scan
+    if after is None:
+        query = query.filter(Post.created > since)
+
+    return _keyset(query, [Post.created, Post.id], after, limit)
+
+
+def iter_posts_since(session, since, page_size=500):
+    """
+    Every post made after ``since``, oldest first.
+    """
+    return _iterate(lambda after, limit: posts_since(session, since, limit, after),
+            page_size)
+
+
+def thread_with_attachments(session, thread_id):
+    """
+    A thread with its forum, and its ``posts`` (oldest first) and their
+    attachments already loaded. Returns ``None`` if there's no such thread.
+    """
+    thread = session.query(Thread).options(joinedload(Thread.forums)).get(thread_id)
+    if thread is None:
+        return None
+
+    posts = (session.query(Post)
+            .filter(Post.thread_id == thread_id)
+            .options(joinedload(Post.authors),
+                     selectinload(Post.attachments).joinedload(Attachment.links))
+            .order_by(Post.created, Post.id)
+            .all())
+    set_committed_value(thread, 'posts', posts)
+    return thread
@@ -0,0 +1,140 @@
+"""
+Adaptive control over how hard we hit the forum.
+
+The limiter keeps a congestion window (the number of requests we'd like to
+have in flight) which grows while responses come back quickly and cleanly,
+and is cut multiplicatively when they slow down past ``latency_target`` or
+the server starts returning errors (AIMD, much like TCP). No more than
+``window`` requests are allowed in flight at once, with an optional hard
+ceiling on requests per second.
+
+Callers which handle responses on the same thread they start requests from
+(e.g. grab's Spider) can't block waiting for a slot to free up, so they
+should use ``wait(paced=True)``. That spaces requests ``latency / window``
+apart instead, which keeps roughly ``window`` in flight.
+"""
+import time
+import logging
+import threading
+from collections import deque
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, max_concurrency, min_concurrency=1, max_rps=None,
+            latency_target=2.0, increase=1.0, decrease=0.5, smoothing=0.2,
+            slot_timeout=60.0, logger=None):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_rps = max_rps
+        self.latency_target = latency_target
+        self.increase = increase
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self.slot_timeout = slot_timeout
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.window = float(min_concurrency)
+        self.latency = None
+        self.requests = 0
+        self.errors = 0
+
+        self._slow_start = True
+        self._last_decrease = 0.0
+        self._last_start = 0.0
+        self._in_flight = deque()
+        self._cond = threading.Condition()
+
+    def record(self, latency=None, ok=True):
+        """
+        Tell the limiter how a request went, freeing up its slot. ``latency``
+        is in seconds and may be ``None`` if the request failed before we got
+        a response.
+        """
+        with self._cond:
+            now = time.monotonic()
+            self.requests += 1
+            if self._in_flight:
+                self._in_flight.popleft()
+            self._cond.notify()
+
+            if latency is not None:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.smoothing * (latency - self.latency)
+
+            if not ok:
+                self.errors += 1
+
+            if not ok or (latency is not None and latency > self.latency_target):
+                # Only back off once per round trip, otherwise a burst of
+                # failures from the same window would collapse it entirely
+                if now - self._last_decrease >= (self.latency or 0):
+                    self._last_decrease = now
+                    self._slow_start = False
+                    self.window = max(self.min_concurrency, self.window * self.decrease)
+                    self.logger.debug('Backing off, window is now {:.1f}'.format(self.window))
+            elif self._slow_start:
+                self.window = min(self.max_concurrency, self.window + 1)
+            else:
+                self.window = min(self.max_concurrency,
+                        self.window + self.increase / self.window)
+
+    def interval(self, paced=False):
+        """
+        The shortest gap allowed between starting consecutive requests.
+        """
+        gaps = [1.0 / self.max_rps if self.max_rps else 0.0]
+
+        if paced:
+            # Until we've heard back from the server, assume the worst
+            latency = self.latency if self.latency is not None else self.latency_target
+            gaps.append(latency / self.window)
+
+        return max(gaps)
+
+    def _expire(self, now):
+        # Requests we never heard back about (e.g. network errors the
+        # caller couldn't see) shouldn't hold on to their slot forever
+        while self._in_flight and now - self._in_flight[0] > self.slot_timeout:
+            self._in_flight.popleft()
+
+    def wait(self, paced=False):
+        """
+        Block until we're allowed to start another request, returning how
+        long we waited. Every call should be followed by a ``record()``.
+        """
+        started = time.monotonic()
+
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+
+                ready = self._last_start + self.interval(paced)
+                has_slot = paced or len(self._in_flight) < int(self.window)
+
+                if has_slot and now >= ready:
+                    self._last_start = now
+                    self._in_flight.append(now)
+                    return now - started
+
+                self._cond.wait(ready - now if now < ready else 0.1)
+
+    @property
+    def in_flight(self):
+        """
+        How many requests have been started but not recorded yet.
+        """
+        with self._cond:
+            self._expire(time.monotonic())
+            return len(self._in_flight)
+
+    def __repr__(self):
+        return '<{}: window={:.1f}, in_flight={}, latency={}, requests={}, errors={}>'.format(
+                self.__class__.__name__,
+                self.window,
+                len(self._in_flight),
+                '{:.3f}s'.format(self.latency) if self.latency is not None else None,
+                self.requests,
+                self.errors)
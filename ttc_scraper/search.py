@@ -0,0 +1,50 @@
+"""
+Ranked full-text search over the scraped posts, using the ``post_search``
+FTS5 index (see ``models.POST_SEARCH_DDL``).
+"""
+from collections import namedtuple
+
+from sqlalchemy import text, DateTime
+
+
+SearchHit = namedtuple('SearchHit',
+        'post_id phpbb_id author created thread link snippet rank')
+
+
+_search = text("""
+    SELECT hits.rowid, posts.phpbb_id, COALESCE(posts.author, authors.name), posts.created,
+           threads.name, threads.link, hits.snippet, hits.rank
+    FROM (SELECT rowid, rank,
+                 snippet(post_search, 0, :start, :end, '...', :tokens) AS snippet
+          FROM post_search
+          WHERE post_search MATCH :query
+          ORDER BY rank
+          LIMIT :limit) AS hits
+    JOIN posts ON posts.id = hits.rowid
+    LEFT JOIN authors ON authors.id = posts.author_id
+    LEFT JOIN threads ON threads.id = posts.thread_id
+    ORDER BY hits.rank
+""").columns(created=DateTime)
+
+
+def search(engine, query, limit=20, start='[', end=']', tokens=16):
+    """
+    The ``limit`` best matches for an FTS5 ``query`` (e.g. ``pacejka``,
+    ``"slip angle" NOT camber`` or ``author:bob``), best first. Matching
+    terms in each snippet are wrapped in ``start`` and ``end``.
+    """
+    with engine.connect() as conn:
+        rows = conn.execute(_search, query=query, limit=limit,
+                start=start, end=end, tokens=tokens)
+        return [SearchHit(*row) for row in rows]
+
+
+def rebuild_index(engine):
+    """
+    Throw away the search index and build it again from scratch, returning
+    the number of posts indexed.
+    """
+    with engine.begin() as conn:
+        conn.execute("INSERT INTO post_search(post_search) VALUES ('rebuild')")
+        conn.execute("INSERT INTO post_search(post_search) VALUES ('optimize')")
+        return conn.execute('SELECT count(*) FROM posts').scalar()
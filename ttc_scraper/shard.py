@@ -0,0 +1,349 @@
+"""
+Splitting a crawl between several worker processes.
+
+Every task belongs to a shard, and each worker only crawls its own shard.
+A forum's listing pages are sharded by the link to its first page (which
+is all its first page knows about it), and threads by the id of the forum
+they're in. The workers share one frontier, the ``_frontier`` table in
+the crawl database, which is switched to WAL mode so they can read it while
+someone else is writing.
+
+A page can only be queued once (the table is unique on task name and URL),
+so two workers which come across the same thread can't both crawl it. All
+of a forum's listing pages land in the same shard, as do all of its threads
+and their pages, so the usual in-process checks (like ``--forum-limit``)
+catch everything else. Primary keys are
+reserved a block at a time (see ``BatchWriter.id_block``) so the workers can
+write to the same tables without clashing.
+
+Shard 0 logs in and stores its cookies in ``_session``. The other workers
+wait for them before starting, so the forum only ever sees one login.
+"""
+import os
+import time
+import pickle
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from http.cookiejar import CookieJar
+from queue import Empty
+
+from sqlalchemy import select, func, bindparam
+from grab.spider import Task
+from utils.misc import get_logger
+
+from .models import SharedTask, LoginSession
+from .storage import sqlite_engine, enable_wal
+from .frontier import url_hash, start_crawl, finish_crawl
+from .writer import BatchWriter
+from .urls import page_url
+from .migrations import upgrade
+from .downloader import AttachmentDownloader
+
+
+def shard_of(task, shards):
+    """
+    Which of ``shards`` shards a task belongs to.
+    """
+    if task.name == 'initial':
+        # Shard 0 logs in for everyone
+        return 0
+
+    if task.name == 'forum':
+        # Only pages after the first know the forum's id
+        return url_hash(page_url(task.url, 0)) % shards
+
+    forum_id = getattr(task, 'forum_id', None)
+    key = str(forum_id) if forum_id is not None else task.url
+    return url_hash(key) % shards
+
+
+class SharedFrontier:
+    """
+    One worker's view of a sharded crawl's frontier, which works as a grab
+    task queue backend.
+
+    Tasks the worker adds (wherever they belong) and finishes are buffered
+    and written out in batches: whenever ``get()`` claims the most urgent of
+    the worker's own tasks from the database, ``claim_size`` at a time, and
+    at least every ``poll_interval`` seconds. A task is never marked as
+    done before the tasks it found are queued. A claimed task stays in the
+    table until it's done, so a worker with nothing to do can tell whether
+    anyone else could still be queueing work for it: ``size()`` counts every
+    unfinished task in every shard.
+
+    ``before_publish`` is called before tasks for other shards are written,
+    so anything else the worker has queued about them (like their
+    checkpoint) is in the database before another worker can start on them.
+    """
+    QUEUED = 'queued'
+    CLAIMED = 'claimed'
+    DONE = 'done'
+
+    def __init__(self, engine, shard, shards, claim_size=8, default_priority=100,
+            ready=None, poll_interval=0.2, before_publish=None, logger=None):
+        self.engine = engine
+        self.shard = shard
+        self.shards = shards
+        self.claim_size = claim_size
+        self.default_priority = default_priority
+        self.ready = ready
+        self.poll_interval = poll_interval
+        self.before_publish = before_publish
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._lock = threading.RLock()
+        self._claimed = deque()
+        self._new = []
+        self._requeued = []
+        self._finished = []
+        self._next_poll = 0
+        self._unfinished = None
+        self._closed = False
+
+        self.claim_count = 0
+        self.peak_size = 0
+
+    def put(self, task, priority=None, schedule_time=None):
+        if priority is None:
+            priority = self.default_priority
+
+        with self._lock:
+            if hasattr(task, 'frontier_id'):
+                # A retry of one of our own tasks
+                self._requeued.append({'_id': task.frontier_id, 'priority': priority,
+                    'task': pickle.dumps(task)})
+            else:
+                self._new.append({'name': task.name, 'url': task.url,
+                    'shard': shard_of(task, self.shards), 'priority': priority,
+                    'state': self.QUEUED, 'task': pickle.dumps(task)})
+
+    def done(self, task):
+        """
+        Mark a task as finished, once everything it found is queued.
+        """
+        if hasattr(task, 'frontier_id'):
+            with self._lock:
+                self._finished.append({'_id': task.frontier_id})
+
+    def _write(self):
+        table = SharedTask.__table__
+
+        if not (self._new or self._requeued or self._finished):
+            return
+
+        if self.before_publish is not None and \
+                any(row['shard'] != self.shard for row in self._new):
+            self.before_publish()
+
+        with self.engine.begin() as conn:
+            if self._new:
+                conn.execute(table.insert().prefix_with('OR IGNORE'), self._new)
+            if self._requeued:
+                conn.execute(table.update()
+                        .where(table.c.id == bindparam('_id'))
+                        .values(state=self.QUEUED), self._requeued)
+            if self._finished:
+                conn.execute(table.update()
+                        .where(table.c.id == bindparam('_id'))
+                        .values(state=self.DONE), self._finished)
+
+        self._new = []
+        self._requeued = []
+        self._finished = []
+        self._unfinished = None
+        # Some of them might be ours
+        self._next_poll = 0
+
+    def get(self):
+        """
+        The most urgent task in our shard, raising ``queue.Empty`` if there
+        aren't any (or we're not ready for another).
+        """
+        if self.ready is not None and not self.ready():
+            raise Empty()
+
+        with self._lock:
+            if not self._claimed:
+                self._write()
+                self._claim()
+            if not self._claimed:
+                raise Empty()
+            return self._claimed.popleft()
+
+    def _claim(self):
+        now = time.monotonic()
+        if now < self._next_poll:
+            return
+
+        table = SharedTask.__table__
+        # Nobody else claims from our shard, so there's no race between
+        # picking tasks and marking them as ours
+        with self.engine.begin() as conn:
+            rows = conn.execute(select([table.c.id, table.c.task])
+                    .where((table.c.shard == self.shard) & (table.c.state == self.QUEUED))
+                    .order_by(table.c.priority, table.c.id)
+                    .limit(self.claim_size)).fetchall()
+            if rows:
+                conn.execute(table.update()
+                        .where(table.c.id.in_([row.id for row in rows]))
+                        .values(state=self.CLAIMED, worker=os.getpid()))
+
+        if not rows:
+            self._next_poll = now + self.poll_interval
+            return
+
+        for row in rows:
+            task = pickle.loads(row.task)
+            task.frontier_id = row.id
+            self._claimed.append(task)
+        self.claim_count += len(rows)
+
+    def size(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._unfinished is None or now >= self._unfinished[0]:
+                self._write()
+                table = SharedTask.__table__
+                with self.engine.connect() as conn:
+                    count = conn.execute(select([func.count()])
+                            .where(table.c.state.in_([self.QUEUED, self.CLAIMED]))).scalar()
+                self._unfinished = (now + self.poll_interval, count)
+
+            size = self._unfinished[1] + len(self._new)
+            self.peak_size = max(self.peak_size, size)
+            return size
+
+    __len__ = size
+
+    def clear(self):
+        """
+        Give back the tasks we've claimed but not started.
+        """
+        with self._lock:
+            self._requeued += [{'_id': task.frontier_id, 'priority': task.priority,
+                'task': pickle.dumps(task)} for task in self._claimed]
+            self._claimed.clear()
+            self._write()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self.clear()
+            self._closed = True
+
+        self.logger.info('Shard {}/{}: crawled {} tasks'.format(self.shard + 1,
+            self.shards, self.claim_count))
+
+    def reset(self, initial_urls=()):
+        """
+        Forget the last crawl's tasks and login, and queue the first tasks of
+        a new one.
+        """
+        with self.engine.begin() as conn:
+            conn.execute(SharedTask.__table__.delete())
+            conn.execute(LoginSession.__table__.delete())
+
+        for url in initial_urls:
+            self.put(Task('initial', url=url), 0)
+        self._write()
+
+    def share_session(self, cookies):
+        """
+        Store the cookies from logging in for the other workers.
+        """
+        with self.engine.begin() as conn:
+            conn.execute(LoginSession.__table__.insert(),
+                    cookies=pickle.dumps(list(cookies)))
+
+    def wait_for_session(self, interval=0.5):
+        """
+        The cookies shard 0 got from logging in, once it has. Returns
+        ``None`` if the crawl finishes without anyone logging in.
+        """
+        table = LoginSession.__table__
+
+        while True:
+            with self.engine.connect() as conn:
+                cookies = conn.execute(select([table.c.cookies])
+                        .order_by(table.c.id.desc())
+                        .limit(1)).scalar()
+            if cookies is not None:
+                return pickle.loads(cookies)
+            if not self.size():
+                return None
+            time.sleep(interval)
+
+
+def _crawl_shard(spider, shard, shards):
+    spider.shard = (shard, shards)
+    spider.run()
+
+
+def run_sharded(spider, workers):
+    """
+    Crawl with ``workers`` copies of a spider which has been configured but
+    not started yet, each in its own process and crawling its own shard.
+    Attachments are downloaded once everyone's finished.
+    """
+    logger = get_logger(__name__, getattr(spider, 'log_file', None) or 'stderr')
+    engine = sqlite_engine(spider.database_location,
+            getattr(spider, 'sqlite_profile', 'tuned'))
+
+    upgrade(engine)
+    enable_wal(engine)
+    frontier = SharedFrontier(engine, 0, workers, logger=logger)
+    frontier.reset(spider.initial_urls)
+    spider.crawl_id = start_crawl(engine, getattr(spider, 'resume', False))
+    # SQLite connections mustn't be carried across a fork
+    engine.dispose()
+
+    # The spider (and its configuration) is copied into each worker
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_crawl_shard, args=(spider, shard, workers),
+                                 name='shard-{}'.format(shard))
+                 for shard in range(workers)]
+
+    logger.info('Crawling with {} workers'.format(workers))
+    for process in processes:
+        process.start()
+
+    try:
+        while any(process.is_alive() for process in processes):
+            failed = [p for p in processes if p.exitcode not in (None, 0)]
+            if failed:
+                # Nobody else can crawl its shard, so the rest would wait
+                # forever. --resume picks up where everyone left off.
+                logger.error('{} exited with {}, stopping the crawl'.format(
+                    failed[0].name, failed[0].exitcode))
+                for process in processes:
+                    if process.is_alive():
+                        process.terminate()
+            time.sleep(0.5)
+    finally:
+        for process in processes:
+            process.join()
+
+    if all(process.exitcode == 0 for process in processes) and \
+            finish_crawl(engine, spider.crawl_id):
+        logger.info('Crawl {} finished'.format(spider.crawl_id))
+
+    download_dir = getattr(spider, 'download_dir', None)
+    cookies = frontier.wait_for_session()
+    if download_dir and cookies:
+        cookiejar = CookieJar()
+        for cookie in cookies:
+            cookiejar.set_cookie(cookie)
+
+        writer = BatchWriter(engine, logger=logger)
+        AttachmentDownloader(engine, writer, download_dir,
+                cookiejar=cookiejar,
+                username=spider.username,
+                password=spider.password,
+                concurrency=getattr(spider, 'download_concurrency', 4),
+                logger=logger).run()
+        writer.close()
+
+    return [process.exitcode for process in processes]
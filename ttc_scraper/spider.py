@@ -1,157 +1,595 @@
+import time
 import logging
+from collections import Counter
 from urllib.parse import urljoin
-from sqlalchemy import create_engine
+from sqlalchemy import func
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import IntegrityError, ProgrammingError, InvalidRequestError
-from bs4 import BeautifulSoup
-from html2text import html2text
-from datetime import datetime
 
 from grab.spider import Spider, Task
 from grab import Grab
-from weblib.error import DataNotFound
-from utils.misc import get_logger, humansize, innerHTML
+from grab.cookie import CookieManager
+from utils.misc import get_logger
+
+from .models import Forum, Thread, Post, Crawl
+from .writer import BatchWriter, CompactStorage, queue_post
+from .archive import PageArchive
+from .cache import ResponseCache
+from .parser import parse_thread, parse_forum, pagination_links
+from .pipeline import ParsePipeline
+from .frontier import SeenUrls, Checkpoint, Frontier, start_crawl, finish_crawl, finished_crawls
+from .shard import SharedFrontier
+from .storage import sqlite_engine
+from .urls import canonical_url, page_url
+from .migrations import upgrade
+from .downloader import AttachmentDownloader
+from .ratecontrol import AdaptiveRateLimiter
+from .metrics import Metrics, TaskProfiler, serve, timed
+
+
+
+class ForumCrawler:
+    """
+    Everything about crawling the forum except actually fetching pages, so
+    the same task handlers can be driven by grab (``ForumSpider``) or asyncio
+    (``AsyncForumSpider``).
+    """
+    initial_urls = ['http://sae.wsu.edu/ttc/']
+    posts_per_page = 10
 
-from .models import Base, Forum, Thread, Url, Post, Attachment
+    #: Which tasks get fetched first (lowest first). The rest of a thread
+    #: comes before any new threads, and new threads before more listings,
+    #: so posts start arriving straight away and only a listing page's worth
+    #: of threads is ever waiting.
+    priorities = {'initial': 0, 'thread_page': 10, 'thread': 20, 'forum': 30}
+    default_priority = 40
 
+    def valid_response_code(self, code, task):
+        valid = super().valid_response_code(code, task)
 
+        # Responses which make it to a handler are recorded by observe().
+        # grab doesn't call this, see ForumSpider.log_failed_network_result()
+        if not valid:
+            self.limiter.record(ok=code < 500 and code != 429)
 
-class ForumSpider(Spider):
-    initial_urls = ['http://sae.wsu.edu/ttc/']
+        return valid
 
-    def create_grab_instance(self, **kwargs):
+    def observe(self, grab, task=None):
         """
-        Because we're logging in, we need to set the user agent and copy
-        across the cookies we were given on login.
+        Feed a successful response's latency back to the rate limiter, fill
+        in the body of a page the server says hasn't changed, and keep a copy
+        of the page if we're archiving. Returns ``False`` if there's nothing
+        to handle because the page has to be fetched again.
         """
-        g = super().create_grab_instance(**kwargs)
-        g.setup(user_agent='ttc_scraper')
-
-        cookies = getattr(self, 'cookies', None)
-        if cookies:
-            g.cookies = cookies
-
-        return g
+        self.limiter.record(grab.response.total_time)
+
+        name = task.name if task is not None else 'initial'
+        self.metrics.inc('ttc_responses_total', task=name)
+        self.metrics.inc('ttc_downloaded_bytes_total', len(grab.response.body or b''), task=name)
+        self.metrics.observe('ttc_fetch_seconds', grab.response.total_time, task=name)
+
+        if self.pipeline is not None:
+            self.pipeline.drain()
+
+        if task is not None and self.cache is not None:
+            if grab.response.code == 304:
+                body = self.cache.hit(task.url)
+                if body is None:
+                    # Evicted while we were revalidating it, so ask for the
+                    # whole page this time
+                    self.logger.debug('{} was evicted from the cache, fetching it again'.format(
+                        task.url))
+                    self.add_task(task.clone(revalidate=False))
+                    task.refetched = True
+                    return False
+                grab.response.body = body
+            elif grab.response.code == 200:
+                self.cache.store(task.url, grab.response.headers, grab.response.body)
+
+        if task is not None and self.archive is not None:
+            self.archive.add(task.name, task.url, grab.response.body)
+
+        return True
+
+    def request_headers(self, task):
+        """
+        Extra headers to send when fetching a task's page.
+        """
+        if self.cache is None or task.name not in ('forum', 'thread') or \
+                not getattr(task, 'revalidate', True):
+            return {}
+        return self.cache.validators(task.url)
 
     def prepare(self):
-        self.base_url = 'http://sae.wsu.edu/ttc/'
+        self.base_url = self.initial_urls[0]
 
         log_level = logging.DEBUG if getattr(self, 'debug', False) else logging.INFO
         self.logger = get_logger(__name__,
                 self.log_file or 'stderr', 
                 log_level=log_level)
 
-        self.engine = create_engine('sqlite:///{}'.format(self.database_location),
-                connect_args={'check_same_thread':False})
-
-        Base.metadata.create_all(self.engine)
+        self.limiter = AdaptiveRateLimiter(self.thread_number,
+                max_rps=getattr(self, 'max_rps', None),
+                logger=self.logger)
+
+        # (index, count) when we're one of several workers sharing a crawl
+        self.shard = getattr(self, 'shard', None)
+        self.sqlite_profile = getattr(self, 'sqlite_profile', 'tuned')
+        self.engine = sqlite_engine(self.database_location, self.sqlite_profile)
+        if self.shard is None:
+            # run_sharded() has already done this for everyone
+            upgrade(self.engine)
         self.Session = sessionmaker(bind=self.engine)  
         self.session = self.Session()
 
-        self.visited_urls = set()
+        self.writer = BatchWriter(self.engine,
+                batch_size=getattr(self, 'batch_size', 500),
+                flush_interval=getattr(self, 'flush_interval', 5.0),
+                logger=self.logger,
+                id_block=1000 if self.shard is not None else None,
+                threaded=self.sqlite_profile == 'tuned')
+        self.writer.install_handlers()
+
+        self.seen_urls = SeenUrls(self.engine, self.writer,
+                bloom_capacity=getattr(self, 'bloom_capacity', None),
+                logger=self.logger)
+        self.seen_urls.load()
+
+        # run_sharded() starts the crawl for everyone
+        self.crawl_id = getattr(self, 'crawl_id', None)
+        if self.crawl_id is None:
+            self.crawl_id = start_crawl(self.engine, getattr(self, 'resume', False))
+        self.checkpoint = Checkpoint(self.engine, self.writer, self.crawl_id,
+                logger=self.logger)
+
+        archive_location = getattr(self, 'archive_location', None)
+        self.archive = PageArchive(archive_location, logger=self.logger) \
+                if archive_location else None
+
+        cache_location = getattr(self, 'cache_location', None)
+        self.cache = ResponseCache(cache_location,
+                max_size=getattr(self, 'cache_size', 500) * 1024 * 1024,
+                logger=self.logger) if cache_location else None
+        self.resume = getattr(self, 'resume', False)
+
+        parse_processes = getattr(self, 'parse_processes', 0)
+        self.pipeline = ParsePipeline(self.save_thread_page,
+                processes=parse_processes,
+                logger=self.logger) if parse_processes else None
+
+        # grab only sets up its own queue if we haven't
+        if self.shard is None:
+            self.task_queue = self.frontier = Frontier(
+                    max_size=getattr(self, 'frontier_size', None) or 10000,
+                    location=getattr(self, 'frontier_location', None),
+                    default_priority=self.default_priority,
+                    ready=self.ready_for_task,
+                    logger=self.logger)
+        else:
+            self.task_queue = self.frontier = SharedFrontier(self.engine, *self.shard,
+                    claim_size=self.thread_number,
+                    default_priority=self.default_priority,
+                    ready=self.ready_for_task,
+                    before_publish=self.writer.flush,
+                    logger=self.logger)
+            if self.shard[0]:
+                # Shard 0 logs in for everyone (see task_initial)
+                cookies = self.frontier.wait_for_session()
+                if cookies is not None:
+                    self.use_session(cookies)
+        self.forum_limit = getattr(self, 'forum_limit', None)
+        self.forum_threads = Counter()
+        self.deferred = 0
+
+        self.incremental = getattr(self, 'incremental', False)
+        self.listings_seen = set()
+        self.known_forums = dict(self.session.query(Forum.link, Forum.id))
+        self.known_threads = self.load_known_threads() if self.incremental else {}
+        self.forum_markers = self.load_forum_markers() if self.incremental else {}
+        self.finished_crawls, self.cutoff = finished_crawls(self.engine) \
+                if self.incremental else (set(), None)
+        self.forums_skipped = 0
+        self.listings_stopped = 0
+        self.compact_storage = CompactStorage(self.engine, self.writer,
+                shared=self.shard is not None) \
+                if getattr(self, 'compact', False) or CompactStorage.in_use(self.engine) \
+                else None
+
+        self.known_posts = {post_id for (post_id,) in
+                self.session.query(Post.phpbb_id).filter(Post.phpbb_id != None)}
+
+        self.setup_metrics()
+
+    def setup_metrics(self):
+        self.metrics = Metrics()
+        self.metrics.gauge('ttc_queue_depth', self.queue_size)
+        self.metrics.gauge('ttc_in_flight', lambda: self.limiter.in_flight)
+        self.metrics.gauge('ttc_rate_window', lambda: round(self.limiter.window, 1))
+        if self.pipeline is not None:
+            self.metrics.gauge('ttc_parse_pending', lambda: len(self.pipeline))
+
+        self.writer.on_flush.append(lambda: self.metrics.observe('ttc_db_flush_seconds',
+            self.writer.last_flush_time))
+
+        stats_interval = getattr(self, 'stats_interval', 0)
+        self.stop_reporting = self.metrics.report_every(stats_interval, self.logger) \
+                if stats_interval else None
+
+        metrics_port = getattr(self, 'metrics_port', None)
+        self.metrics_server = serve(self.metrics, metrics_port) if metrics_port else None
+        if self.metrics_server is not None:
+            self.logger.info('Serving metrics at http://127.0.0.1:{}/metrics'.format(
+                self.metrics_server.server_port))
+
+        profile_dir = getattr(self, 'profile_dir', None)
+        self.profiler = TaskProfiler(profile_dir, logger=self.logger) if profile_dir else None
+
+    def find_task_handler(self, task):
+        handler = super().find_task_handler(task)
+        profile = self.profiler[task.name] if self.profiler is not None else None
+
+        def instrumented(grab, task):
+            # New tasks are queued here rather than on grab's dispatcher
+            # thread, so they're in the frontier before the task is done
+            try:
+                for new_task in timed(handler(grab, task), self.metrics, task.name, profile):
+                    self.add_task(new_task)
+            finally:
+                # A task fetched again is still in the frontier
+                if not getattr(task, 'refetched', False):
+                    self.frontier.done(task)
 
-    def task_initial(self, grab, task):
-        self.logger.info('Logging in')
+        return instrumented
 
-        g = Grab(user_agent='ttc_scraper')
-        g.go(self.base_url)
-        g.doc.set_input('username', self.username)
-        g.doc.set_input('password', self.password)
-        g.doc.submit()
+    def log_rejected_task(self, task, reason):
+        super().log_rejected_task(task, reason)
+        self.checkpoint.failed(task)
+        self.frontier.done(task)
 
-        elem = g.doc.select('//a[contains(text(),"All Users Must Register")]')
+    def load_known_threads(self):
+        """
+        Everything we need to know to tell whether a thread has new posts,
+        keyed by its link.
+        """
+        post_counts = dict(self.session.query(Post.thread_id, func.count(Post.id))
+                .group_by(Post.thread_id))
+        threads = self.session.query(Thread.link, Thread.id, Thread.replies,
+                Thread.last_post)
 
-        if len(elem):
-            self.logger.error('Login failed')
-            raise RuntimeError('Login failed')
-        else:
-            self.cookies = g.cookies
-            self.logger.info('Login successful')
+        return {link: (thread_id, replies, last_post, post_counts.get(thread_id, 0))
+                for link, thread_id, replies, last_post in threads}
 
-        if not self.already_checked(self.base_url):
+    def load_forum_markers(self):
+        """
+        What each forum's parent listing said about it last time, and which
+        crawl read it, keyed by the forum's link.
+        """
+        forums = self.session.query(Forum.link, Forum.topics, Forum.posts,
+                Forum.last_post_id, Forum.crawl_id)
+
+        return {link: ((topics, posts, last_post_id), crawl_id)
+                for link, topics, posts, last_post_id, crawl_id in forums}
+
+    def add_task(self, task, *args, **kwargs):
+        self.checkpoint.queued(task)
+
+        if not self.within_forum_limit(task):
+            # It stays queued in the checkpoint for the next --resume
+            self.deferred += 1
+            return False
+
+        task.priority = self.task_priority(task)
+        task.priority_set_explicitly = True
+        return super().add_task(task, *args, **kwargs)
+
+    def ready_for_task(self):
+        """
+        Whether to start another request. Pages which have been fetched but
+        not handled yet count as in flight, so the network can't run ahead
+        of the handlers (and fetch lower priority pages before the ones
+        they'd have queued).
+        """
+        return self.limiter.in_flight < 2 * self.thread_number
+
+    def task_priority(self, task):
+        name = task.name
+        if name == 'thread' and hasattr(task, 'thread_id'):
+            name = 'thread_page'
+        return self.priorities.get(name, self.default_priority)
+
+    def within_forum_limit(self, task):
+        """
+        Whether we can start on another new thread in the task's forum
+        without going over ``forum_limit``.
+        """
+        if not self.forum_limit or task.name != 'thread' or hasattr(task, 'thread_id'):
+            return True
+        if getattr(task, 'within_limit', False):
+            # A retry, which has already been counted
+            return True
+
+        if self.forum_threads[task.forum_id] >= self.forum_limit:
+            return False
+
+        self.forum_threads[task.forum_id] += 1
+        task.within_limit = True
+        return True
+
+    def resumed_tasks(self):
+        for name, url, params in self.checkpoint.pending():
+            yield Task(name, url=url, resumed=True, **params)
+
+    def shutdown(self):
+        self.logger.info('Rate limiter: {}'.format(self.limiter))
+
+        if self.pipeline is not None:
+            self.pipeline.close()
+
+        download_dir = getattr(self, 'download_dir', None)
+        if download_dir and getattr(self, 'cookiejar', None) and self.shard is None:
+            # Sharded crawls download everything once all the workers are done
+            self.download_attachments(download_dir)
+
+        if self.deferred:
+            self.logger.info('Left {} threads over the per-forum limit for --resume'.format(
+                self.deferred))
+        self.frontier.close()
+
+        self.writer.close()
+        if self.forums_skipped or self.listings_stopped:
+            self.logger.info('Skipped {} unchanged forums and stopped paging {} listings '
+                    'early'.format(self.forums_skipped, self.listings_stopped))
+        if self.shard is None and finish_crawl(self.engine, self.crawl_id):
+            # Sharded crawls are finished by run_sharded()
+            self.logger.info('Crawl {} finished'.format(self.crawl_id))
+
+        if self.archive is not None:
+            self.archive.close()
+        if self.cache is not None:
+            self.cache.close()
+
+        if self.stop_reporting is not None:
+            self.stop_reporting.set()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        if self.profiler is not None:
+            self.profiler.dump()
+        self.logger.info('Stats: {}'.format(self.metrics.summary()))
+
+    def download_attachments(self, directory):
+        """
+        Fetch the files behind every attachment we've found, using the
+        cookies we got when logging in (or logging in again if they've
+        expired).
+        """
+        self.writer.flush()
+
+        downloader = AttachmentDownloader(self.engine, self.writer, directory,
+                cookiejar=self.cookiejar,
+                username=self.username,
+                password=self.password,
+                concurrency=getattr(self, 'download_concurrency', 4),
+                logger=self.logger)
+        return downloader.run()
+
+    def task_initial(self, grab, task):
+        self.observe(grab)
+        self.login()
+        if self.shard is not None:
+            self.frontier.share_session(self.cookiejar)
+
+        if self.resume or self.incremental:
+            # Anything an earlier crawl didn't get to won't be found again
+            yield from self.resumed_tasks()
+
+        if not self.listing_checked(self.base_url):
             yield Task('forum', url=self.base_url, title='Main Forum')
 
     def task_forum(self, grab, task):
-        if not hasattr(task, 'forum_id'):
+        if not self.observe(grab, task):
+            return
+        self.checkpoint.started(task)
+        parent_id = getattr(task, 'parent_id', None)
+
+        if task.url in self.known_forums:
+            forum_id = self.known_forums[task.url]
+        elif not hasattr(task, 'forum_id'):
             # Add the forum to our database
-            parent_id = getattr(task, 'parent_id', None)
-            new_forum = Forum(name=task.title, link=task.url, parent_id=parent_id)
-            self.session.add(new_forum)
-            self.session.commit()
-            self.logger.debug('Forum created: {}'.format(new_forum))
+            forum_id = self.writer.add(Forum,
+                    name=task.title,
+                    link=task.url,
+                    parent_id=parent_id,
+                    topics=getattr(task, 'topics', None),
+                    posts=getattr(task, 'posts', None),
+                    last_post=getattr(task, 'last_post', None),
+                    last_post_id=getattr(task, 'last_post_id', None),
+                    crawl_id=self.crawl_id)
+            self.logger.debug('Forum created: {} ({})'.format(task.title, forum_id))
         else:
-            new_forum = self.session.query(Forum).filter(Forum.id ==
-                    task.forum_id).first()
+            forum_id = task.forum_id
 
         self.logger.info('Reading forum: {} (page {})'.format(task.title,
                 getattr(task, 'page', 1)))
 
+        start = time.perf_counter()
+        listing = parse_forum(grab.doc.tree, self.base_url)
+        self.metrics.observe('ttc_parse_seconds', time.perf_counter() - start, task='forum')
+
+        if task.url == self.base_url and listing.forums and not self.resume:
+            # Anything older than this is in the database once we're finished
+            self.writer.update(Crawl, self.crawl_id, newest_post=max(
+                (forum.last_post for forum in listing.forums if forum.last_post),
+                default=None))
+
         # Check all the forums we find
-        for elem in grab.doc.select('//a[@class="forumtitle"]'):
-            link = urljoin(self.base_url, elem.attr('href'))
+        for forum in listing.forums:
+            link = canonical_url(forum.link)
             self.logger.debug('Found forum: {}'.format(link))
 
-            if not self.already_checked(link):
+            if self.forum_unchanged(forum, link):
+                continue
+
+            if not self.listing_checked(link):
                 yield Task('forum', url=link, 
-                        title=elem.text(), 
-                        parent_id=new_forum.id)
+                        title=forum.title, 
+                        parent_id=forum_id,
+                        topics=forum.topics,
+                        posts=forum.posts,
+                        last_post=forum.last_post,
+                        last_post_id=forum.last_post_id)
+            elif not self.incremental:
+                # An earlier crawl read it
+                continue
+
+            if link in self.known_forums:
+                self.writer.update(Forum, self.known_forums[link],
+                        topics=forum.topics,
+                        posts=forum.posts,
+                        last_post=forum.last_post,
+                        last_post_id=forum.last_post_id,
+                        crawl_id=self.crawl_id)
 
         # Check all the threads we find
-        for elem in grab.doc.select('//a[@class="topictitle"]'):
-            link = urljoin(self.base_url, elem.attr('href'))
+        for topic in listing.topics:
+            link = canonical_url(topic.link)
             self.logger.debug('Found thread: {}'.format(link))
 
-            if not self.already_checked(link):
+            if link in self.known_threads:
+                yield from self.refresh_thread(topic, link, task, forum_id)
+            elif not self.already_checked(link):
                 yield Task('thread', 
                         url=link, 
-                        title=elem.text(), 
+                        title=topic.title, 
                         forum=task.title,
-                        forum_id=new_forum.id)
+                        forum_id=forum_id,
+                        replies=topic.replies,
+                        last_post=topic.last_post)
 
         # Now queue the other pages of this Forum
-        pager = grab.doc.select('//div[@class="pagination"]')
-        paginations = self.pagination_links(pager)
+        for link, page in self.listing_pages(listing, task):
+            link = canonical_url(urljoin(task.url, link))
 
-        for link, page in paginations:
-            link = urljoin(task.url, link)
-
-            if not self.already_checked(link):
+            if not self.listing_checked(link):
                 yield Task('forum', 
                         url=link, 
-                        title=elem.text(), 
+                        title=task.title, 
                         parent_id=parent_id,
-                        forum_id=new_forum.id,
+                        forum_id=forum_id,
                         page=page)
 
+        self.checkpoint.done(task)
+
+    def forum_unchanged(self, forum, link):
+        """
+        In incremental mode, whether a forum's topic and post counts and
+        latest post are what they were when a finished crawl last read them.
+        phpBB counts sub-forums in their parent's row, so nothing anywhere
+        under the forum can have changed either.
+        """
+        if not self.incremental or link not in self.forum_markers:
+            return False
+
+        marker, crawl_id = self.forum_markers[link]
+        unchanged = crawl_id in self.finished_crawls and None not in marker and \
+                marker == (forum.topics, forum.posts, forum.last_post_id)
+
+        if unchanged:
+            self.forums_skipped += 1
+            self.logger.info('Forum unchanged since the last crawl: {}'.format(forum.title))
+        return unchanged
+
+    def listing_pages(self, listing, task):
+        """
+        The other pages of a forum listing to read. Topics are listed with
+        the most recently active first, so once an incremental crawl knows
+        everything before ``cutoff`` has been crawled it reads a forum one
+        page at a time, stopping at the first page which reaches a topic
+        older than that.
+        """
+        if not self.incremental or self.cutoff is None:
+            return listing.pages
+
+        current = int(getattr(task, 'page', 1))
+        later = [(link, page) for link, page in listing.pages
+                 if page.isdigit() and int(page) > current]
+
+        # Stickies and announcements come first whatever their age, so only
+        # the last topic on the page says how far back it goes
+        oldest = listing.topics[-1].last_post if listing.topics else None
+        if oldest is not None and oldest < self.cutoff:
+            if later:
+                self.listings_stopped += 1
+            return []
+
+        return [(link, page) for link, page in later if int(page) == current + 1]
+
+    def refresh_thread(self, topic, link, task, forum_id):
+        """
+        In incremental mode, queue the tail of a thread we've seen before if
+        the forum listing says it has new posts.
+        """
+        thread_id, replies, last_post, stored = self.known_threads[link]
+        if (topic.replies, topic.last_post) == (replies, last_post):
+            return
+
+        self.writer.update(Thread, thread_id,
+                replies=topic.replies,
+                last_post=topic.last_post)
+        self.known_threads[link] = (thread_id, topic.replies, topic.last_post, stored)
+
+        # Re-read the last page we've (partially) got, skipping the posts on
+        # it we already have. Any newer pages get found via its paginator.
+        start = stored // self.posts_per_page * self.posts_per_page
+        self.logger.info('Thread has new posts: {} ({} -> {} replies)'.format(
+            topic.title, replies, topic.replies))
+
+        yield Task('thread',
+                url=page_url(link, start),
+                title=topic.title,
+                forum=task.title,
+                forum_id=forum_id,
+                thread_id=thread_id,
+                skip_posts=stored - start,
+                page=start // self.posts_per_page + 1)
 
     def task_thread(self, grab, task):
-        if not hasattr(task, 'thread_id'):
-            current_thread = Thread(
+        if not self.observe(grab, task):
+            return
+        self.checkpoint.started(task)
+
+        thread_id = getattr(task, 'thread_id', None)
+        if thread_id is None and getattr(task, 'resumed', False):
+            # The last crawl may have got as far as saving the thread
+            thread_id = self.session.query(Thread.id).filter(
+                    Thread.link == task.url).scalar()
+
+        if thread_id is None:
+            thread_id = self.writer.add(Thread,
                     name=task.title,
                     link=task.url,
-                    forum_id=task.forum_id)
-            self.session.add(current_thread)
-            self.session.commit()
-            self.logger.debug('Thread created: {}'.format(current_thread))
-        else:
-            current_thread = self.session.query(Thread).filter(Thread.id ==
-                    task.thread_id).first()
+                    forum_id=task.forum_id,
+                    replies=getattr(task, 'replies', None),
+                    last_post=getattr(task, 'last_post', None))
+            self.logger.debug('Thread created: {} ({})'.format(task.title, thread_id))
 
-        self.logger.info('Checking thread: {} (page {})'.format(current_thread.name,
+        self.logger.info('Checking thread: {} (page {})'.format(task.title,
             getattr(task, 'page', 1)))
 
-        soup = BeautifulSoup(grab.response.body, 'html.parser')
+        start = time.perf_counter()
+        if self.pipeline is not None:
+            # The posts get saved by save_thread_page() once they're parsed
+            self.pipeline.submit(task.url, grab.response.body, (task, thread_id))
+            pages = list(pagination_links(grab.doc.tree))
+        else:
+            parsed = parse_thread(grab.doc.tree, task.url)
+            pages = parsed.pages
+        self.metrics.observe('ttc_parse_seconds', time.perf_counter() - start, task='thread')
 
-        # Iterate through the posts, saving them
-        for elem in soup.find_all(class_='postbody'):
-            self.parse_post(grab, task, elem, current_thread)
+        if self.pipeline is None:
+            self.save_thread_page((task, thread_id), parsed)
 
         # Now queue the other pages of this thread
-        pager = grab.doc.select('//div[@class="pagination"]')
-        paginations = self.pagination_links(pager)
-
-        for link, page in paginations:
-            link = urljoin(task.url, link)
+        for link, page in pages:
+            link = canonical_url(urljoin(task.url, link))
 
             if not self.already_checked(link):
                 yield Task('thread', 
@@ -159,76 +597,127 @@ class ForumSpider(Spider):
                         title=task.title, 
                         forum=task.forum,
                         forum_id=task.forum_id,
-                        thread_id=current_thread.id,
+                        thread_id=thread_id,
                         page=page)
 
-    def parse_post(self, grab, task, elem, current_thread):
-        author_tag = elem.find(class_='author')
-        author = author_tag.strong.text
-        created = author_tag.text.split('»')[-1].strip()
-        content = elem.find(class_='content')
+    def save_thread_page(self, context, parsed):
+        task, thread_id = context
+
+        for post in parsed.posts[getattr(task, 'skip_posts', 0):]:
+            self.save_post(post, thread_id)
 
-        # Convert the timestamp to a python datetime
-        created_on = datetime.strptime(created, '%a %b %d, %Y %I:%M %p')
+        self.checkpoint.done(task)
 
-        # Convert any relative links in the content to absolute
-        for anchor in content.find_all('a'):
-            anchor['href'] = urljoin(task.url, anchor['href'])
+    def save_post(self, post, thread_id):
+        if post.phpbb_id in self.known_posts:
+            self.logger.debug('Skipping post we already have: {}'.format(post.phpbb_id))
+            return
+        if post.phpbb_id is not None:
+            self.known_posts.add(post.phpbb_id)
 
-        new_post = Post(
-                author=author,
-                created=created_on,
-                html=innerHTML(content),
-                text=html2text(innerHTML(content)),
-                thread_id=current_thread.id)
+        post_id = queue_post(self.writer, post, thread_id, compact=self.compact_storage)
+        self.logger.debug('Post created: {} by {} ({})'.format(
+            post_id, post.author, post.created))
 
-        self.session.add(new_post)
-        self.session.commit()
-        self.logger.debug('Post created: {}'.format(new_post))
+        for name, link in post.images:
+            self.logger.info('Found inline attachment: {}'.format(name))
 
-        # look for embedded images
-        embedded_images = content.find_all('img')
+        for name, link in post.attachments:
+            self.logger.info('Attachment found: {}'.format(name))
 
-        for img in embedded_images:
-            link = urljoin(task.url, img['src'])
+    def already_checked(self, url):
+        return not self.seen_urls.add(url)
 
-            new_attachment = Attachment(
-                    name=img.get('alt', '').strip() or link.split('/')[-1], 
-                    link=link)
-            new_attachment.post_id = new_post.id
-            self.session.add(new_attachment)
-            self.session.commit()
+    def listing_checked(self, url):
+        """
+        Forum listings are where new threads and replies show up, so an
+        incremental crawl revisits them (once per run) regardless of whether
+        they've been seen before.
+        """
+        if not self.incremental:
+            return self.already_checked(url)
 
-            self.logger.info('Found inline attachment: {}'.format(new_attachment))
+        if url in self.listings_seen:
+            return True
 
-        # Check if there were any attachments
-        attach_box = elem.find(class_='attachbox')
-        if attach_box is not None:
-            for thing in attach_box.find_all(class_='postlink'):
-                link = urljoin(task.url, thing['href'])
-                name = thing.text
+        self.listings_seen.add(url)
+        self.already_checked(url)
+        return False
 
-                new_attachment = Attachment(name=name, link=link)
-                new_attachment.post_id = new_post.id
-                self.session.add(new_attachment)
-                self.session.commit()
 
-                self.logger.info('Attachment found: {}'.format(new_attachment))
+class ForumSpider(ForumCrawler, Spider):
+    def create_grab_instance(self, **kwargs):
+        """
+        Because we're logging in, we need to set the user agent and copy
+        across the cookies we were given on login.
+        """
+        limiter = getattr(self, 'limiter', None)
+        if limiter is not None:
+            # Responses are handled on this thread, so we can't block waiting
+            # for a free slot
+            limiter.wait(paced=True)
 
-    def already_checked(self, url):
-        if url in self.visited_urls:
-            return True
+        g = super().create_grab_instance(**kwargs)
+        g.setup(user_agent='ttc_scraper')
+
+        cookies = getattr(self, 'cookies', None)
+        if cookies:
+            g.cookies = cookies
+
+        return g
+
+    def log_failed_network_result(self, res):
+        """
+        grab's hook for every request which won't be handled: network errors
+        and timeouts as well as error responses. None of them reach
+        ``observe()``, so the rate limiter hears about them here.
+        """
+        super().log_failed_network_result(res)
+
+        if res['ok']:
+            code = res['grab'].doc.code
+            self.limiter.record(ok=code < 500 and code != 429)
         else:
-            try:
-                new_url = Url(link=url)
-                self.session.add(new_url)
-                self.session.commit()
-                self.visited_urls.add(url)
-                return False
-            except (IntegrityError, InvalidRequestError):
-                self.session.rollback()
-                return True
-
-    def pagination_links(self, pagination_element):
-        for elem in pagination_element.select('span/a'):
-            yield (elem.attr('href'), elem.text())
+            self.logger.warning('Unable to fetch {}: {}'.format(
+                res['grab_config_backup'].get('url'), res.get('error_abbr')))
+            self.limiter.record(ok=False)
+
+    def queue_size(self):
+        return self.task_queue.size() if self.task_queue is not None else 0
+
+    def use_session(self, cookies):
+        """
+        Use cookies from somebody else's login instead of logging in.
+        """
+        self.cookies = CookieManager.from_cookie_list(cookies)
+        self.cookiejar = self.cookies.cookiejar
+
+    def setup_grab_for_task(self, task):
+        self.metrics.inc('ttc_requests_started_total', task=task.name)
+        g = super().setup_grab_for_task(task)
+
+        headers = self.request_headers(task)
+        if headers:
+            g.setup(headers=headers)
+
+        return g
+
+    def login(self):
+        self.logger.info('Logging in')
+
+        g = Grab(user_agent='ttc_scraper')
+        g.go(self.base_url)
+        g.doc.set_input('username', self.username)
+        g.doc.set_input('password', self.password)
+        g.doc.submit()
+
+        elem = g.doc.select('//a[contains(text(),"All Users Must Register")]')
+
+        if len(elem):
+            self.logger.error('Login failed')
+            raise RuntimeError('Login failed')
+        else:
+            self.cookies = g.cookies
+            self.cookiejar = g.cookies.cookiejar
+            self.logger.info('Login successful')
+
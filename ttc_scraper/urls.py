@@ -0,0 +1,65 @@
+"""
+Canonicalising phpBB links so the same page always maps to the same URL.
+
+phpBB sprinkles ``sid=`` session tokens through every link it generates and
+is inconsistent about parameter order, so without this the spider would
+happily fetch (and store) the same page several times over.
+"""
+from html import unescape
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+#: The only query parameters which actually identify a page, per script
+SIGNIFICANT_PARAMS = {
+    'viewforum.php': ('f', 'start'),
+    'viewtopic.php': ('t', 'p', 'start'),
+}
+
+#: Parameters which never change what a page contains
+NOISE_PARAMS = {'sid', 'hilit', 'view', 'sk', 'sd', 'st'}
+
+
+def canonical_url(url):
+    """
+    Normalise a URL so every link to the same page compares equal: ``&amp;``
+    is unescaped, session ids and the fragment are dropped, ``start=0`` is
+    removed and the remaining parameters are sorted. On topic and forum
+    pages only the parameters which select the page are kept.
+    """
+    parts = urlsplit(unescape(url).strip())
+    script = parts.path.rsplit('/', 1)[-1]
+    params = parse_qsl(parts.query, keep_blank_values=True)
+
+    if script in SIGNIFICANT_PARAMS:
+        wanted = SIGNIFICANT_PARAMS[script]
+        params = [(k, v) for k, v in params if k in wanted]
+
+        # a topic id makes the post id redundant
+        if any(k == 't' for k, _ in params):
+            params = [(k, v) for k, v in params if k != 'p']
+    else:
+        params = [(k, v) for k, v in params if k not in NOISE_PARAMS]
+
+    params = sorted((k, v) for k, v in params
+                    if not (k == 'start' and _int(v) == 0))
+
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path, urlencode(params), ''))
+
+
+def page_url(url, start):
+    """
+    The canonical URL for the page of a forum or topic starting at post (or
+    topic) number ``start``.
+    """
+    parts = urlsplit(canonical_url(url))
+    params = [(k, v) for k, v in parse_qsl(parts.query) if k != 'start']
+    params.append(('start', str(start)))
+    return canonical_url(urlunsplit(parts._replace(query=urlencode(params))))
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
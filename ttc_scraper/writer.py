@@ -0,0 +1,428 @@
+"""
+A write-behind buffer for the scraper's database.
+
+Rather than committing every row as soon as it's scraped, rows are queued up
+and written in one transaction per batch using executemany-style bulk
+inserts. Primary keys are handed out client-side so the spider can keep
+referencing a row (e.g. a post's attachments) before it hits the disk.
+
+A ``threaded`` writer hands each batch to a writer thread of its own, so the
+crawl carries on while it's written. The thread keeps one connection open
+for its whole life, which keeps SQLite's page cache warm and lets it reuse
+the prepared statements for each table.
+"""
+import time
+import atexit
+import signal
+import logging
+import threading
+from queue import Queue
+from collections import OrderedDict
+
+from sqlalchemy import func, select, bindparam, literal
+from sqlalchemy.exc import IntegrityError
+
+from .models import Base, Post, Attachment, Author, Link, IdRange, compress_text
+
+
+def queue_post(writer, post, thread_id, downloads=None, compact=None):
+    """
+    Queue a parsed ``PostRecord`` and its attachments, returning the post's
+    id. ``downloads`` optionally maps attachment links to the ``sha256`` and
+    ``size`` of files which have already been downloaded. Passing a
+    ``CompactStorage`` writes the post in the compact layout.
+    """
+    downloads = downloads or {}
+
+    values = dict(phpbb_id=post.phpbb_id,
+            created=post.created,
+            text=post.text,
+            thread_id=thread_id)
+    if compact is None:
+        values.update(author=post.author, html=post.html)
+    else:
+        values.update(author_id=compact.authors(post.author),
+                html=compress_text(post.html))
+
+    post_id = writer.add(Post, **values)
+
+    for name, link in post.images + post.attachments:
+        if compact is None:
+            where = dict(link=link)
+        else:
+            where = dict(link_id=compact.links(link))
+
+        writer.add(Attachment, name=name, post_id=post_id,
+                **where, **downloads.get(link, {}))
+
+    return post_id
+
+
+class Interned:
+    """
+    Hands out the ids of the rows in a lookup table (e.g. ``authors``) by
+    value, adding a row through the writer the first time a value turns up.
+    Every existing row is loaded up front.
+
+    If ``shared``, other processes may be adding the same values, so new
+    rows are written straight away and whichever id won is used.
+    """
+
+    def __init__(self, engine, writer, model, column, shared=False):
+        self.engine = engine
+        self.writer = writer
+        self.model = model
+        self.column = column
+        self.shared = shared
+
+        table = model.__table__
+        with engine.connect() as conn:
+            self._ids = {value: row_id for row_id, value in
+                         conn.execute(select([table.c.id, table.c[column]]))}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __call__(self, value):
+        if value is None:
+            return None
+
+        if value not in self._ids:
+            if self.shared:
+                self._ids[value] = self._add_shared(value)
+            else:
+                self._ids[value] = self.writer.add(self.model, **{self.column: value})
+        return self._ids[value]
+
+    def _add_shared(self, value):
+        table = self.model.__table__
+
+        with self.engine.begin() as conn:
+            conn.execute(table.insert().prefix_with('OR IGNORE'), {self.column: value})
+            return conn.execute(select([table.c.id])
+                    .where(table.c[self.column] == value)).scalar()
+
+
+class CompactStorage:
+    """
+    The compact layout for posts: HTML is zlib-compressed, and authors and
+    attachment links are stored once in their own tables and referred to by
+    id. Anything reading posts copes with either layout.
+    """
+
+    def __init__(self, engine, writer, shared=False):
+        self.authors = Interned(engine, writer, Author, 'name', shared=shared)
+        self.links = Interned(engine, writer, Link, 'link', shared=shared)
+
+    @staticmethod
+    def in_use(engine):
+        """
+        Whether any posts have already been written in the compact layout,
+        in which case new ones should be too.
+        """
+        with engine.connect() as conn:
+            return conn.execute(select([Post.id])
+                    .where(Post.author_id != None)
+                    .limit(1)).first() is not None
+
+
+class BatchWriter:
+    #: Tables where an insert which conflicts with an existing row is
+    #: silently dropped instead of being treated as an error.
+    ignore_conflicts = {'_urls', 'posts', 'attachments'}
+
+    #: Tables where an insert which conflicts with an existing row replaces it
+    replace_conflicts = {'_tasks'}
+
+    #: Tables whose primary keys are handed out by the writer
+    assign_ids = {'forums', 'threads', 'posts', '_tasks', 'authors', 'links'}
+
+    def __init__(self, engine, batch_size=500, flush_interval=5.0, logger=None,
+            metadata=Base.metadata, id_block=None, threaded=False, max_queued=4):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        #: Reserve primary keys this many at a time from the ``_ids`` table,
+        #: so writers in other processes never hand out the same ones
+        self.id_block = id_block
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._lock = threading.RLock()
+        self._pending = OrderedDict(
+                (table, []) for table in metadata.sorted_tables)
+        self._updates = OrderedDict(
+                (table, []) for table in metadata.sorted_tables)
+        self._pending_count = 0
+        self._next_ids = {}
+        self._reserved = {}
+        self._last_flush = time.monotonic()
+        self._closed = False
+        self._statements = {}
+        self._compiled = {}
+
+        #: Callbacks to run as each batch is taken to be written (with the
+        #: lock held), and once it has been written. Every batch gets a
+        #: call to each, in the same order.
+        self.on_batch = []
+        self.on_flush = []
+
+        self.rows_written = 0
+        self.flush_time = 0.0
+        self.last_flush_time = None
+
+        self._queue = None
+        self._error = None
+        if threaded:
+            # Bounded, so a crawl which outruns the disk slows down rather
+            # than filling up memory
+            self._queue = Queue(maxsize=max_queued)
+            self._thread = threading.Thread(target=self._write_batches,
+                    name='batch-writer', daemon=True)
+            self._thread.start()
+
+    def add(self, model, **values):
+        """
+        Queue a row for insertion, returning its primary key (if the table
+        is in ``assign_ids`` and one wasn't provided). ``model`` may be an
+        ORM class or a plain ``Table``.
+        """
+        table = getattr(model, '__table__', model)
+
+        with self._lock:
+            if table.name in self.assign_ids:
+                values.setdefault('id', self._next_id(table))
+
+            self._pending[table].append(values)
+            self._pending_count += 1
+
+            if (self._pending_count >= self.batch_size or
+                    time.monotonic() - self._last_flush >= self.flush_interval):
+                self._submit()
+
+        return values.get('id')
+
+    def update(self, model, id, **values):
+        """
+        Queue an update to an existing row. Updates are applied after the
+        batch's inserts, in the same transaction.
+        """
+        values['_id'] = id
+
+        with self._lock:
+            self._updates[getattr(model, '__table__', model)].append(values)
+            self._pending_count += 1
+
+            if self._pending_count >= self.batch_size:
+                self._submit()
+
+    def _next_id(self, table):
+        if self.id_block:
+            return self._reserved_id(table)
+
+        if table.name not in self._next_ids:
+            with self.engine.connect() as conn:
+                current = conn.execute(select([func.max(table.c.id)])).scalar()
+            self._next_ids[table.name] = current or 0
+
+        self._next_ids[table.name] += 1
+        return self._next_ids[table.name]
+
+    def _reserved_id(self, table):
+        next_id, end = self._reserved.get(table.name, (0, 0))
+        if next_id >= end:
+            next_id = self._reserve(table)
+            end = next_id + self.id_block
+
+        self._reserved[table.name] = (next_id + 1, end)
+        return next_id
+
+    def _reserve(self, table):
+        ids = IdRange.__table__
+
+        # Each statement writes, so the transaction holds the write lock
+        # from the start and nobody can reserve the same block
+        with self.engine.begin() as conn:
+            conn.execute(ids.insert().prefix_with('OR IGNORE').from_select(
+                [ids.c.name, ids.c.next_id],
+                select([literal(table.name), func.coalesce(func.max(table.c.id), 0) + 1])))
+            conn.execute(ids.update()
+                    .where(ids.c.name == table.name)
+                    .values(next_id=ids.c.next_id + self.id_block))
+            end = conn.execute(select([ids.c.next_id])
+                    .where(ids.c.name == table.name)).scalar()
+
+        return end - self.id_block
+
+    def _insert(self, table):
+        stmt = table.insert()
+        if table.name in self.ignore_conflicts:
+            stmt = stmt.prefix_with('OR IGNORE')
+        elif table.name in self.replace_conflicts:
+            stmt = stmt.prefix_with('OR REPLACE')
+        return stmt
+
+    def _update(self, table):
+        return table.update().where(table.c.id == bindparam('_id'))
+
+    def _statement(self, table, statement):
+        # The same statement object every time, so it's only compiled once
+        # (per set of columns) and SQLite can reuse the prepared statement
+        key = (table.name, statement.__name__)
+        if key not in self._statements:
+            self._statements[key] = statement(table)
+        return self._statements[key]
+
+    def _write(self, conn, table, rows, statement):
+        # executemany needs every row to have the same set of keys
+        groups = OrderedDict()
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+
+        for group in groups.values():
+            conn.execute(self._statement(table, statement), group)
+
+    def _batches(self):
+        batches = [(table, rows, self._insert)
+                   for table, rows in self._pending.items() if rows]
+        batches += [(table, rows, self._update)
+                    for table, rows in self._updates.items() if rows]
+
+        for table in self._pending:
+            self._pending[table] = []
+            self._updates[table] = []
+
+        return batches
+
+    def _submit(self):
+        """
+        Take everything that's currently queued as a batch and write it (or
+        hand it to the writer thread).
+        """
+        with self._lock:
+            batches = self._batches()
+            count, self._pending_count = self._pending_count, 0
+            self._last_flush = time.monotonic()
+
+            if not batches:
+                return
+
+            for callback in self.on_batch:
+                callback()
+
+            if self._queue is None:
+                with self.engine.connect() as conn:
+                    self._write_batch(conn, batches, count)
+            else:
+                self._queue.put((batches, count))
+
+    def flush(self):
+        """
+        Write everything that's currently queued in a single transaction,
+        returning once it's been written.
+        """
+        self._submit()
+
+        if self._queue is not None:
+            self._queue.join()
+
+            error, self._error = self._error, None
+            if error is not None:
+                raise error
+
+    def _write_batches(self):
+        with self.engine.connect() as conn:
+            while True:
+                item = self._queue.get()
+                try:
+                    if item is None:
+                        break
+                    self._write_batch(conn, *item)
+                except Exception as e:
+                    self.logger.exception('Unable to write a batch of {} rows'.format(item[1]))
+                    self._error = e
+                finally:
+                    self._queue.task_done()
+
+    def _write_batch(self, conn, batches, count):
+        start = time.monotonic()
+        try:
+            with conn.begin():
+                cached = conn.execution_options(compiled_cache=self._compiled)
+                for table, rows, statement in batches:
+                    self._write(cached, table, rows, statement)
+        except IntegrityError as e:
+            self.logger.warning('Batch rejected ({}), retrying row by row'.format(e.orig))
+            count = self._write_individually(conn, batches)
+        finally:
+            elapsed = time.monotonic() - start
+            self.flush_time += elapsed
+            self.last_flush_time = elapsed
+
+            for callback in self.on_flush:
+                callback()
+
+        self.rows_written += count
+        self.logger.debug('Flushed {} rows in {:.3f}s ({:.0f} rows/sec)'.format(
+            count, elapsed, count / elapsed if elapsed else 0))
+
+    def _write_individually(self, conn, batches):
+        written = 0
+
+        for table, rows, statement in batches:
+            for row in rows:
+                try:
+                    with conn.begin():
+                        conn.execute(self._statement(table, statement), row)
+                    written += 1
+                except IntegrityError as e:
+                    self.logger.error('Dropping {} row {}: {}'.format(
+                        table.name, row, e.orig))
+
+        return written
+
+    def close(self):
+        """
+        Flush any outstanding rows (stopping the writer thread, if there is
+        one) and log the overall write throughput.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                if self._queue is not None:
+                    self._queue.put(None)
+                    self._thread.join()
+                    # Anything added from now on is written straight away
+                    self._queue = None
+
+        self.logger.info('Wrote {} rows in {:.2f}s ({:.0f} rows/sec)'.format(
+            self.rows_written, self.flush_time,
+            self.rows_written / self.flush_time if self.flush_time else 0))
+
+    def install_handlers(self):
+        """
+        Make sure pending rows are written if the interpreter exits or the
+        process is asked to terminate.
+        """
+        atexit.register(self.close)
+
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            self.logger.warning('Caught signal {}, flushing pending rows'.format(signum))
+            self.close()
+
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                raise SystemExit(128 + signum)
+
+        signal.signal(signal.SIGTERM, on_sigterm)